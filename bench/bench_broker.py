@@ -0,0 +1,141 @@
+#!/usr/bin/env python2
+# Load test for the ccerbdd directory.
+#
+# Registers `--workers` fake workers, each advertising a few of `--job-keys` job keys
+# and changing its load `--updates` times per second, then has client processes
+# ask for workers the way shims do: a fresh connection per query.
+from __future__ import print_function
+assert __name__ == '__main__'
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+import ccerb
+import net_util
+
+####
+
+def worker_thread(addr, port, job_keys, updates, stop):
+    conn = ccerb.directory_connect(addr, ccerb.DIRECTORY_WORKER)
+    ccerb.register_worker(conn, '10.0.0.1', port, job_keys)
+    max_slots = random.choice([8, 16, 32])
+    while not stop.is_set():
+        busy = random.randint(0, max_slots + 4)
+        status = ccerb.RemoteStatus(True, max(max_slots - busy, 0), max_slots,
+                                    max(busy - max_slots, 0), 1.0)
+        ccerb.send_status(conn, status)
+        time.sleep(1.0 / updates)
+    net_util.kill_socket(conn)
+
+
+def client_proc(addr, job_keys, seconds, queue):
+    lats = []
+    errors = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        job_key = random.choice(job_keys)
+        start = time.time()
+        try:
+            conn = ccerb.directory_connect(addr, ccerb.DIRECTORY_CLIENT)
+            ccerb.query_directory(conn, job_key, 2)
+            net_util.kill_socket(conn)
+        except (socket.error, net_util.ExSocketClosed):
+            errors += 1
+            continue
+        lats.append(time.time() - start)
+    queue.put((lats, errors))
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float('nan')
+    i = min(len(sorted_vals) - 1, int(len(sorted_vals) * p / 100.0))
+    return sorted_vals[i]
+
+####
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, default=15600)
+parser.add_argument('--workers', type=int, default=200)
+parser.add_argument('--job-keys', type=int, default=20)
+parser.add_argument('--keys-per-worker', type=int, default=3)
+parser.add_argument('--updates', type=float, default=5.0)
+parser.add_argument('--procs', type=int, default=4)
+parser.add_argument('--seconds', type=float, default=5.0)
+args = parser.parse_args()
+
+socket.setdefaulttimeout(10.0)
+
+home_dir = tempfile.mkdtemp(prefix='ccerb-bench-')
+try:
+    with open(os.path.join(home_dir, '.ccerb.ini'), 'wb') as f:
+        f.write('directory_port={}\n'.format(args.port))
+
+    env = dict(os.environ)
+    env['HOME'] = home_dir
+    daemon = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'ccerbdd.py')],
+                              env=env, stdout=open(os.devnull, 'wb'),
+                              stderr=subprocess.STDOUT)
+    try:
+        time.sleep(1.0)
+        addr = ('127.0.0.1', args.port)
+
+        all_keys = ['job_key_{}'.format(i) for i in range(args.job_keys)]
+        stop = threading.Event()
+        for i in range(args.workers):
+            keys = random.sample(all_keys, min(args.keys_per_worker, len(all_keys)))
+            t = threading.Thread(target=worker_thread,
+                                 args=(addr, 10000 + i, keys, args.updates, stop))
+            t.daemon = True
+            t.start()
+        time.sleep(1.0)
+
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client_proc,
+                                         args=(addr, all_keys, args.seconds, queue))
+                 for _ in range(args.procs)]
+        start = time.time()
+        for p in procs:
+            p.start()
+        results = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+        diff = time.time() - start
+        stop.set()
+
+        lats = sorted(sum([x for (x, _) in results], []))
+        errors = sum([x for (_, x) in results])
+        print('{} workers, {} job keys, {:.0f} status updates/s:'.format(
+              args.workers, args.job_keys, args.workers * args.updates))
+        print('{:8.0f} queries/s  p50 {:6.2f}ms  p99 {:6.2f}ms  errors {}'.format(
+              len(lats) / diff, percentile(lats, 50) * 1000, percentile(lats, 99) * 1000,
+              errors))
+
+        try:
+            with open('/proc/{}/stat'.format(daemon.pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+            print('ccerbdd cpu: {:.2f}s total, {:.0f}us per query'.format(
+                  cpu, cpu * 1000 * 1000 / max(len(lats), 1)))
+        except (IOError, OSError, ValueError):
+            pass # Not Linux.
+    finally:
+        daemon.terminate()
+        daemon.wait()
+finally:
+    shutil.rmtree(home_dir)
+
+# Skip tearing down the fake workers' daemon threads.
+sys.stdout.flush()
+os._exit(0)
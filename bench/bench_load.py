@@ -0,0 +1,309 @@
+#!/usr/bin/env python2
+# Load test of a whole ccerberus setup on one box, without a real toolchain.
+#
+# Starts a front ccerbd (which the shims talk to, on the default local ports) and
+# `--remotes` more on localhost ports, each with its own HOME, all running a fake
+# compiler with configurable CPU time and output sizes. Then drives ccerb_shim.py
+# at each `-j` level, reporting jobs/s, latency percentiles, and the mean of each
+# phase from the shims' and ccerbds' trace spans. Save a run with --save, and
+# compare a later one against it with --baseline.
+from __future__ import print_function
+assert __name__ == '__main__'
+
+import argparse
+import collections
+import json
+import os
+import Queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+import ccerb
+import trace_util
+
+FAKE_CC = '''#!{python}
+import hashlib, os, sys, time
+args = sys.argv[1:]
+if args == ['-v']:
+    sys.stderr.write('bench_cc 1.0\\n')
+    sys.exit(0)
+
+source = [x for x in args if x.endswith('.c')][0]
+with open(source, 'rb') as f:
+    text = f.read()
+tag = hashlib.sha1(text).hexdigest()[:8]
+
+if '-E' in args:
+    line = 'int sym_{{}}_%s;\\n' % tag
+    size = 0
+    i = 0
+    while size < {preproc_bytes}:
+        out = line.format(i)
+        sys.stdout.write(out)
+        size += len(out)
+        i += 1
+    sys.stdout.write(text)
+    sys.exit(0)
+
+start = time.clock()
+while time.clock() - start < {cpu_secs}:
+    pass
+sys.stderr.write('{warning}')
+for x in args:
+    if x.startswith('-Fo'):
+        # Half noise, half padding: about as compressible as an object file.
+        half = {obj_bytes} // 2
+        with open(x[3:], 'wb') as f:
+            f.write(os.urandom(half) + tag * ((half + 7) // 8))
+'''
+
+####
+
+def write_file(path, data, mode=0o644):
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 0.5).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def start_ccerbd(home_dir, ini):
+    write_file(os.path.join(home_dir, '.ccerb.ini'), ini)
+    env = dict(os.environ)
+    env['HOME'] = home_dir
+    log = open(os.path.join(home_dir, 'ccerbd.log'), 'wb')
+    return subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'ccerbd.py')],
+                            env=env, cwd=home_dir, stdout=log, stderr=subprocess.STDOUT)
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float('nan')
+    i = min(len(sorted_vals) - 1, int(len(sorted_vals) * p / 100.0))
+    return sorted_vals[i]
+
+####
+
+def run_level(jobs, count, shim_args, env, work_dir):
+    # Returns ([latency secs], failures, wall secs).
+    queue = Queue.Queue()
+    for i in range(count):
+        queue.put(i)
+
+    lock = threading.Lock()
+    lats = []
+    failures = [0]
+    devnull = open(os.devnull, 'wb')
+    def thread():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            args = shim_args + ['-c', '-Fosrc{}.obj'.format(i), 'src{}.c'.format(i)]
+            start = time.time()
+            returncode = subprocess.call(args, env=env, cwd=work_dir, stdout=devnull,
+                                         stderr=devnull)
+            lat = time.time() - start
+            with lock:
+                lats.append(lat)
+                if returncode != 0:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=thread) for _ in range(jobs)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (sorted(lats), failures[0], time.time() - start)
+
+
+def take_spans(trace_dirs):
+    # Reads and clears what's been traced so far.
+    spans = []
+    for trace_dir in trace_dirs:
+        path = os.path.join(trace_dir, trace_util.TRACE_FILE_NAME)
+        try:
+            with open(path, 'rb') as f:
+                lines = f.readlines()
+            os.remove(path)
+        except (IOError, OSError):
+            continue
+        for line in lines:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                pass
+    return spans
+
+
+def phase_means(spans):
+    # {'host proc': {name: mean secs}}
+    durs = collections.defaultdict(list)
+    for span in spans:
+        durs[('{} {}'.format(span['host'], span['proc']), span['name'])].append(
+            span['dur'])
+    ret = collections.defaultdict(dict)
+    for ((proc, name), vals) in durs.items():
+        ret[proc][name] = sum(vals) / len(vals)
+    return ret
+
+
+def report(jobs, result, baseline):
+    def delta(key, higher_is_better=False):
+        if not baseline or key not in baseline:
+            return ''
+        was = baseline[key]
+        if not was:
+            return ''
+        change = 100.0 * (result[key] - was) / was
+        is_worse = (change < 0) if higher_is_better else (change > 0)
+        return ' ({}{:.1f}%{})'.format('+' if change > 0 else '', change,
+                                       ' worse' if is_worse else '')
+
+    print('-j {}: {} jobs, {} failed, {} shimmed out, {:.1f}s'.format(
+          jobs, result['jobs'], result['failures'], result['shim_outs'], result['secs']))
+    print('    {:.2f} jobs/s{}'.format(result['jobs_per_sec'],
+                                        delta('jobs_per_sec', True)))
+    for p in ('p50', 'p95', 'p99'):
+        print('    {} {:.1f}ms{}'.format(p, result[p] * 1000, delta(p)))
+    for (proc, phases) in sorted(result['phases'].items()):
+        print('    {}:'.format(proc))
+        for (name, secs) in sorted(phases.items(), key=lambda x: -x[1]):
+            print('        {:>16} {:8.1f}ms'.format(name, secs * 1000))
+    return
+
+####
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-j', default='1,4,16', help='Comma-separated concurrency levels.')
+parser.add_argument('-n', type=int, default=100, help='Jobs per level.')
+parser.add_argument('--remotes', type=int, default=2)
+parser.add_argument('--port', type=int, default=15600,
+                    help='First of the ccerbds\' public and metrics ports.')
+parser.add_argument('--cpu-ms', type=float, default=50.0, help='CPU time per compile.')
+parser.add_argument('--preproc-kb', type=int, default=256)
+parser.add_argument('--obj-kb', type=int, default=64)
+parser.add_argument('--warning', action='store_true', help='Compiles print a warning.')
+parser.add_argument('--forward', action='store_true', help='Shims forward via ccerbd.')
+parser.add_argument('--no-local', action='store_true', help='Never compile locally.')
+parser.add_argument('--cache-mb', type=int, default=0, help='ccerbds\' result caches.')
+parser.add_argument('--no-trace', action='store_true', help='No phase breakdown.')
+parser.add_argument('--extra', default='', help='Extra .ccerb.ini lines for every'
+                    ' ccerbd, separated by \';\'.')
+parser.add_argument('--save', help='Write the results to this JSON file.')
+parser.add_argument('--baseline', help='Compare against results saved with --save.')
+parser.add_argument('--keep', action='store_true', help='Keep the temp dir.')
+args = parser.parse_args()
+
+levels = [int(x) for x in args.j.split(',')]
+baseline = dict()
+if args.baseline:
+    with open(args.baseline, 'rb') as f:
+        baseline = json.load(f)
+
+root_dir = tempfile.mkdtemp(prefix='ccerb-load-')
+daemons = []
+try:
+    cc_path = os.path.join(root_dir, 'bench_cc')
+    warning = 'src.c(1): warning C4100: unreferenced parameter\\n' if args.warning else ''
+    write_file(cc_path, FAKE_CC.format(python=sys.executable,
+                                       preproc_bytes=args.preproc_kb * 1024,
+                                       cpu_secs=args.cpu_ms / 1000.0,
+                                       obj_bytes=args.obj_kb * 1024, warning=warning),
+               0o755)
+
+    remote_ports = [args.port + 1 + i for i in range(args.remotes)]
+    # Hosts must differ, and all of 127/8 is loopback.
+    remotes_ini = ''.join(['127.0.0.{}={}\n'.format(i + 1, x)
+                           for (i, x) in enumerate(remote_ports)])
+    extra_ini = ''.join([x.strip() + '\n' for x in args.extra.split(';') if x.strip()])
+
+    homes = []
+    for (i, port) in enumerate([args.port] + remote_ports):
+        home_dir = os.path.join(root_dir, 'front' if i == 0 else 'remote{}'.format(i))
+        os.mkdir(home_dir)
+        os.mkdir(os.path.join(home_dir, 'ws'))
+        homes.append(home_dir)
+
+        ini = 'host_info={}\nport={}\nresult_cache_mb={}\nmetrics_port={}\n'.format(
+              'front' if i == 0 else 'remote', port, args.cache_mb, port + 100)
+        # Out of the shared temp dir, so it goes with the rest when we're done.
+        ini += 'workspace_dir={}\n'.format(os.path.join(home_dir, 'ws'))
+        if not args.no_trace:
+            ini += 'trace_dir={}\n'.format(os.path.join(home_dir, 'trace'))
+        if i == 0:
+            ini += 'forward={}\nno_local={}\n'.format(int(args.forward),
+                                                    int(args.no_local))
+        ini += extra_ini
+        ini += '[bin]\n{}=\n[dedicated_remotes]\n'.format(cc_path)
+        if i == 0:
+            ini += remotes_ini
+        daemons.append(start_ccerbd(home_dir, ini))
+
+        # The front has to get the local ports before any remote tries for them.
+        if not wait_for_port(port) or (i == 0 and
+                                       not wait_for_port(ccerb.CCERBD_LOCAL_ADDR[1])):
+            print('ccerbd on port {} didn\'t come up: see {}'.format(port, home_dir))
+            args.keep = True
+            exit(1)
+
+    work_dir = os.path.join(root_dir, 'work')
+    os.mkdir(work_dir)
+    for i in range(args.n):
+        write_file(os.path.join(work_dir, 'src{}.c'.format(i)),
+                   'int unit_{} = {};\n'.format(i, i))
+
+    env = dict(os.environ)
+    env['HOME'] = homes[0]
+    shim_args = [sys.executable, os.path.join(ROOT_DIR, 'ccerb_shim.py'), cc_path]
+    trace_dirs = [os.path.join(x, 'trace') for x in homes]
+
+    # Warm up: job key caches, pooled connections, workspaces.
+    run_level(max(levels), min(args.n, 8), shim_args, env, work_dir)
+    time.sleep(1.5)
+    take_spans(trace_dirs)
+
+    results = dict()
+    for jobs in levels:
+        (lats, failures, secs) = run_level(jobs, args.n, shim_args, env, work_dir)
+        time.sleep(1.5) # For the ccerbds to flush their spans.
+        spans = take_spans(trace_dirs)
+
+        result = {'jobs': len(lats), 'failures': failures, 'secs': secs,
+                  'jobs_per_sec': len(lats) / secs, 'p50': percentile(lats, 50),
+                  'p95': percentile(lats, 95), 'p99': percentile(lats, 99),
+                  'shim_outs': len([x for x in spans if x['name'] == 'shim_out']),
+                  'phases': phase_means(spans)}
+        results[str(jobs)] = result
+        report(jobs, result, baseline.get(str(jobs)))
+
+    if args.save:
+        with open(args.save, 'wb') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+finally:
+    for p in daemons:
+        p.terminate()
+    for p in daemons:
+        p.wait()
+    if args.keep:
+        print('Kept {}'.format(root_dir))
+    else:
+        shutil.rmtree(root_dir, ignore_errors=True)
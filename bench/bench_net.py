@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+# Compares net_util.serve_forever (thread per connection) with net_util.EventLoop.
+#
+# Clients run in separate processes, each doing connect/request/reply/close cycles,
+# while `--idle` extra connections sit open on the server.
+from __future__ import print_function
+assert __name__ == '__main__'
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import net_util
+
+####
+
+def echo(conn):
+    try:
+        data = net_util.recv_buffer(conn)
+    except net_util.ExSocketClosed:
+        return None
+    net_util.send_buffer(conn, data)
+    return echo
+
+
+def accept_loop(conn, addr):
+    # Like the ccerbd handlers: wait for each request on the loop, not a thread.
+    conn.settimeout(None)
+    return echo
+
+
+def accept_threaded(conn, addr):
+    conn.settimeout(None)
+    while echo(conn):
+        continue
+
+####
+
+def client_proc(addr, cycles, threads, queue):
+    lats = []
+    errors = [0]
+    lock = threading.Lock()
+    def thread():
+        mine = []
+        for _ in range(cycles):
+            start = time.time()
+            try:
+                conn = socket.create_connection(addr, 10.0)
+                net_util.send_buffer(conn, b'ping')
+                net_util.recv_buffer(conn)
+                net_util.kill_socket(conn)
+            except (socket.error, net_util.ExSocketClosed):
+                with lock:
+                    errors[0] += 1
+                continue
+            mine.append(time.time() - start)
+        with lock:
+            lats.extend(mine)
+
+    ts = [threading.Thread(target=thread) for _ in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    queue.put((lats, errors[0]))
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float('nan')
+    i = min(len(sorted_vals) - 1, int(len(sorted_vals) * p / 100.0))
+    return sorted_vals[i]
+
+
+def run(name, addr, args):
+    idle = []
+    for _ in range(args.idle):
+        conn = socket.create_connection(addr)
+        net_util.send_buffer(conn, b'hi')
+        net_util.recv_buffer(conn)
+        idle.append(conn)
+    time.sleep(0.5)
+    server_threads = threading.active_count()
+
+    queue = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=client_proc,
+                                     args=(addr, args.cycles, args.threads, queue))
+             for _ in range(args.procs)]
+    start = time.time()
+    for p in procs:
+        p.start()
+    results = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+    diff = time.time() - start
+
+    for conn in idle:
+        net_util.kill_socket(conn)
+
+    lats = sorted(sum([x for (x, _) in results], []))
+    errors = sum([x for (_, x) in results])
+    print('{:>10}: {:8.0f} conn/s  p50 {:6.2f}ms  p99 {:7.2f}ms  p99.9 {:7.2f}ms'
+          '  errors {}  threads(idle={}) {}'.format(
+              name, len(lats) / diff, percentile(lats, 50) * 1000,
+              percentile(lats, 99) * 1000, percentile(lats, 99.9) * 1000, errors,
+              args.idle, server_threads))
+
+####
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, default=15500)
+parser.add_argument('--procs', type=int, default=4)
+parser.add_argument('--threads', type=int, default=16)
+parser.add_argument('--cycles', type=int, default=200)
+parser.add_argument('--idle', type=int, default=500)
+args = parser.parse_args()
+
+socket.setdefaulttimeout(10.0)
+
+threaded_addr = ('127.0.0.1', args.port)
+net_util.spawn_thread(net_util.serve_forever, (threaded_addr, accept_threaded))
+time.sleep(0.5)
+run('threaded', threaded_addr, args)
+
+loop_addr = ('127.0.0.1', args.port + 1)
+loop = net_util.EventLoop()
+loop.listen(loop_addr, accept_loop)
+net_util.spawn_thread(loop.run_forever, ())
+time.sleep(0.5)
+run('eventloop', loop_addr, args)
+
+# Skip tearing down the servers' daemon threads.
+sys.stdout.flush()
+os._exit(0)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+# Microbenchmark of Scheduler queue operations with many pending timeslots.
+#
+# Compares the original sorted-list PriorityQueue against sched_util's heap, then
+# times whole-Scheduler enqueue/cancel/dispatch at the same depth.
+from __future__ import print_function
+assert __name__ == '__main__'
+
+import argparse
+import bisect
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sched_util
+
+####
+
+class ListQueue:
+    # The pre-heap implementation.
+    def __init__(self):
+        self.list = []
+        return
+
+    def pop(self):
+        return self.list.pop(0)
+
+    def insert(self, elem):
+        bisect.insort_right(self.list, elem)
+
+    def remove(self, elem):
+        self.list.remove(elem)
+
+
+class Slot:
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.key = priority
+        self.seq = seq
+        self.is_queued = False
+
+    def __lt__(self, x):
+        return self.priority < x.priority
+
+####
+
+def bench_queue(name, queue, slots, cancel):
+    start = time.time()
+    for x in slots:
+        queue.insert(x)
+    t_insert = time.time() - start
+
+    start = time.time()
+    for x in cancel:
+        queue.remove(x)
+    t_remove = time.time() - start
+
+    start = time.time()
+    popped = 0
+    try:
+        while True:
+            queue.pop()
+            popped += 1
+    except IndexError:
+        pass
+    t_pop = time.time() - start
+
+    def us(t, n):
+        return t * 1000 * 1000 / max(n, 1)
+    print('{:>6}: insert {:7.2f}us  remove {:8.2f}us  pop {:7.2f}us  (per op, {} popped)'
+          .format(name, us(t_insert, len(slots)), us(t_remove, len(cancel)),
+                  us(t_pop, popped), popped))
+
+
+def bench_scheduler(count, priorities):
+    sched = sched_util.Scheduler(0, aging_rate=1.0)
+    slots = [sched.enqueue(random.choice(priorities), i) for i in range(count)]
+
+    start = time.time()
+    for x in slots:
+        x.__enter__()
+    t_enter = time.time() - start
+
+    # Cancel half while pending.
+    random.shuffle(slots)
+    half = count // 2
+    start = time.time()
+    for x in slots[:half]:
+        x.__exit__(None, None, None)
+    t_cancel = time.time() - start
+
+    # Dispatch the rest one slot at a time.
+    sched.max_slots = 1
+    start = time.time()
+    with sched.lock:
+        sched._process()
+    order = []
+    while sched.active:
+        cur = next(iter(sched.active))
+        order.append(cur.info)
+        cur.__exit__(None, None, None)
+    t_dispatch = time.time() - start
+
+    def us(t, n):
+        return t * 1000 * 1000 / max(n, 1)
+    print('Scheduler({} pending): enqueue {:.2f}us  cancel {:.2f}us  dispatch {:.2f}us'
+          .format(count, us(t_enter, count), us(t_cancel, half),
+                  us(t_dispatch, len(order))))
+
+####
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--count', type=int, default=10000)
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+random.seed(args.seed)
+
+PRIORITIES = [10, 100, 110, 120, 130]
+
+slots = [Slot(random.choice(PRIORITIES), i) for i in range(args.count)]
+cancel = random.sample(slots, args.count // 2)
+
+print('{} pending timeslots, {} cancelled:'.format(args.count, len(cancel)))
+bench_queue('list', ListQueue(), slots, cancel)
+bench_queue('heap', sched_util.PriorityQueue(), slots, cancel)
+
+bench_scheduler(args.count, PRIORITIES)
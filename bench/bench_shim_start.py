@@ -0,0 +1,100 @@
+#!/usr/bin/env python2
+# Measures end-to-end shim overhead against running the compiler directly.
+#
+# Starts a private ccerbd (HOME is pointed at a temp dir holding its .ccerb.ini),
+# using a stand-in compiler that does no work. Needs the default local ports free.
+from __future__ import print_function
+assert __name__ == '__main__'
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+NOOP_CC = '''#!{}
+import os, sys
+args = sys.argv[1:]
+if args == ['-v']:
+    sys.stderr.write('noop_cc 1.0\\n')
+    sys.exit(0)
+if '-E' in args:
+    sys.stdout.write('int x;\\n')
+    sys.exit(0)
+for x in args:
+    if x.startswith('-Fo'):
+        open(x[3:], 'wb').close()
+'''
+
+####
+
+def percentile(sorted_vals, p):
+    i = min(len(sorted_vals) - 1, int(len(sorted_vals) * p / 100.0))
+    return sorted_vals[i]
+
+
+def time_runs(name, args, env, cwd, count):
+    times = []
+    for _ in range(count):
+        start = time.time()
+        returncode = subprocess.call(args, env=env, cwd=cwd)
+        times.append(time.time() - start)
+        if returncode != 0:
+            print('{}: returncode {}'.format(name, returncode))
+    times.sort()
+    mean = sum(times) / len(times)
+    print('{:>24}: mean {:6.1f}ms  p50 {:6.1f}ms  p95 {:6.1f}ms'.format(
+          name, mean * 1000, percentile(times, 50) * 1000, percentile(times, 95) * 1000))
+    return mean
+
+####
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', type=int, default=30)
+parser.add_argument('--port', type=int, default=14306)
+args = parser.parse_args()
+
+home_dir = tempfile.mkdtemp(prefix='ccerb-bench-')
+try:
+    cc_path = os.path.join(home_dir, 'noop_cc')
+    with open(cc_path, 'wb') as f:
+        f.write(NOOP_CC.format(sys.executable))
+    os.chmod(cc_path, 0o755)
+
+    with open(os.path.join(home_dir, '.ccerb.ini'), 'wb') as f:
+        f.write('host_info=bench\nport={}\nresult_cache_mb=0\n'.format(args.port))
+        f.write('[bin]\n{}=\n[dedicated_remotes]\n'.format(cc_path))
+
+    with open(os.path.join(home_dir, 'foo.c'), 'wb') as f:
+        f.write('int x;\n')
+
+    env = dict(os.environ)
+    env['HOME'] = home_dir
+
+    daemon = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'ccerbd.py')],
+                              env=env, cwd=home_dir, stdout=open(os.devnull, 'wb'),
+                              stderr=subprocess.STDOUT)
+    try:
+        time.sleep(1.5)
+
+        shim = [sys.executable, os.path.join(ROOT_DIR, 'ccerb_shim.py')]
+        not_distributable = [cc_path, '-Fofoo.obj', 'foo.c'] # Not compile-only.
+        distributable = [cc_path, '-c', '-Fofoo.obj', 'foo.c']
+
+        direct = time_runs('direct', not_distributable, env, home_dir, args.n)
+        shim_out = time_runs('shim (not distributable)', shim + not_distributable, env,
+                             home_dir, args.n)
+        full = time_runs('shim (distributed)', shim + distributable, env, home_dir,
+                         args.n)
+
+        print('shim-out overhead: {:.1f}ms, distributed overhead: {:.1f}ms'.format(
+              (shim_out - direct) * 1000, (full - direct) * 1000))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+finally:
+    shutil.rmtree(home_dir)
@@ -1,13 +1,18 @@
 from __future__ import print_function
 assert __name__ != '__main__'
 
+import collections
+import marshal
 import os
 import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
 
+import chunk_util
+import codec_util
 import net_util
 
 ####
@@ -38,7 +43,7 @@ def v_log(v_level, fmt_str, *fmt_args):
 
 ####
 
-def get_job_key(job_bin):
+def _spawn_job_key(job_bin):
     args = [job_bin, '-v']
     try:
         p = subprocess.Popen(args, bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -49,53 +54,555 @@ def get_job_key(job_bin):
     (outdata, errdata) = p.communicate()
 
     job_key = errdata.splitlines()[0]
-    v_log(3, '<<get_job_key({}): {}>>', args, job_key)
+    v_log(3, '<<_spawn_job_key({}): {}>>', args, job_key)
+    return job_key
+
+####
+
+def write_file_atomic(path, data):
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.isdir(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            pass # Raced with another process.
+
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Windows won't rename over an existing file.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        os.rename(tmp_path, path)
+    return
+
+
+def hash_file(path):
+    import hashlib
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+####
+
+JOB_KEY_CACHE_DIR = os.path.expanduser('~/.ccerb/job_keys')
+JOB_KEY_HASH_CONTENT = False
+
+class JobKeyStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+        return
 
+
+    def record(self, was_hit, seconds):
+        with self.lock:
+            if was_hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.seconds += seconds
+        return
+
+
+    def summary(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            if not lookups:
+                return 'no lookups'
+            hit_rate = 100.0 * self.hits / lookups
+            avg_us = int(self.seconds * 1000 * 1000 / lookups)
+            return '{} lookups, {:.1f}% hits, avg {}us'.format(lookups, hit_rate, avg_us)
+
+job_key_stats = JobKeyStats()
+
+####
+
+def _job_key_signature(bin_path):
+    st = os.stat(bin_path)
+    sig = '{} {} {} {}'.format(st.st_size, st.st_mtime, st.st_ino, st.st_dev)
+    if JOB_KEY_HASH_CONTENT:
+        sig += ' ' + hash_file(bin_path)
+    return sig
+
+
+def _job_key_cache_path(bin_path):
+    import hashlib
+    name = hashlib.sha1(bin_path).hexdigest()
+    return os.path.join(JOB_KEY_CACHE_DIR, name)
+
+
+def _find_executable(name):
+    # As distutils.spawn.find_executable, without the cost of importing it.
+    if sys.platform == 'win32' and os.path.splitext(name)[1].lower() != '.exe':
+        name += '.exe'
+    if os.path.isfile(name):
+        return name
+    if os.path.dirname(name):
+        return None
+    for dir_path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(dir_path, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _lookup_job_key(job_bin):
+    # Returns (job_key, was_hit).
+    bin_path = _find_executable(job_bin)
+    if not bin_path:
+        return (_spawn_job_key(job_bin), False)
+    bin_path = os.path.abspath(bin_path)
+
+    sig = _job_key_signature(bin_path)
+    cache_path = _job_key_cache_path(bin_path)
+
+    # Entries are written atomically, so readers never need to lock.
+    try:
+        with open(cache_path, 'rb') as f:
+            (cached_path, cached_sig, job_key) = f.read().split('\n', 2)
+        if cached_path == bin_path and cached_sig == sig:
+            return (job_key, True)
+    except (IOError, ValueError):
+        pass
+
+    job_key = _spawn_job_key(job_bin)
+    try:
+        write_file_atomic(cache_path, '\n'.join([bin_path, sig, job_key]))
+    except (IOError, OSError) as e:
+        v_log(1, '<failed to cache job_key for {}: {}>', bin_path, e)
+    return (job_key, False)
+
+
+def get_job_key(job_bin):
+    start = time.time()
+    (job_key, was_hit) = _lookup_job_key(job_bin)
+    diff = time.time() - start
+    job_key_stats.record(was_hit, diff)
+
+    v_log(2, '<get_job_key({}): {} in {}us>', job_bin, 'hit' if was_hit else 'miss',
+          int(diff * 1000 * 1000))
+    v_log(3, '<<get_job_key({}): {}>>', job_bin, job_key)
     return job_key
 
 ####
 
-def read_files(root_dir):
+def list_files(root_dir):
     ret = []
     for cur_root, cur_dirs, cur_files in os.walk(root_dir):
         for x in cur_files:
             path = os.path.join(cur_root, x)
-            v_log(3, '<<read {}>>', path)
-            with open(path, 'rb') as f:
-                data = f.read()
-
             rel_path = os.path.relpath(path, root_dir)
-            ret.append((rel_path, data))
+            ret.append((rel_path, path))
     return ret
 
+####
 
-def write_files(root_dir, files):
-    for (file_rel_path, file_data) in files:
-        dir_name = os.path.dirname(file_rel_path)
-        if dir_name:
-            os.makedirs(dir_name)
-        file_path = os.path.join(root_dir, file_rel_path)
-        v_log(3, '<<write {}>>', file_path)
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
+COMPRESS_CODECS = None # Offered and accepted. None for all supported.
+
+def compress_codecs(names):
+    # Those of `names` (from config) installed here, in order.
+    supported = codec_util.supported_names()
+    unknown = [x for x in names if x not in supported]
+    if unknown:
+        v_log(1, '<compress: ignoring unknown or uninstalled {}>', ','.join(unknown))
+    return [x for x in names if x in supported]
+
+
+def _compress_codecs():
+    if COMPRESS_CODECS is None:
+        return codec_util.supported_names()
+    return COMPRESS_CODECS
+
+class Link:
+    def __init__(self, codec, version=1, hello=''):
+        self.codec = codec
+        self.version = version
+        self.hello = hello
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.chunks = None # Receiving: the peer's chunk_util.ChunkCache, if any.
+        self.chunked_bytes = 0
+        self.deduped_bytes = 0 # Of chunked_bytes, those the receiver already had.
+        return
+
+
+    def ratio_info(self):
+        if not self.raw_bytes:
+            info = '{}: -'.format(self.codec.name)
+        else:
+            info = '{}: {}/{} bytes ({:.1f}%)'.format(self.codec.name, self.wire_bytes,
+                                                     self.raw_bytes, 100.0 *
+                                                     self.wire_bytes / self.raw_bytes)
+        if self.chunked_bytes:
+            info += ', deduped {}/{} bytes ({:.1f}%)'.format(
+                self.deduped_bytes, self.chunked_bytes,
+                100.0 * self.deduped_bytes / self.chunked_bytes)
+        return info
+
+
+# v2 peers add this to their codec offer, which v1 servers ignore. v2 servers then
+# reply `codec\0PROTOCOL_V2\0hello` instead of just `codec`.
+PROTOCOL_V2 = 'ccerb2'
+# v3 adds declared outputs to jobs, and streams their stdout/stderr while they run.
+# Offered alongside PROTOCOL_V2, which v2 servers pick.
+PROTOCOL_V3 = 'ccerb3'
+# v4 takes a trace id ahead of any request, for the spans recorded serving it.
+PROTOCOL_V4 = 'ccerb4'
+# v5 takes 'pump' jobs: unpreprocessed sources and their headers (see PUMP_ROOT).
+PROTOCOL_V5 = 'ccerb5'
+# v6 takes job inputs as chunk manifests, and then only the chunks it lacks.
+PROTOCOL_V6 = 'ccerb6'
+PROTOCOL_VERSIONS = {PROTOCOL_V2: 2, PROTOCOL_V3: 3, PROTOCOL_V4: 4, PROTOCOL_V5: 5,
+                     PROTOCOL_V6: 6}
+
+# v1 servers first sent the local port's clients a pickled ccerbdd_addr. v2 sends
+# pickle.dumps(None) as a constant, so v1 shims still get through. v2 shims find
+# the address in the hello.
+LEGACY_LOCAL_HELLO = 'N.'
+
+def _link_versions():
+    # Those we take. Only v6 is all about dedup, so without DEDUP, neither side
+    # gets manifests.
+    return [x for x in PROTOCOL_VERSIONS if DEDUP or x != PROTOCOL_V6]
+
+
+def send_link_offer(conn, codec_names=None):
+    if codec_names is None:
+        codec_names = _compress_codecs()
+    versions = sorted(_link_versions(), key=lambda x: PROTOCOL_VERSIONS[x])
+    net_util.send_buffer(conn, '\0'.join(codec_names + versions))
+
+
+class ExBadHandshake(net_util.ExSocketClosed):
+    pass
+
+
+def recv_link_choice(conn):
+    reply = str(net_util.recv_buffer(conn)).split('\0')
+    net_util.IO_STATS.round_trips += 1
+    codec = codec_util.find(reply[0])
+    if not codec:
+        raise ExBadHandshake('unknown codec {!r}'.format(reply[0]))
+    if len(reply) == 3 and reply[1] in PROTOCOL_VERSIONS:
+        return Link(codec, PROTOCOL_VERSIONS[reply[1]], reply[2])
+    return Link(codec)
+
+
+def link_handshake_client(conn, codec_names=None):
+    send_link_offer(conn, codec_names)
+    return recv_link_choice(conn)
+
+
+def link_handshake_server(conn, hello=''):
+    offered = str(net_util.recv_buffer(conn)).split('\0')
+    codec = codec_util.choose([x for x in offered if x in _compress_codecs()])
+    versions = [x for x in offered if x in _link_versions()]
+    if not versions:
+        net_util.send_buffer(conn, codec.name)
+        return Link(codec)
+
+    marker = max(versions, key=lambda x: PROTOCOL_VERSIONS[x])
+    net_util.send_buffer(conn, '\0'.join([codec.name, marker, hello]))
+    return Link(codec, PROTOCOL_VERSIONS[marker], hello)
 
 ####
 
-def recv_files(conn):
+PAYLOAD_RAW = 0
+PAYLOAD_COMPRESSED = 1
+PAYLOAD_KEEPALIVE = 2 # v2 only: just the flag, between a file's payloads.
+PAYLOAD_CHUNKED = 3 # v6 only: instead of a file's payloads (see send_files).
+
+def send_payload(conn, link, data, frame=None):
+    # With a `frame`, the payload joins it, and only sends (along with the rest of
+    # the frame) once the frame reaches FRAME_JOIN_LIMIT.
+    is_own_frame = frame is None
+    if is_own_frame:
+        frame = net_util.Frame()
+
+    codec = link.codec
+    if not codec.tuner or len(data) < codec_util.MIN_COMPRESS_SIZE:
+        net_util.send_byte(frame, PAYLOAD_RAW)
+        net_util.send_buffer(frame, data)
+        if is_own_frame or frame.size >= net_util.FRAME_JOIN_LIMIT:
+            frame.send(conn)
+        link.raw_bytes += len(data)
+        link.wire_bytes += len(data)
+        return
+
+    level = codec.tuner.pick()
+    start = time.time()
+    comp_data = codec.compress(data, level)
+    comp_secs = time.time() - start
+
+    net_util.send_byte(frame, PAYLOAD_COMPRESSED)
+    net_util.send_buffer(frame, comp_data)
+    send_secs = None # Unknown until the frame goes out.
+    if is_own_frame or frame.size >= net_util.FRAME_JOIN_LIMIT:
+        frame.send(conn)
+        send_secs = time.time() - start - comp_secs
+
+    codec.tuner.record(level, len(data), len(comp_data), comp_secs, send_secs)
+    link.raw_bytes += len(data)
+    link.wire_bytes += len(comp_data)
+    return
+
+
+def recv_payload(conn, link):
+    flag = net_util.recv_byte(conn)
+    data = net_util.recv_buffer(conn)
+    if flag == PAYLOAD_COMPRESSED:
+        data = link.codec.decompress(bytes(data))
+    return data
+
+####
+
+# Each file is its name followed by payloads of at most FILE_CHUNK_SIZE raw bytes,
+# ending with an empty payload. Uncompressed files from disk go out as a single
+# payload via sendfile where available. A file still being written goes out as it
+# grows, with keepalives through any lull.
+
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# With `dedup`, files of at least DEDUP_MIN_SIZE going to a v6 peer are instead
+# PAYLOAD_CHUNKED and a chunk_util manifest. Once the receiver has all the files'
+# manifests, it replies with the ids of the chunks it lacks, each sent once,
+# in that order, as a payload.
+DEDUP = True
+DEDUP_MIN_SIZE = 64 * 1024
+
+def _send_end_of_file(conn):
+    net_util.send_byte(conn, PAYLOAD_RAW)
+    net_util.send_struct(conn, '<Q', 0)
+
+
+def _is_chunked(link, dedup, size):
+    return dedup and DEDUP and link.version >= 6 and size >= DEDUP_MIN_SIZE
+
+
+def _send_manifest(frame, data):
+    # Returns the chunks, for _send_missing_chunks().
+    chunks = chunk_util.split(data)
+    net_util.send_byte(frame, PAYLOAD_CHUNKED)
+    net_util.send_buffer(frame, chunk_util.pack_manifest(chunks))
+    return chunks
+
+
+def _send_missing_chunks(conn, link, chunks):
+    if not chunks:
+        return
+    data = net_util.recv_buffer(conn)
+    net_util.IO_STATS.round_trips += 1
+    by_id = dict(chunks)
+    frame = net_util.Frame()
+    sent_bytes = 0
+    for pos in range(0, len(data), chunk_util.ID_SIZE):
+        try:
+            chunk = by_id[str(data[pos:pos+chunk_util.ID_SIZE])]
+        except KeyError:
+            raise net_util.ExSocketClosed('peer asked for a chunk we didn\'t send')
+        send_payload(conn, link, chunk, frame)
+        sent_bytes += len(chunk)
+    frame.send(conn)
+
+    chunked_bytes = sum([len(x) for (_, x) in chunks])
+    link.chunked_bytes += chunked_bytes
+    link.deduped_bytes += chunked_bytes - sent_bytes
+    return
+
+
+# For both, `frame` may carry fields to go out ahead of the files.
+
+def send_files(conn, files, link, frame=None, dedup=False):
+    if frame is None:
+        frame = net_util.Frame()
+    net_util.send_struct(frame, '<Q', len(files))
+    chunks = []
+    for (name, data) in files:
+        net_util.send_buffer(frame, name)
+        if _is_chunked(link, dedup, len(data)):
+            chunks += _send_manifest(frame, data)
+            continue
+        if data:
+            if link.codec.tuner:
+                for pos in range(0, len(data), FILE_CHUNK_SIZE):
+                    send_payload(conn, link, data[pos:pos+FILE_CHUNK_SIZE], frame)
+            else:
+                send_payload(conn, link, data, frame)
+        _send_end_of_file(frame)
+    frame.send(conn)
+    _send_missing_chunks(conn, link, chunks)
+
+
+def send_file_paths(conn, files, link, frame=None, dedup=False):
+    if frame is None:
+        frame = net_util.Frame()
+    net_util.send_struct(frame, '<Q', len(files))
+    buf = None
+    chunks = []
+    for (name, path) in files:
+        v_log(3, '<<send {}>>', path)
+        net_util.send_buffer(frame, name)
+        with open(path, 'rb') as f:
+            if _is_chunked(link, dedup, os.fstat(f.fileno()).st_size):
+                chunks += _send_manifest(frame, f.read())
+                continue
+            if link.codec.tuner:
+                while True:
+                    data = f.read(FILE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    send_payload(conn, link, data, frame)
+            else:
+                size = os.fstat(f.fileno()).st_size
+                if size:
+                    if buf is None:
+                        buf = bytearray(FILE_CHUNK_SIZE)
+                    net_util.send_byte(frame, PAYLOAD_RAW)
+                    net_util.send_struct(frame, '<Q', size)
+                    frame.send(conn)
+                    net_util.send_file(conn, f, size, buf)
+                    link.raw_bytes += size
+                    link.wire_bytes += size
+        _send_end_of_file(frame)
+    frame.send(conn)
+    _send_missing_chunks(conn, link, chunks)
+
+
+def send_file_stream(conn, name, read, link, frame=None):
+    # Sends a single file. `read(timeout)` returns the file's next data, '' if none
+    # came within `timeout`, or None at its end.
+    assert link.version >= 2
+    if frame is None:
+        frame = net_util.Frame()
+    net_util.send_struct(frame, '<Q', 1)
+    net_util.send_buffer(frame, name)
+    frame.send(conn)
+
+    # The receiver would time out waiting for a slow writer.
+    keepalive_interval = conn.gettimeout() * 0.5
+    while True:
+        data = read(keepalive_interval)
+        if data is None:
+            break
+        if not data:
+            net_util.send_byte(conn, PAYLOAD_KEEPALIVE)
+            continue
+        for pos in range(0, len(data), FILE_CHUNK_SIZE):
+            send_payload(conn, link, data[pos:pos+FILE_CHUNK_SIZE])
+    _send_end_of_file(frame)
+    frame.send(conn)
+
+
+class ExTooLarge(Exception):
+    pass
+
+
+class ExBadChunk(Exception):
+    pass
+
+
+def _recv_missing_chunks(conn, link, chunked):
+    # For [(file_path, manifest)]: asks for the chunks link.chunks lacks, and writes
+    # out the files.
+    have = dict()
+    missing = []
+    for (_, manifest) in chunked:
+        for (chunk_id, _) in manifest:
+            if chunk_id in have:
+                continue
+            chunk = link.chunks and link.chunks.get(chunk_id)
+            have[chunk_id] = chunk
+            if chunk is None:
+                missing.append(chunk_id)
+    net_util.send_buffer(conn, ''.join(missing))
+
+    for chunk_id in missing:
+        chunk = str(recv_payload(conn, link))
+        if not chunk_util.is_valid(chunk_id, chunk):
+            raise ExBadChunk('chunk doesn\'t match its id')
+        have[chunk_id] = chunk
+        if link.chunks:
+            link.chunks.put(chunk_id, chunk)
+
+    for (file_path, manifest) in chunked:
+        with open(file_path, 'wb') as f:
+            for (chunk_id, _) in manifest:
+                f.write(have[chunk_id])
+
+    chunked_bytes = sum([sum([x for (_, x) in y]) for (_, y) in chunked])
+    missing_bytes = sum([len(have[x]) for x in missing])
+    link.chunked_bytes += chunked_bytes
+    link.deduped_bytes += chunked_bytes - missing_bytes
+    return
+
+
+def recv_files_to_dir(conn, root_dir, link, max_bytes=0):
+    # Raises ExTooLarge once the files pass `max_bytes` in total, if set.
     file_count = net_util.recv_struct(conn, '<Q')
-    files = []
+    names = []
+    chunked = [] # [(file_path, manifest)]
+    total_bytes = 0
+    buf = bytearray(FILE_CHUNK_SIZE)
     for _ in range(file_count):
         name = unicode(net_util.recv_buffer(conn))
-        data = net_util.recv_buffer(conn)
-        files.append((name, data))
-    return files
+        file_path = os.path.join(root_dir, name)
+        dir_name = os.path.dirname(file_path)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
 
+        v_log(3, '<<write {}>>', file_path)
+        flag = net_util.recv_byte(conn)
+        if flag == PAYLOAD_CHUNKED:
+            manifest = chunk_util.unpack_manifest(str(net_util.recv_buffer(conn)))
+            total_bytes += sum([x for (_, x) in manifest])
+            if max_bytes and total_bytes > max_bytes:
+                raise ExTooLarge('{} exceeds {} bytes'.format(file_path, max_bytes))
+            chunked.append((file_path, manifest))
+            names.append(name)
+            continue
 
-def send_files(conn, files):
-    net_util.send_struct(conn, '<Q', len(files))
-    for (name, data) in files:
-        net_util.send_buffer(conn, name)
-        net_util.send_buffer(conn, data)
+        with open(file_path, 'wb') as f:
+            while True:
+                if flag is None:
+                    flag = net_util.recv_byte(conn)
+                if flag == PAYLOAD_KEEPALIVE:
+                    flag = None
+                    continue
+                size = net_util.recv_struct(conn, '<Q')
+                if not size:
+                    break
+                if flag == PAYLOAD_COMPRESSED:
+                    # Senders never compress more than FILE_CHUNK_SIZE at a time.
+                    data = net_util.recv_n(conn, size)
+                    data = link.codec.decompress(bytes(data))
+                    size = len(data)
+                total_bytes += size
+                if max_bytes and total_bytes > max_bytes:
+                    raise ExTooLarge('{} exceeds {} bytes'.format(file_path, max_bytes))
+                if flag == PAYLOAD_COMPRESSED:
+                    f.write(data)
+                else:
+                    net_util.recv_into_file(conn, f, size, buf)
+                flag = None
+        names.append(name)
+
+    if chunked:
+        _recv_missing_chunks(conn, link, chunked)
+    return names
 
 ####
 
@@ -142,6 +649,30 @@ def parse_ini(path):
             continue
     return headings
 
+
+CONFIG_CACHE_PATH = os.path.expanduser('~/.ccerb/config.cache')
+
+def load_config(path):
+    # parse_ini(path), memoized on disk as marshal data keyed by the ini's stat, so
+    # short-lived shims skip re-parsing it.
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    try:
+        with open(CONFIG_CACHE_PATH, 'rb') as f:
+            (cached_key, headings) = marshal.load(f)
+        if cached_key == key:
+            return headings
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    headings = parse_ini(path)
+    try:
+        write_file_atomic(CONFIG_CACHE_PATH, marshal.dumps((key, headings)))
+    except (IOError, OSError) as e:
+        v_log(1, '<failed to cache config: {}>', e)
+    return headings
+
 ####
 
 ALLOW_NICE_DOWN = False
@@ -159,13 +690,385 @@ def nice_down():
 
 ####
 
-def acquire_remote_job(conn, job_key, priority):
-    net_util.send_buffer(conn, job_key)
-    net_util.send_byte(conn, priority)
+# Server states, sent after heartbeat 0s:
+JOB_READY = 1
+JOB_CACHED = 2
+JOB_CANCELLED = 3
+# v5 only: refuses a 'pump' request, from a server without a header store. The
+# connection takes other requests after.
+JOB_NO_PUMP = 4
+
+# Client replies to JOB_READY/JOB_CACHED, or sent while still waiting:
+JOB_START = 1
+JOB_CANCEL = 2
+
+def send_trace_id(conn, trace_id):
+    # v4 only: applies to the next request.
+    net_util.send_buffer(conn, 'trace')
+    net_util.send_buffer(conn, trace_id)
+
+
+def send_job_request(conn, job_key, priority, digest='', trace_id=None, is_pump=False):
+    # v5 only, with `is_pump`: the job is run_pump_job_client's.
+    frame = net_util.Frame()
+    if trace_id:
+        send_trace_id(frame, trace_id)
+    if is_pump:
+        net_util.send_buffer(frame, 'pump')
+    net_util.send_buffer(frame, job_key)
+    net_util.send_byte(frame, priority)
+    net_util.send_buffer(frame, digest)
+    frame.send(conn)
+
+
+def recv_job_state(conn):
+    net_util.IO_STATS.round_trips += 1
+    while True:
+        state = net_util.recv_byte(conn)
+        if state != 0:
+            return state
+
+
+def acquire_remote_job(conn, job_key, priority, digest='', trace_id=None,
+                       is_pump=False):
+    # Returns JOB_READY/JOB_CACHED, which must be answered by start_remote_job() or
+    # cancel_remote_job(), or JOB_CANCELLED, or JOB_NO_PUMP if `is_pump`.
+    send_job_request(conn, job_key, priority, digest, trace_id, is_pump)
+    return recv_job_state(conn)
+
 
-    while net_util.recv_byte(conn) == 0:
+# Reply to a 'forward' request, after its beacon:
+FORWARD_FAILED = 0
+FORWARD_OK = 1
+
+# Reply to a 'mux' request, after which the connection is a mux_util.MuxSession.
+MUX_OK = 1
+
+def start_remote_job(conn):
+    net_util.send_byte(conn, JOB_START)
+
+
+def acquire_and_start_remote_job(conn, job_key, priority):
+    state = acquire_remote_job(conn, job_key, priority)
+    assert state == JOB_READY
+    start_remote_job(conn)
+
+
+def cancel_remote_job(conn):
+    # Only for a job that isn't waiting in acquire_remote_job on another thread.
+    net_util.send_byte(conn, JOB_CANCEL)
+    while net_util.recv_byte(conn) != JOB_CANCELLED:
         continue
 
+
+def send_shim_out(conn, reason):
+    # v3 only: tells the local ccerbd why a shim compiled on its own, for its
+    # metrics. Nothing comes back.
+    frame = net_util.Frame()
+    net_util.send_buffer(frame, 'shim_out')
+    net_util.send_buffer(frame, reason)
+    frame.send(conn)
+
+####
+
+# Between a v3 job's heartbeat 0s, ahead of its final 1, each followed by a payload:
+JOB_STDOUT = 2
+JOB_STDERR = 3
+
+def send_job_args(conn, link, job_args, output_names):
+    # v3 peers also get the job's declared outputs, if known, so they needn't look.
+    net_util.send_buffer(conn, '\0'.join(job_args))
+    if link.version >= 3:
+        net_util.send_buffer(conn, '\0'.join(output_names or []))
+
+
+def recv_job_args(conn, link):
+    # Returns (job_args, output_names), with output_names None if not declared.
+    job_args = str(net_util.recv_buffer(conn)).split('\0')
+    output_names = None
+    if link.version >= 3:
+        output_names = str(net_util.recv_buffer(conn)).split('\0')
+        if output_names == ['']:
+            output_names = None
+    return (job_args, output_names)
+
+
+def send_job_output(conn, link, tag, data):
+    frame = net_util.Frame()
+    net_util.send_byte(frame, tag)
+    send_payload(conn, link, data, frame)
+    frame.send(conn)
+
+
+def recv_job_output(conn, link, on_output):
+    # Waits out a job's beacon, passing any output to on_output(tag, data).
+    assert conn.gettimeout() != None
+    while True:
+        tag = net_util.recv_byte(conn)
+        if tag == 0:
+            continue
+        if tag not in (JOB_STDOUT, JOB_STDERR):
+            return
+        on_output(tag, str(recv_payload(conn, link)))
+
+####
+
+# A pump job ships the source and the headers it may include, by content hash,
+# instead of the preprocessor's output. The remote lays them out under PUMP_ROOT in
+# its workspace, at pump_name() of their paths, and preprocesses there. Paths in
+# the preprocessor's args are pump_name()s after PUMP_PATH_MARK, which the remote
+# replaces with PUMP_ROOT's path.
+#
+# After the job args: the source's name for the compile, the preprocessor args,
+# and the manifest, [(pump_name, sha1)]. The remote replies with the hashes it
+# lacks, which then go out as files named by their hash. After the job's beacon,
+# the remote sends PUMP_OK or PUMP_FAILED, the preprocessor's stderr, and, if
+# PUMP_OK, the job's result. A remote's preprocessor can fail for want of a header
+# find_headers missed, so PUMP_FAILED leaves the compile to the client.
+
+PUMP_ROOT = 'pump'
+PUMP_PATH_MARK = '\x01'
+
+PUMP_FAILED = 0
+PUMP_OK = 1
+
+def pump_name(path):
+    # '/usr/x.h' -> '_/usr/x.h', 'c:\dev\x.h' -> 'c_/dev/x.h'
+    path = os.path.abspath(path).replace('\\', '/')
+    (drive, sep, rest) = path.partition(':')
+    if sep and len(drive) == 1:
+        return drive.lower() + '_' + rest
+    return '_' + path
+
+
+def send_pump_job(conn, link, job_args, output_names, source_name, preproc_args,
+                  manifest, frame=None):
+    if frame is None:
+        frame = net_util.Frame()
+    send_job_args(frame, link, job_args, output_names)
+    net_util.send_buffer(frame, source_name)
+    net_util.send_buffer(frame, '\0'.join(preproc_args))
+    net_util.send_struct(frame, '<Q', len(manifest))
+    for (name, sha1) in manifest:
+        net_util.send_buffer(frame, name)
+        net_util.send_buffer(frame, sha1)
+    frame.send(conn)
+
+
+def recv_pump_job(conn, link):
+    # Returns (job_args, output_names, source_name, preproc_args, manifest).
+    (job_args, output_names) = recv_job_args(conn, link)
+    source_name = str(net_util.recv_buffer(conn))
+    preproc_args = str(net_util.recv_buffer(conn)).split('\0')
+    manifest = []
+    for _ in range(net_util.recv_struct(conn, '<Q')):
+        name = unicode(net_util.recv_buffer(conn))
+        sha1 = str(net_util.recv_buffer(conn))
+        manifest.append((name, sha1))
+    return (job_args, output_names, source_name, preproc_args, manifest)
+
+
+def send_hashes(conn, hashes):
+    net_util.send_buffer(conn, '\0'.join(hashes))
+
+
+def recv_hashes(conn):
+    data = str(net_util.recv_buffer(conn))
+    if not data:
+        return []
+    return data.split('\0')
+
+
+def pump_digest(job_key, job_args, preproc_args, manifest):
+    # A job_digest for a pump job, which either side can tell before preprocessing.
+    d = _JobDigest(job_key, job_args + [PUMP_ROOT] + preproc_args)
+    for (name, sha1) in manifest:
+        d.update(name)
+        d.update(sha1)
+    return d.h.hexdigest()
+
+####
+
+def _ccerbd_connect(addr, host_info, frame):
+    conn = socket.create_connection(addr)
+    net_util.set_nodelay(conn)
+    hello = net_util.Frame()
+    net_util.send_buffer(hello, host_info)
+    send_link_offer(hello)
+    frame.send(hello)
+    hello.send(conn)
+    return conn
+
+
+def ccerbd_connect(addr, host_info):
+    conn = _ccerbd_connect(addr, host_info, net_util.Frame())
+    link = recv_link_choice(conn)
+    return (conn, link)
+
+
+def ccerbd_connect_status(addr, host_info, job_key):
+    # Returns (conn, link, status), with the status query sent along with the
+    # handshake.
+    frame = net_util.Frame()
+    send_status_query(frame, job_key)
+    conn = _ccerbd_connect(addr, host_info, frame)
+    link = recv_link_choice(conn)
+    status = recv_status(conn)
+    net_util.IO_STATS.pipelined += 1
+    return (conn, link, status)
+
+
+def ccerbd_connect_mux(addr, host_info):
+    # Returns (conn, link), with conn ready for a mux_util.MuxSession, or None if the
+    # remote predates 'mux'.
+    frame = net_util.Frame()
+    net_util.send_buffer(frame, 'mux')
+    conn = _ccerbd_connect(addr, host_info, frame)
+    try:
+        link = recv_link_choice(conn)
+        net_util.recv_byte(conn) # MUX_OK
+    except net_util.ExSocketClosed:
+        net_util.kill_socket(conn) # It hung up on the unknown job_key.
+        return None
+    net_util.IO_STATS.pipelined += 1
+    return (conn, link)
+
+
+def parse_remote_addrs(section):
+    # From a [dedicated_remotes] section of `host=port` lines.
+    ret = []
+    for (host, port) in section.viewitems():
+        if not port:
+            (_, port) = CCERBD_LOCAL_ADDR
+        ret.append((host, int(port)))
+    return ret
+
+####
+
+RemoteStatus = collections.namedtuple('RemoteStatus',
+                                      'has_job_key, free_slots, max_slots, pending, speed')
+STATUS_FORMAT = '<?IIIf'
+
+def send_status(conn, status):
+    conn.sendall(struct.pack(STATUS_FORMAT, *status))
+
+
+def recv_status(conn):
+    data = net_util.recv_n(conn, struct.calcsize(STATUS_FORMAT))
+    return RemoteStatus(*struct.unpack(STATUS_FORMAT, bytes(data)))
+
+
+def send_status_query(conn, job_key):
+    frame = net_util.Frame()
+    net_util.send_buffer(frame, 'status')
+    net_util.send_buffer(frame, job_key)
+    frame.send(conn)
+
+
+def query_status(conn, job_key):
+    send_status_query(conn, job_key)
+    net_util.IO_STATS.round_trips += 1
+    return recv_status(conn)
+
+
+def status_score(status):
+    # Estimated queueing per unit of capacity. Lower is better.
+    if not status.has_job_key or not status.max_slots:
+        return float('inf')
+    backlog = status.pending + 1 - status.free_slots
+    return backlog / (status.max_slots * max(status.speed, 0.01))
+
+####
+
+# ccerbdd, the directory of workers (ccerbds).
+CCERBDD_PORT = 14307
+
+DIRECTORY_WORKER = 'worker'
+DIRECTORY_CLIENT = 'client'
+
+def parse_directory_addr(text):
+    # `host` or `host:port`
+    (host, sep, port) = text.partition(':')
+    if not sep:
+        return (host, CCERBDD_PORT)
+    return (host, int(port))
+
+
+def directory_connect(addr, role):
+    conn = socket.create_connection(addr)
+    net_util.set_nodelay(conn)
+    net_util.send_buffer(conn, role)
+    return conn
+
+
+def register_worker(conn, host, port, job_keys):
+    # Followed by a send_status() whenever the worker's load changes.
+    frame = net_util.Frame()
+    net_util.send_buffer(frame, host)
+    net_util.send_struct(frame, '<H', port)
+    net_util.send_buffer(frame, '\0'.join(job_keys))
+    frame.send(conn)
+
+
+def query_directory(conn, job_key, count):
+    # Returns up to `count` [(addr, RemoteStatus)], best first. The directory counts
+    # each returned worker as one job busier until it hears otherwise.
+    frame = net_util.Frame()
+    net_util.send_buffer(frame, job_key)
+    net_util.send_byte(frame, count)
+    frame.send(conn)
+    net_util.IO_STATS.round_trips += 1
+    ret = []
+    for _ in range(net_util.recv_byte(conn)):
+        host = str(net_util.recv_buffer(conn))
+        port = net_util.recv_struct(conn, '<H')
+        ret.append(((host, port), recv_status(conn)))
+    return ret
+
+####
+
+class _JobDigest:
+    def __init__(self, job_key, job_args):
+        import hashlib
+        self.h = hashlib.sha1()
+        self.update(job_key)
+        self.update('\0'.join(job_args))
+        return
+
+
+    def update(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.h.update(struct.pack('<Q', len(data)))
+        self.h.update(data)
+
+
+    def update_from_file(self, path):
+        self.h.update(struct.pack('<Q', os.path.getsize(path)))
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(FILE_CHUNK_SIZE)
+                if not data:
+                    break
+                self.h.update(data)
+
+
+def job_digest(job_key, job_args, input_files):
+    d = _JobDigest(job_key, job_args)
+    for (name, data) in input_files:
+        d.update(name)
+        d.update(data)
+    return d.h.hexdigest()
+
+
+def job_digest_dir(job_key, job_args, root_dir, input_names):
+    # Same as job_digest, for inputs already written under root_dir.
+    d = _JobDigest(job_key, job_args)
+    for name in input_names:
+        d.update(name)
+        d.update_from_file(os.path.join(root_dir, name))
+    return d.h.hexdigest()
+
 ####
 
 class Future:
@@ -206,7 +1109,7 @@ class Future:
         try:
             return self.val[0]
         except IndexError:
-            raise Rejection()
+            raise Future.Rejection()
 
 ####
 
@@ -0,0 +1,24 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+assert __name__ == '__main__'
+
+import datetime
+import sys
+
+import log_util
+
+####################
+
+# Usage: ccerb_log.py LOG_PATH
+#
+# Prints a ccerbd log_file written with log_binary=1, as text.
+
+if len(sys.argv) != 2:
+    print('Usage: ccerb_log.py LOG_PATH', file=sys.stderr)
+    exit(1)
+
+with open(sys.argv[1], 'rb') as f:
+    for (t, source, line) in log_util.read_binary_log(f):
+        when = datetime.datetime.fromtimestamp(t).strftime('%H:%M:%S.%f')
+        text = u'{} {} {}'.format(when, source or '-', line)
+        print(text.encode('utf-8'))
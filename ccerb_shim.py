@@ -2,15 +2,10 @@
 from __future__ import print_function
 assert __name__ == '__main__'
 
+# Only what process_args needs is imported up front: commands we can't distribute
+# shim out before loading the config or anything else.
 import os
-import socket
-import subprocess
 import sys
-import threading
-import time
-
-import ccerb
-import net_util
 
 ####################
 
@@ -22,14 +17,6 @@ REMOTE_COMPILE_PRIORITY=130
 
 ####################
 
-CONFIG = ccerb.parse_ini(ccerb.CONFIG_PATH)
-assert 'dedicated_remotes' in CONFIG
-
-HOST_INFO = CONFIG[None]['host_info']
-NO_LOCAL = int(CONFIG[None].get('no_local', 0))
-
-####################
-
 class ExShimOut(Exception):
     def __init__(self, reason):
         self.reason = reason
@@ -39,6 +26,8 @@ class ExShimOut(Exception):
 
 SOURCE_EXTS = ['c', 'cc', 'cpp']
 BOTH_ARGS = ['nologo', '-Tc', '-TC', '-Tp', '-TP']
+# Write files we don't name for the remote, which then has to look for its outputs.
+UNDECLARED_OUTPUT_ARGS = ['-FA', '-Fa', '-Fm', '-Fp', '-FR', '-Fr', '-doc']
 
 def process_args(args):
     args = args[:]
@@ -47,6 +36,10 @@ def process_args(args):
 
     source_file_name = None
     is_compile_only = False
+    obj_name = None
+    pdb_name = None
+    has_pdb = False
+    has_undeclared_outputs = False
 
     preproc = ['-E']
     compile = ['-c']
@@ -98,6 +91,24 @@ def process_args(args):
         if cur.startswith('-Fo'):
             if os.path.dirname(cur[2:]):
                 raise ExShimOut('-Fo target is a path')
+            obj_name = cur[3:]
+            compile.append(cur)
+            continue
+
+        if cur.startswith('-Fd'):
+            if os.path.dirname(cur[3:]):
+                raise ExShimOut('-Fd target is a path')
+            pdb_name = cur[3:]
+            compile.append(cur)
+            continue
+
+        if cur in ('-Zi', '-ZI'):
+            has_pdb = True
+            compile.append(cur)
+            continue
+
+        if any([cur.startswith(x) for x in UNDECLARED_OUTPUT_ARGS]):
+            has_undeclared_outputs = True
             compile.append(cur)
             continue
 
@@ -122,46 +133,312 @@ def process_args(args):
     if not source_file_name:
         raise ExShimOut('no source file')
 
-    return (preproc, compile, source_file_name)
+    # None if we can't tell.
+    output_names = None
+    if not has_undeclared_outputs and (pdb_name or not has_pdb):
+        if not obj_name:
+            obj_name = source_file_name.rsplit('.', 1)[0] + '.obj'
+        elif '.' not in obj_name:
+            obj_name += '.obj'
+        output_names = [obj_name]
+        if has_pdb:
+            if '.' not in pdb_name:
+                pdb_name += '.pdb'
+            output_names.append(pdb_name)
+
+    return (preproc, compile, source_file_name, output_names)
+
+
+def pump_inputs(preproc_args):
+    # Returns (preproc_args, manifest, {sha1: path}) for a pump job (see
+    # ccerb.PUMP_ROOT), or raises include_util.ExUnpumpable.
+    def mark(path):
+        return ccerb.PUMP_PATH_MARK + ccerb.pump_name(path)
+
+    args = []
+    include_dirs = []
+    paths = [] # Forced includes, then the source.
+    source = None
+    pending = list(preproc_args)
+    while pending:
+        cur = pending.pop(0)
+        if cur in ('-I', '-FI'):
+            path = pending.pop(0)
+            (include_dirs if cur == '-I' else paths).append(path)
+            args += [cur, mark(path)]
+            continue
+        if cur.startswith('-I'):
+            include_dirs.append(cur[2:])
+            args.append('-I' + mark(cur[2:]))
+            continue
+        split = cur.rsplit('.', 1)
+        if not cur.startswith('-') and len(split) == 2 and split[1].lower() in SOURCE_EXTS:
+            source = cur
+            args.append(mark(cur))
+            continue
+        args.append(cur)
+        continue
 
-####
+    found = include_util.find_headers([source] + paths, include_dirs)
+    manifest = sorted([(ccerb.pump_name(x), sha1) for (x, sha1) in found.items()])
+    files = dict([(sha1, x) for (x, sha1) in found.items()])
+    return (args, manifest, files)
+
+
+def source_path(preproc_args):
+    for x in preproc_args:
+        split = x.rsplit('.', 1)
+        if not x.startswith('-') and len(split) == 2 and split[1].lower() in SOURCE_EXTS:
+            return x
+    return None
+
+####################
 
-def run_remote_job_client(conn, job_args, input_files):
-    job_args = '\0'.join(job_args)
-    net_util.send_buffer(conn, job_args)
+# sys.argv: [ccerb.py, cl, foo.c]
 
-    ccerb.send_files(conn, input_files)
+args = sys.argv[1:]
 
-    net_util.wait_on_beacon(conn)
+shim_out_reason = None
+try:
+    if not args:
+        raise ExShimOut('no args')
+    (preproc_args, compile_args, source_file_name,
+     output_names) = process_args(args[1:])
+except ExShimOut as e:
+    shim_out_reason = e.reason
 
+####################
+
+import socket
+import subprocess
+import threading
+import time
+
+import ccerb
+import include_util
+import log_util
+import net_util
+import preproc_cache
+import trace_util
+
+SHIM_START = time.time()
+# Replaced once we have the config, which may have a trace_dir.
+TRACER = trace_util.Tracer(None, None, 'ccerb_shim')
+
+def trace_id_for(link):
+    if link.version < 4:
+        return None
+    return TRACER.current()
+
+####
+
+def write_job_output(tag, data):
+    f = sys.stdout if tag == ccerb.JOB_STDOUT else sys.stderr
+    f.write(data)
+    f.flush()
+
+
+def run_remote_job_client(conn, link, job_state, job_args, input_files, dedup=False):
+    if job_state == ccerb.JOB_CACHED:
+        ccerb.start_remote_job(conn)
+    else:
+        frame = net_util.Frame()
+        ccerb.start_remote_job(frame)
+        ccerb.send_job_args(frame, link, job_args, output_names)
+        ccerb.send_files(conn, input_files, link, frame, dedup)
+
+        ccerb.recv_job_output(conn, link, write_job_output)
+
+    return recv_job_result(conn, link)
+
+
+def run_pump_job_client(conn, link, job_state, job_args, pump):
+    # Returns (returncode, the remote preprocessor's stderr).
+    if job_state == ccerb.JOB_CACHED:
+        ccerb.start_remote_job(conn)
+        return (recv_job_result(conn, link), '')
+
+    (pump_args, manifest, files) = pump
+    frame = net_util.Frame()
+    ccerb.start_remote_job(frame)
+    ccerb.send_pump_job(conn, link, job_args, output_names, source_file_name, pump_args,
+                        manifest, frame)
+    missing = ccerb.recv_hashes(conn)
+    net_util.IO_STATS.round_trips += 1
+    ccerb.v_log(2, '<pump: {} of {} files sent>', len(missing), len(manifest))
+    ccerb.send_file_paths(conn, [(x, files[x]) for x in missing], link)
+
+    ccerb.recv_job_output(conn, link, write_job_output)
+    status = net_util.recv_byte(conn)
+    preproc_err = str(ccerb.recv_payload(conn, link))
+    if status != ccerb.PUMP_OK:
+        # Maybe only a header we didn't ship: let the local compiler say.
+        ccerb.v_log(2, '<<pump preproc stderr: {}>>', preproc_err)
+        raise ExShimOut('pump preproc failed')
+    return (recv_job_result(conn, link), preproc_err)
+
+
+def run_streamed_job_client(conn, link, job_args, file_name, stream):
+    # Only for JOB_READY on a v2 link.
+    frame = net_util.Frame()
+    ccerb.start_remote_job(frame)
+    ccerb.send_job_args(frame, link, job_args, output_names)
+    ccerb.send_file_stream(conn, file_name, stream.read, link, frame)
+
+    ccerb.recv_job_output(conn, link, write_job_output)
+    return recv_job_result(conn, link)
+
+
+def run_forwarded_job(conn, link, job_key, digest, job_args, input_files):
+    # The local ccerbd picks a remote and relays over its pooled connections.
+    frame = net_util.Frame()
+    trace_id = trace_id_for(link)
+    if trace_id:
+        ccerb.send_trace_id(frame, trace_id)
+    net_util.send_buffer(frame, 'forward')
+    net_util.send_buffer(frame, job_key)
+    net_util.send_byte(frame, 0 if NO_LOCAL else LOCAL_COMPILE_PRIORITY)
+    net_util.send_byte(frame, DEDICATED_COMPILE_PRIORITY)
+    net_util.send_buffer(frame, digest)
+    ccerb.send_job_args(frame, link, job_args, output_names)
+    ccerb.send_files(conn, input_files, link, frame)
+
+    ccerb.recv_job_output(conn, link, write_job_output)
+    if net_util.recv_byte(conn) != ccerb.FORWARD_OK:
+        raise ExShimOut('forward failed')
+    return recv_job_result(conn, link)
+
+
+def recv_job_result(conn, link):
     returncode = net_util.recv_struct(conn, '<i')
-    outdata = net_util.recv_buffer(conn)
-    errdata = net_util.recv_buffer(conn)
+    net_util.IO_STATS.round_trips += 1
+    outdata = ccerb.recv_payload(conn, link)
+    errdata = ccerb.recv_payload(conn, link)
 
     sys.stderr.write(errdata)
     #ccerb.v_log(1, 'errdata: {}', errdata)
     sys.stdout.write(outdata)
     #ccerb.v_log(1, 'outdata: {}', outdata)
 
-    output_files = ccerb.recv_files(conn)
-
-    ccerb.write_files('', output_files)
+    ccerb.recv_files_to_dir(conn, '', link)
     return returncode
 
 ####
 
+def preproc_errors(errdata):
+    # Without the -showIncludes notes, if only PREPROC_CACHE asked for them.
+    if run_preproc_args is preproc_args:
+        return errdata
+    return PREPROC_CACHE.without_notes(errdata)
+
+
 def preproc(cc_bin, preproc_args):
     preproc_args = [cc_bin] + preproc_args
     p = subprocess.Popen(preproc_args, bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
 
     (outdata, errdata) = p.communicate()
     if p.returncode != 0:
-        sys.stderr.write(errdata)
+        sys.stderr.write(preproc_errors(errdata))
         sys.stdout.write(outdata)
-        exit(p.returncode)
+        exit_now(p.returncode)
 
     return (outdata, errdata)
 
+
+STREAM_READ_SIZE = 64 * 1024
+
+class PreprocStream:
+    # Runs the preprocessor with its output read on a thread, as raw bytes, so it can
+    # go out while the preprocessor is still running. `beacon` holds our local
+    # preproc slot until the preprocessor exits, however far sending has got.
+    def __init__(self, cc_bin, preproc_args, beacon):
+        self.p = subprocess.Popen([cc_bin] + preproc_args, bufsize=-1,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.beacon = beacon
+        self.cond = threading.Condition(threading.Lock())
+        self.parts = []
+        self.read_pos = 0 # Parts already returned by read().
+        self.is_eof = False
+        self.errdata = ''
+
+        self.threads = []
+        for target in (self._read_stdout, self._read_stderr):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return
+
+
+    def _read_stdout(self):
+        fd = self.p.stdout.fileno()
+        while True:
+            data = os.read(fd, STREAM_READ_SIZE)
+            if not data:
+                break
+            with self.cond:
+                self.parts.append(data)
+                self.cond.notify()
+
+        # Give up the preproc slot now, not once the output has gone out.
+        self.p.wait()
+        try:
+            self.beacon.signal()
+        except net_util.ExSocketClosed:
+            pass # The main thread finds out when it next uses the connection.
+        with self.cond:
+            self.is_eof = True
+            self.cond.notify()
+        return
+
+
+    def _read_stderr(self):
+        # What universal_newlines would have given us.
+        self.errdata = self.p.stderr.read().replace('\r\n', '\n')
+
+
+    def read(self, timeout):
+        # Returns the output since the last read(), waiting up to `timeout` for some:
+        # '' if none came, or None once it's all been read. Exits like preproc() if
+        # the preprocessor failed.
+        with self.cond:
+            if self.read_pos == len(self.parts) and not self.is_eof:
+                self.cond.wait(timeout)
+            new_parts = self.parts[self.read_pos:]
+            self.read_pos = len(self.parts)
+            is_eof = self.is_eof
+
+        if new_parts:
+            return ''.join(new_parts)
+        if not is_eof:
+            return ''
+
+        for t in self.threads:
+            t.join()
+        if self.p.returncode != 0:
+            sys.stderr.write(preproc_errors(self.errdata))
+            sys.stdout.write(''.join(self.parts))
+            exit_now(self.p.returncode)
+        return None
+
+
+    def finish(self):
+        # Like preproc(), for whatever output hasn't been read yet.
+        while self.read(None) is not None:
+            continue
+        return (''.join(self.parts), self.errdata)
+
+
+    def kill(self):
+        try:
+            self.p.kill()
+        except OSError:
+            pass
+        try:
+            self.beacon.signal()
+        except net_util.ExSocketClosed:
+            pass
+
 ####
 '''
 EXAMPLE_CL_ARGS = [
@@ -204,140 +481,574 @@ EXAMPLE_CL_ARGS = [
 '''
 ####################
 
-def ccerbd_connect(addr):
-    remote_conn = socket.create_connection(addr)
-    net_util.send_buffer(remote_conn, HOST_INFO)
-    return remote_conn
+def query_remote(addr, job_key):
+    try:
+        return ccerb.ccerbd_connect_status(addr, HOST_INFO, job_key)
+    except (socket.timeout, socket.error, net_util.ExSocketClosed):
+        return None
 
-####################
 
-def add_remote_addr(addr, job_key, priority):
-    def thread():
-        try:
-            remote_conn = ccerbd_connect(addr)
-        except socket.timeout:
+def connect_remote(addr, status):
+    # For a remote whose status we already have from the directory.
+    try:
+        (remote_conn, link) = ccerb.ccerbd_connect(addr, HOST_INFO)
+    except (socket.timeout, socket.error, net_util.ExSocketClosed):
+        return None
+    return (remote_conn, link, status)
+
+
+def query_directory(ccerbdd_addr, job_key):
+    # Returns [(addr, status)], or None if the directory can't help.
+    try:
+        directory_conn = ccerb.directory_connect(ccerbdd_addr, ccerb.DIRECTORY_CLIENT)
+    except (socket.timeout, socket.error):
+        return None
+
+    try:
+        return ccerb.query_directory(directory_conn, job_key, RACE_WIDTH) or None
+    except (socket.timeout, socket.error, net_util.ExSocketClosed):
+        return None
+    finally:
+        net_util.kill_socket(directory_conn)
+
+
+def choose_candidates(job_key, local_candidate, ccerbdd_addr, min_version=1):
+    # Pick where to reserve a slot, among the local ccerbd and either the best
+    # remotes according to the directory, or (without one) a random sample of
+    # REMOTE_CHOICES dedicated remotes queried for their load: just the best one if
+    # it has a free slot, otherwise race the best RACE_WIDTH. Only those speaking at
+    # least `min_version` of the protocol count.
+    import random
+    candidates = []
+    if local_candidate:
+        candidates.append(local_candidate)
+
+    targets = None
+    if ccerbdd_addr:
+        targets = query_directory(ccerbdd_addr, job_key)
+        if targets:
+            ccerb.v_log(3, '<<directory: {}>>', targets)
+        else:
+            ccerb.v_log(2, '<directory {} had no workers for job_key>', ccerbdd_addr)
+
+    if not targets:
+        addrs = ccerb.parse_remote_addrs(CONFIG['dedicated_remotes'])
+        addrs = random.sample(addrs, min(REMOTE_CHOICES, len(addrs)))
+        targets = [(x, None) for x in addrs]
+
+    lock = threading.Lock()
+    is_done = [False]
+    def thread(addr, status):
+        if status:
+            res = connect_remote(addr, status)
+        else:
+            res = query_remote(addr, job_key)
+        if not res:
             return
-        try_remote_conn(remote_conn, job_key, priority)
-        return
+        with lock:
+            if not is_done[0]:
+                candidates.append(res)
+                return
+        net_util.kill_socket(res[0]) # Too late.
+
+    threads = []
+    for (addr, status) in targets:
+        t = threading.Thread(target=thread, args=(addr, status))
+        t.daemon = True
+        t.start()
+        threads.append(t)
 
-    t = threading.Thread(target=thread)
-    t.daemon = True
-    t.start()
-    return
+    deadline = time.time() + socket.getdefaulttimeout()
+    for t in threads:
+        t.join(max(deadline - time.time(), 0))
+    with lock:
+        is_done[0] = True
+
+    ranked = sorted(candidates, key=lambda x: ccerb.status_score(x[2]))
+    ranked = [x for x in ranked if x[2].has_job_key and x[1].version >= min_version]
+    for x in ranked:
+        ccerb.v_log(3, '<<candidate {}: {}>>', x[0].getpeername(), x[2])
+
+    if ranked and ranked[0][2].free_slots:
+        chosen = ranked[:1]
+    else:
+        chosen = ranked[:RACE_WIDTH]
+
+    for x in candidates:
+        if x not in chosen and x is not local_candidate:
+            net_util.kill_socket(x[0])
+    return chosen
 
 ####################
 
 remotes_lock = threading.Lock()
-remotes_set = set()
+remotes_waiting = set()
+remotes_cancelled = set()
+remotes_left = [0]
 remotes_future = ccerb.Future()
+local_race_done = threading.Event()
+pump_refused = [False] # A remote in the race had no header store.
 
-def try_remote_conn(remote_conn, job_key, priority):
+def race_remotes(candidates, job_key, digest, is_pump=False):
     with remotes_lock:
-        if remotes_future.is_resolved():
-            return # bail without waiting
-        remotes_set.add(remote_conn)
+        for (remote_conn, _, _) in candidates:
+            remotes_waiting.add(remote_conn)
+        remotes_left[0] = len(candidates)
+
+    for (remote_conn, link, _) in candidates:
+        if remote_conn is conn:
+            priority = LOCAL_COMPILE_PRIORITY
+        else:
+            priority = DEDICATED_COMPILE_PRIORITY
+
+        t = threading.Thread(target=try_remote_conn,
+                             args=(remote_conn, link, job_key, priority, digest, is_pump))
+        t.daemon = True
+        t.start()
+    return
+
 
+def try_remote_conn(remote_conn, link, job_key, priority, digest, is_pump):
     try:
-        ccerb.acquire_remote_job(remote_conn, job_key, priority)
-    except (socket.timeout, socket.error):
+        _try_remote_conn(remote_conn, link, job_key, priority, digest, is_pump)
+    finally:
+        if remote_conn is conn:
+            local_race_done.set()
+
+
+def _try_remote_conn(remote_conn, link, job_key, priority, digest, is_pump):
+    try:
+        job_state = ccerb.acquire_remote_job(remote_conn, job_key, priority, digest,
+                                             trace_id_for(link), is_pump)
+    except (socket.timeout, socket.error, net_util.ExSocketClosed):
+        job_state = None
+
+    if job_state in (None, ccerb.JOB_NO_PUMP):
         with remotes_lock:
-            remotes_set.remove(remote_conn)
-            if not remotes_set:
+            remotes_waiting.discard(remote_conn)
+            remotes_left[0] -= 1
+            if not remotes_left[0]:
                 remotes_future.reject()
 
+        if job_state == ccerb.JOB_NO_PUMP:
+            pump_refused[0] = True
+            ccerb.v_log(2, '<{} has no header store>', remote_conn.getpeername())
+            if remote_conn is conn:
+                return # Still good for shimming out.
         net_util.kill_socket(remote_conn)
         return
 
-    if remotes_future.accept(remote_conn):
-        with remotes_lock:
-            for x in remotes_set:
-                if x != remote_conn:
-                    net_util.kill_socket(x)
+    with remotes_lock:
+        remotes_waiting.discard(remote_conn)
+        if job_state != ccerb.JOB_CANCELLED:
+            if remotes_future.accept((remote_conn, link, job_state)):
+                # Release the losers' reservations now, rather than when they notice
+                # we hung up.
+                for x in remotes_waiting:
+                    try:
+                        net_util.send_byte(x, ccerb.JOB_CANCEL)
+                        remotes_cancelled.add(x)
+                    except socket.error:
+                        pass
+                return
+        was_cancelled = remote_conn in remotes_cancelled
+
+    try:
+        if job_state != ccerb.JOB_CANCELLED:
+            # Granted, but we already have a winner.
+            if was_cancelled:
+                while net_util.recv_byte(remote_conn) != ccerb.JOB_CANCELLED:
+                    continue
+            else:
+                ccerb.cancel_remote_job(remote_conn)
+    except (socket.timeout, socket.error, net_util.ExSocketClosed):
+        net_util.kill_socket(remote_conn)
+        return
+
+    if remote_conn is not conn:
+        net_util.kill_socket(remote_conn)
     return
 
+####
+
+def find_remote(job_key, local_candidate, ccerbdd_addr, digest, is_pump):
+    # Returns the race's (remote_conn, link, job_state), or None if a pump race
+    # failed because of remotes without header stores.
+    global remotes_future
+    remotes_future = ccerb.Future()
+    pump_refused[0] = False
+
+    candidates = choose_candidates(job_key, local_candidate, ccerbdd_addr,
+                                   5 if is_pump else 1)
+    if local_candidate not in candidates:
+        local_race_done.set()
+    if not candidates:
+        raise ExShimOut('no remote for job_key')
+
+    race_remotes(candidates, job_key, digest, is_pump)
+    try:
+        return remotes_future.await()
+    except ccerb.Future.Rejection:
+        if is_pump and pump_refused[0]:
+            return None
+        raise ExShimOut('no remote available')
+
+
+def stream_to_remote(stream, job_key, ccerbdd_addr, job_args, file_name):
+    # Races remotes for a slot while the preprocessor runs, then sends the winner
+    # its output as it comes. Returns (remote_conn, returncode), or None if no
+    # remote has `job_key`.
+    try:
+        candidates = choose_candidates(job_key, None, ccerbdd_addr)
+        if not candidates:
+            return None
+        local_race_done.set()
+        race_remotes(candidates, job_key, '') # No digest before the output is all in.
+
+        try:
+            (remote_conn, link, job_state) = remotes_future.await()
+        except ccerb.Future.Rejection:
+            raise ExShimOut('no remote available')
+        ccerb.v_log(2, 'compiler addr: {} (streaming)', remote_conn.getpeername())
+
+        try:
+            if link.version >= 2:
+                returncode = run_streamed_job_client(remote_conn, link, job_args,
+                                                     file_name, stream)
+            else:
+                # No keepalives to carry a v1 remote through a slow preprocessor.
+                (preproc_data, _) = stream.finish()
+                returncode = run_remote_job_client(remote_conn, link, job_state, job_args,
+                                                   [(file_name, preproc_data)])
+            ccerb.v_log(3, '<<link {}>>', link.ratio_info())
+        except (socket.timeout, socket.error, net_util.ExSocketClosed) as e:
+            raise ExShimOut('{}({})'.format(type(e), e))
+    except ExShimOut:
+        stream.kill()
+        raise
+    return (remote_conn, returncode)
+
 ####################
 
-if ccerb.VERBOSE:
-    log_conn = socket.create_connection(ccerb.CCERBD_LOG_ADDR)
-    log_conn.settimeout(None)
-    def log_to_ccerbd(msg):
-        net_util.send_buffer(log_conn, msg)
+def store_preproc(key, source, preproc_data, show_includes, started):
+    # On a thread, while the compile runs. exit_now() waits for it.
+    global preproc_store
+    def store():
+        start = time.time()
+        stored = PREPROC_CACHE.store(key, source, preproc_data, show_includes, started)
+        ccerb.v_log(2, '<preproc cache: {}>', 'stored' if stored else 'not storable')
+        TRACER.add('preproc_store', start, time.time(), {'stored': stored})
+        return
+
+    preproc_store = threading.Thread(target=store)
+    preproc_store.daemon = True
+    preproc_store.start()
+    return
+
+
+preproc_store = None
+
+def exit_now(returncode):
+    # Skips interpreter teardown, which is slow and can trip over the
+    # HeartbeatService daemon thread.
+    if preproc_store:
+        preproc_store.join()
+    if TRACER.current():
+        TRACER.add('shim', SHIM_START, time.time(), {'source': source_file_name})
+        TRACER.flush()
+    if LOG_SENDER:
+        LOG_SENDER.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(returncode)
+
+
+def connect_local(priority, status_job_key=None):
+    # Our side of the handshake goes out together with a first 'wait' request (and
+    # a status query for `status_job_key`, if given), so getting a local slot costs
+    # a single round trip.
+    conn = socket.create_connection(ccerb.CCERBD_LOCAL_ADDR)
+    net_util.set_nodelay(conn)
+
+    frame = net_util.Frame()
+    # Compressing over loopback only costs CPU.
+    ccerb.send_link_offer(frame, ['none'])
+    if status_job_key:
+        ccerb.send_status_query(frame, status_job_key)
+    ccerb.send_job_request(frame, 'wait', priority)
+    frame.send(conn)
+
+    net_util.recv_buffer(conn) # LEGACY_LOCAL_HELLO
+    link = ccerb.recv_link_choice(conn)
+    status = None
+    if status_job_key:
+        status = ccerb.recv_status(conn)
+        net_util.IO_STATS.pipelined += 1
+    state = ccerb.recv_job_state(conn)
+    assert state == ccerb.JOB_READY
+    net_util.IO_STATS.round_trips -= 1
+    net_util.IO_STATS.pipelined += 1
+    ccerb.start_remote_job(conn)
+
+    ccerbdd_addr = None
+    if link.hello:
+        ccerbdd_addr = ccerb.parse_directory_addr(link.hello)
+    return (conn, link, ccerbdd_addr, status)
+
+
+def shim_out(conn, link, reason):
+    # `conn` must hold a started 'wait' job.
+    ccerb.v_log(2, '<shimming out: \'{}\'>', reason)
+    ccerb.v_log(2, '<<shimming out args: {}>>', args)
 
-    ccerb.log_func = log_to_ccerbd
+    with net_util.WaitBeacon(conn):
+        ccerb.log_time_split(63)
+        start = time.time()
+        p = subprocess.Popen(args, bufsize=-1)
+        ccerb.log_time_split(64)
+        p.communicate()
+        TRACER.add('shim_out', start, time.time(), {'reason': reason})
+        ccerb.log_time_split(65)
+
+    if link.version >= 3:
+        try:
+            ccerb.send_shim_out(conn, reason)
+        except socket.error:
+            pass
+    net_util.kill_socket(conn)
+    ccerb.log_time_split(67)
+    exit_now(p.returncode)
 
 ####################
 
-# sys.argv: [ccerb.py, cl, foo.c]
+LOG_SENDER = None
 
-ccerb.nice_down()
+def start_logging():
+    # Lines go to ccerbd in batches, off the compile's path, and the rest at exit.
+    global LOG_SENDER
+    if ccerb.VERBOSE:
+        LOG_SENDER = log_util.LogSender(ccerb.CCERBD_LOG_ADDR)
+        ccerb.log_func = LOG_SENDER.log
+    return
 
-args = sys.argv[1:]
-#args = EXAMPLE_CL_ARGS
-#print('args:', args)
+####################
 
+ccerb.nice_down()
+
+if shim_out_reason:
+    # ccerbd logs the reason we send it, so short of debugging (VERBOSE past the
+    # default), this opens no log socket.
+    if ccerb.VERBOSE > 2:
+        start_logging()
+    else:
+        ccerb.VERBOSE = 0
+    (conn, link, _, _) = connect_local(SHIM_OUT_PRIORITY)
+    ccerb.log_time_split(62)
+    shim_out(conn, link, shim_out_reason)
+
+start_logging()
 ccerb.log_time_split(11)
 
-conn = socket.create_connection(ccerb.CCERBD_LOCAL_ADDR)
+####
+
+CONFIG = ccerb.load_config(ccerb.CONFIG_PATH)
+assert 'dedicated_remotes' in CONFIG
+
+HOST_INFO = CONFIG[None]['host_info']
+NO_LOCAL = int(CONFIG[None].get('no_local', 0))
+FORWARD = int(CONFIG[None].get('forward', 0))
+REMOTE_CHOICES = int(CONFIG[None].get('remote_choices', 2))
+RACE_WIDTH = 2
+# Pick a remote before preprocessing, and send it the output while it's produced.
+# Skipped while the local ccerbd has a free slot.
+STREAM_PREPROC = int(CONFIG[None].get('stream_preproc', 0))
+# Ship remotes the source and the headers it may include, for them to preprocess,
+# instead of preprocessing here. Not with `forward`, and takes the place of
+# stream_preproc. Sources with includes we can't follow are preprocessed here.
+PUMP = int(CONFIG[None].get('pump', 0)) and not FORWARD
+# Reuse preprocessor output while the source and the headers -showIncludes listed
+# for it are unchanged, up to this much on disk. 0 to always preprocess.
+PREPROC_CACHE = None
+PREPROC_CACHE_MB = int(CONFIG[None].get('preproc_cache_mb', 1024))
+if PREPROC_CACHE_MB:
+    PREPROC_CACHE = preproc_cache.PreprocCache(
+        os.path.expanduser(CONFIG[None].get('preproc_cache_dir', '~/.ccerb/preproc')),
+        PREPROC_CACHE_MB * 1024 * 1024,
+        CONFIG[None].get('show_includes_prefix', 'Note: including file:'))
+ccerb.JOB_KEY_HASH_CONTENT = int(CONFIG[None].get('job_key_hash', 0))
+if 'compress' in CONFIG[None]:
+    ccerb.COMPRESS_CODECS = ccerb.compress_codecs(CONFIG[None]['compress'].split(','))
+ccerb.DEDUP = int(CONFIG[None].get('dedup', 1))
+# Record spans for this compile there, and have ccerbds record theirs under the
+# same trace id (see ccerb_trace.py).
+TRACE_DIR = os.path.expanduser(CONFIG[None].get('trace_dir', ''))
+if TRACE_DIR:
+    if not os.path.isdir(TRACE_DIR):
+        # No local ccerbd may have made it.
+        try:
+            os.makedirs(TRACE_DIR)
+        except OSError:
+            pass # Raced with another process.
+    TRACER = trace_util.Tracer(TRACE_DIR, HOST_INFO, 'ccerb_shim')
+    TRACER.default_id = trace_util.new_trace_id()
+
 ccerb.log_time_split(12)
 
-ccerbdd_addr = net_util.recv_pickle(conn)
+cc_bin = args[0]
+start = time.time()
+cc_key = ccerb.get_job_key(cc_bin)
+TRACER.add('get_job_key', start, time.time())
+
+# Needs no slot, so before we wait for one.
+preproc_key = None
+preproc_cached = None
+if PREPROC_CACHE:
+    start = time.time()
+    preproc_source = source_path(preproc_args)
+    preproc_key = PREPROC_CACHE.key(cc_key, preproc_args, preproc_source)
+    preproc_cached = PREPROC_CACHE.lookup(preproc_key)
+    ccerb.v_log(2, '<preproc cache: {}>', 'hit' if preproc_cached else 'miss')
+    TRACER.add('preproc_cache', start, time.time(), {'hit': bool(preproc_cached)})
+
+status_job_key = None
+if STREAM_PREPROC and not FORWARD and not NO_LOCAL:
+    status_job_key = cc_key
+start = time.time()
+(conn, local_link, ccerbdd_addr, local_status) = connect_local(PREPROC_PRIORITY,
+                                                               status_job_key)
+TRACER.add('local_slot', start, time.time())
 ccerb.log_time_split(13)
 
 try:
-    if not args:
-        raise ExShimOut('no args')
-
     ccerb.v_log(3, '<args: {}>>', args)
 
-    cc_bin = args[0]
-    cc_args = args[1:]
-
-    cc_key = ccerb.get_job_key(cc_bin)
-
     ccerb.log_time_split(21)
 
     ####
 
-    (preproc_args, compile_args, source_file_name) = process_args(cc_args)
     info = 'ccerb-preproc: {}'.format(source_file_name)
 
     ccerb.v_log(3, '<<preproc_args: {}>>', preproc_args)
     ccerb.v_log(3, '<<compile_args: {}>>', compile_args)
 
     has_show_includes = '-showIncludes' in preproc_args
+    run_preproc_args = preproc_args
+    if preproc_key and not has_show_includes:
+        # For the includes to check cached output against. Not shown.
+        run_preproc_args = preproc_args + ['-showIncludes', '-nologo']
 
     ####
 
-    ccerb.acquire_remote_job(conn, 'wait', PREPROC_PRIORITY)
-
-    with net_util.WaitBeacon(conn):
-        (preproc_data, show_includes) = preproc(cc_bin, preproc_args)
+    is_local_free = (local_status and local_status.has_job_key and
+                     local_status.free_slots)
+
+    streamed = None
+    pump = None
+    start = time.time()
+    if preproc_cached:
+        with net_util.WaitBeacon(conn):
+            pass # Nothing to preprocess.
+        (preproc_data, show_includes) = preproc_cached
+    elif STREAM_PREPROC and not FORWARD and not PUMP and not is_local_free:
+        stream = PreprocStream(cc_bin, run_preproc_args, net_util.WaitBeacon(conn))
+        streamed = stream_to_remote(stream, cc_key, ccerbdd_addr, compile_args,
+                                    source_file_name)
+        (preproc_data, show_includes) = stream.finish()
+        TRACER.add('stream_to_remote', start, time.time())
+        if preproc_key:
+            store_preproc(preproc_key, preproc_source, preproc_data, show_includes, start)
+    else:
+        with net_util.WaitBeacon(conn):
+            if PUMP:
+                try:
+                    pump = pump_inputs(preproc_args)
+                except include_util.ExUnpumpable as e:
+                    ccerb.v_log(2, '<not pumping: {}>', e.reason)
+                now = time.time()
+                TRACER.add('find_headers', start, now, {'ok': bool(pump)})
+                start = now
+            if not pump:
+                (preproc_data, show_includes) = preproc(cc_bin, run_preproc_args)
+                TRACER.add('preproc', start, time.time())
+                if preproc_key:
+                    store_preproc(preproc_key, preproc_source, preproc_data, show_includes, start)
+
+    if pump:
+        digest = ''
+        if not has_show_includes:
+            # Cached results don't keep the remote preprocessor's includes.
+            digest = ccerb.pump_digest(cc_key, compile_args, pump[0], pump[1])
+    elif not streamed:
+        input_files = [(source_file_name, preproc_data)]
+        digest = ccerb.job_digest(cc_key, compile_args, input_files)
 
     ########
 
-    if not NO_LOCAL:
-        t = threading.Thread(target=try_remote_conn,
-                             args=(conn, cc_key, LOCAL_COMPILE_PRIORITY))
-        t.daemon = True
-        t.start()
-
-    for (host, port) in CONFIG['dedicated_remotes'].viewitems():
-        if not port:
-            (_, port) = ccerb.CCERBD_LOCAL_ADDR
-        add_remote_addr((host, port), cc_key, DEDICATED_COMPILE_PRIORITY)
-
-    ####
-
-    remote_conn = remotes_future.await()
-    ccerb.v_log(2, 'compiler addr: {}', remote_conn.getpeername())
-
-    ########
+    if streamed:
+        (remote_conn, returncode) = streamed
+    elif FORWARD:
+        local_race_done.set()
+        start = time.time()
+        try:
+            returncode = run_forwarded_job(conn, local_link, cc_key, digest, compile_args,
+                                           input_files)
+        except (socket.timeout, socket.error, net_util.ExSocketClosed) as e:
+            raise ExShimOut('{}({})'.format(type(e), e))
+        TRACER.add('forward', start, time.time())
+        remote_conn = None
+    else:
+        start = time.time()
+        local_candidate = None
+        if not NO_LOCAL:
+            local_candidate = (conn, local_link, ccerb.query_status(conn, cc_key))
+        else:
+            local_race_done.set()
+
+        found = find_remote(cc_key, local_candidate, ccerbdd_addr, digest, bool(pump))
+        if not found:
+            # Preprocess here after all, and race again for a plain job.
+            ccerb.v_log(2, '<not pumping: refused>')
+            pump = None
+            local_race_done.wait() # The local ccerbd may have been in the race.
+            local_race_done.clear()
+            now = time.time()
+            ccerb.acquire_and_start_remote_job(conn, 'wait', PREPROC_PRIORITY)
+            with net_util.WaitBeacon(conn):
+                (preproc_data, show_includes) = preproc(cc_bin, run_preproc_args)
+            TRACER.add('preproc', now, time.time())
+            if preproc_key:
+                store_preproc(preproc_key, preproc_source, preproc_data, show_includes,
+                              now)
+            input_files = [(source_file_name, preproc_data)]
+            digest = ccerb.job_digest(cc_key, compile_args, input_files)
+            found = find_remote(cc_key, local_candidate, ccerbdd_addr, digest, False)
+        (remote_conn, link, job_state) = found
+
+        ####
+
+        remote_addr = remote_conn.getpeername()
+        ccerb.v_log(2, 'compiler addr: {}{}', remote_addr,
+                    ' (cached)' if job_state == ccerb.JOB_CACHED else '')
+        now = time.time()
+        TRACER.add('find_remote', start, now)
+        start = now
 
-    input_files = [(source_file_name, preproc_data)]
-    try:
-        returncode = run_remote_job_client(remote_conn, compile_args, input_files)
-    except (socket.timeout, socket.error) as e:
-        raise ExShimOut('{}({})'.format(type(e), e))
+        try:
+            if pump:
+                (returncode, show_includes) = run_pump_job_client(remote_conn, link,
+                                                                  job_state,
+                                                                  compile_args, pump)
+            else:
+                # Not to the local ccerbd, which has nothing to dedup against.
+                returncode = run_remote_job_client(remote_conn, link, job_state,
+                                                   compile_args, input_files,
+                                                   remote_conn is not conn)
+            ccerb.v_log(3, '<<link {}>>', link.ratio_info())
+        except (socket.timeout, socket.error, net_util.ExSocketClosed) as e:
+            raise ExShimOut('{}({})'.format(type(e), e))
+        TRACER.add('remote_job', start, time.time(),
+                   {'addr': str(remote_addr), 'pump': bool(pump),
+                    'cached': job_state == ccerb.JOB_CACHED})
 
     if has_show_includes:
         try:
@@ -348,29 +1059,20 @@ try:
         except ValueError:
             pass
 
-    net_util.kill_socket(remote_conn)
-    exit(returncode)
+    if remote_conn:
+        net_util.kill_socket(remote_conn)
+    ccerb.v_log(2, '<wire: {}>', net_util.IO_STATS.summary())
+    exit_now(returncode)
 
 except ExShimOut as e:
     ccerb.log_time_split(51)
-    ccerb.v_log(1, '<shimming out: \'{}\'>', e.reason)
-    ccerb.v_log(2, '<<shimming out args: {}>>', args)
-    pass
+    shim_out_reason = e.reason
 
 ####
 ccerb.log_time_split(61)
 
-ccerb.acquire_remote_job(conn, 'wait', SHIM_OUT_PRIORITY)
+# The local connection may still be backing out of the race.
+local_race_done.wait()
+ccerb.acquire_and_start_remote_job(conn, 'wait', SHIM_OUT_PRIORITY)
 ccerb.log_time_split(62)
-
-with net_util.WaitBeacon(conn):
-    ccerb.log_time_split(63)
-    p = subprocess.Popen(args, buf_size=-1)
-    ccerb.log_time_split(64)
-    p.communicate()
-    ccerb.log_time_split(65)
-
-ccerb.log_time_split(66)
-net_util.kill_socket(conn)
-ccerb.log_time_split(67)
-exit(p.returncode)
+shim_out(conn, local_link, shim_out_reason)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+assert __name__ == '__main__'
+
+import json
+import os
+import sys
+
+import trace_util
+
+####################
+
+# Usage: ccerb_trace.py OUT_JSON TRACE_PATH...
+#
+# Merges spans from the trace_dirs (or trace files) of any number of hosts into a
+# Chrome trace, for chrome://tracing or ui.perfetto.dev: a process per ccerbd or
+# host's shims, with a row per compile. Hosts' clocks are taken as they are.
+
+if len(sys.argv) < 3:
+    print('Usage: ccerb_trace.py OUT_JSON TRACE_PATH...', file=sys.stderr)
+    exit(1)
+
+out_path = sys.argv[1]
+
+paths = []
+for path in sys.argv[2:]:
+    if os.path.isdir(path):
+        path = os.path.join(path, trace_util.TRACE_FILE_NAME)
+        paths += [path + '.old', path]
+    else:
+        paths.append(path)
+
+spans = []
+for path in paths:
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        continue
+    with f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                pass # Cut short by a crash.
+
+if not spans:
+    print('No spans in {}'.format(sys.argv[2:]), file=sys.stderr)
+    exit(1)
+
+####################
+
+# Rows are named after the source file, which only the shim's spans know.
+sources = dict()
+for span in spans:
+    source = span.get('args', dict()).get('source')
+    if source:
+        sources[span['trace']] = source
+
+start = min([x['ts'] for x in spans])
+pids = dict() # (host, proc) -> pid
+tids = dict() # (pid, trace, thread) -> tid
+events = []
+for span in spans:
+    proc_key = (span['host'], span['proc'])
+    try:
+        pid = pids[proc_key]
+    except KeyError:
+        pid = len(pids) + 1
+        pids[proc_key] = pid
+        events.append({'ph': 'M', 'name': 'process_name', 'pid': pid,
+                       'args': {'name': '{} {}'.format(*proc_key)}})
+
+    thread_key = (pid, span['trace'], span['pid'], span['tid'])
+    try:
+        tid = tids[thread_key]
+    except KeyError:
+        tid = len(tids) + 1
+        tids[thread_key] = tid
+        events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+                       'args': {'name': sources.get(span['trace'], span['trace'])}})
+
+    args = dict(span.get('args', dict()))
+    args['trace'] = span['trace']
+    events.append({'ph': 'X', 'name': span['name'], 'pid': pid, 'tid': tid,
+                   'ts': int((span['ts'] - start) * 1000 * 1000),
+                   'dur': int(span['dur'] * 1000 * 1000), 'args': args})
+
+with open(out_path, 'wb') as f:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+print('{} spans, {} compiles, {} processes -> {}'.format(len(spans), len(sources),
+                                                          len(pids), out_path))
@@ -4,13 +4,12 @@ assert __name__ == '__main__'
 
 from collections import namedtuple
 
-import bisect
 import itertools
 import math
 import multiprocessing
 import os
+import re
 import select
-import shutil
 import socket
 import subprocess
 import sys
@@ -19,7 +18,19 @@ import time
 import threading
 
 import ccerb
+import chunk_util
+import header_store
+import hedge_util
+import load_util
+import log_util
+import metrics_util
+import mux_util
 import net_util
+import remote_pool
+import result_cache
+import sched_util
+import trace_util
+import workspace_pool
 
 ####################
 
@@ -35,10 +46,97 @@ except KeyError:
     (_, PUBLIC_PORT) = ccerb.CCERBD_LOCAL_ADDR
 PUBLIC_ADDR = ('', PUBLIC_PORT)
 
+ccerb.JOB_KEY_HASH_CONTENT = int(CONFIG[None].get('job_key_hash', 0))
+
+if 'compress' in CONFIG[None]:
+    ccerb.COMPRESS_CODECS = ccerb.compress_codecs(CONFIG[None]['compress'].split(','))
+ccerb.DEDUP = int(CONFIG[None].get('dedup', 1))
+
+# Chunks of job inputs, kept per client IP for later inputs to refer to (see
+# ccerb.send_files), in memory, for up to chunk_cache_peers IPs (0 to disable).
+CHUNK_CACHE_MB = int(CONFIG[None].get('chunk_cache_mb', 64))
+CHUNK_CACHE_PEERS = int(CONFIG[None].get('chunk_cache_peers', 16))
+
+# Relative per-slot speed, advertised to clients choosing a remote.
+SPEED = float(CONFIG[None].get('speed', 1.0))
+
+# Job slots follow the load on the box, from everything else running on it and
+# its free memory, between slots_min and slots_max (see load_util). Without
+# adaptive_slots (off by default), or /proc to read, it's fixed at slots_max. An
+# otherwise idle box takes on more jobs than it has CPUs only with a higher
+# slots_max.
+ADAPTIVE_SLOTS = int(CONFIG[None].get('adaptive_slots', 0))
+SLOTS_MIN = int(CONFIG[None].get('slots_min', 1))
+SLOTS_MAX = int(CONFIG[None].get('slots_max', SLOT_COUNT))
+SLOT_MEM_MB = int(CONFIG[None].get('slot_mem_mb', 512))
+
+# Priority units a pending job gains per second of waiting.
+SCHED_AGING_RATE = float(CONFIG[None].get('sched_aging_rate', 1.0))
+
+RESULT_CACHE_MB = int(CONFIG[None].get('result_cache_mb', 2048))
+RESULT_CACHE_DIR = os.path.expanduser(CONFIG[None].get('result_cache_dir',
+                                                       '~/.ccerb/results'))
+
+# Sources and headers from pump jobs, by content (0 to refuse pump jobs).
+HEADER_STORE_MB = int(CONFIG[None].get('header_store_mb', 2048))
+HEADER_STORE_DIR = os.path.expanduser(CONFIG[None].get('header_store_dir',
+                                                       '~/.ccerb/headers'))
+
+# Job scratch dirs. With a per-workspace cap, as many as fit in workspace_ram_mb
+# go under workspace_ram_dir (e.g. a tmpfs) instead.
+WORKSPACE_DIR = os.path.expanduser(CONFIG[None].get('workspace_dir',
+                                                    tempfile.gettempdir()))
+WORKSPACE_RAM_DIR = CONFIG[None].get('workspace_ram_dir', '')
+WORKSPACE_RAM_MB = int(CONFIG[None].get('workspace_ram_mb', 1024))
+WORKSPACE_MAX_MB = int(CONFIG[None].get('workspace_max_mb', 0))
+
+REMOTE_ADDRS = ccerb.parse_remote_addrs(CONFIG.get('dedicated_remotes', dict()))
+REMOTE_CHOICES = int(CONFIG[None].get('remote_choices', 2))
+# Run all forwarded jobs to a remote over one multiplexed connection.
+REMOTE_MUX = int(CONFIG[None].get('remote_mux', 1))
+# Streams served at once across all mux connections; more are closed on arrival.
+MAX_MUX_STREAMS = int(CONFIG[None].get('max_mux_streams', 256))
+MUX_STREAM_SLOTS = threading.BoundedSemaphore(MAX_MUX_STREAMS)
+# Run a forwarded job again, on another remote or locally, once it's slower than
+# this percentile of recent ones for its size (0 for never), and at least
+# hedge_min_secs.
+HEDGE_PERCENTILE = float(CONFIG[None].get('hedge_percentile', 95))
+HEDGE_MIN_SECS = float(CONFIG[None].get('hedge_min_secs', 2.0))
+HOST_INFO = CONFIG[None].get('host_info', socket.gethostname())
+
+# Metrics, in Prometheus text format, for any HTTP GET to this port (0 to disable).
+METRICS_PORT = int(CONFIG[None].get('metrics_port', 14294))
+# e.g. '' to let a Prometheus server elsewhere scrape us.
+METRICS_HOST = CONFIG[None].get('metrics_host', 'localhost')
+
+# Where to record spans for jobs from shims that trace theirs (see ccerb_trace.py).
+TRACE_DIR = os.path.expanduser(CONFIG[None].get('trace_dir', ''))
+TRACE_MAX_MB = int(CONFIG[None].get('trace_max_mb', 256))
+TRACE_FLUSH_INTERVAL = 1.0
+
+# Our and our shims' log lines go here instead of stdout and stderr, as text, or
+# as log_util binary records (see ccerb_log.py) with log_binary=1.
+LOG_FILE = os.path.expanduser(CONFIG[None].get('log_file', ''))
+LOG_BINARY = int(CONFIG[None].get('log_binary', 0))
+
+# The ccerbdd to advertise our load to, and to point our shims at.
+DIRECTORY_ADDR = None
+if 'directory' in CONFIG[None]:
+    DIRECTORY_ADDR = ccerb.parse_directory_addr(CONFIG[None]['directory'])
+# How the directory should tell clients to reach us. Defaults to the address it
+# sees us connect from.
+PUBLIC_HOST = CONFIG[None].get('public_host', '')
+
+# Handed to v2 shims in the local handshake.
+LOCAL_HELLO = ''
+if DIRECTORY_ADDR:
+    LOCAL_HELLO = '{}:{}'.format(*DIRECTORY_ADDR)
+
 ####
 
 JOB_MAP = dict()
-JOB_MAP['wait'] = net_util.wait_on_beacon
+JOB_BINS = dict()
+JOB_MAP['wait'] = lambda conn, link: net_util.wait_on_beacon(conn)
 
 ####################
 
@@ -50,242 +148,1044 @@ def locked_print(*args, **kwargs):
 
 ccerb.print_func = locked_print
 
+# v_log() only queues: lines are printed or written on a thread of their own.
+LOG_SINK = log_util.LogSink(locked_print, LOG_FILE or None, LOG_BINARY)
+ccerb.log_func = LOG_SINK.log
+net_util.spawn_thread(LOG_SINK.run, ())
+
 ####################
 
-class ScopedTempDir:
-    def __init__(self):
+OUTPUT_READ_SIZE = 64 * 1024
+
+class JobOutput:
+    # Passes a job's stdout/stderr on to a v3 client as it comes, keeping a copy
+    # while `keep` is set (for the result cache).
+    def __init__(self, link, beacon, keep):
+        self.link = link
+        self.beacon = beacon
+        self.keep = keep
+        self.kept = {ccerb.JOB_STDOUT: [], ccerb.JOB_STDERR: []}
         return
 
-    def __enter__(self):
-        self.path = tempfile.mkdtemp()
-        return self
 
-    def __exit__(self, ex_type, ex_val, ex_traceback):
-        shutil.rmtree(self.path)
+    def __call__(self, tag, data):
+        if self.keep:
+            self.kept[tag].append(data)
+        try:
+            self.beacon.send(lambda conn: ccerb.send_job_output(conn, self.link, tag,
+                                                                data))
+        except net_util.ExSocketClosed:
+            pass # The beacon's on_error kills the job.
         return
 
-####
 
-def run_in_temp_dir(input_files, args):
-    with ScopedTempDir() as temp_dir:
-        ccerb.write_files(temp_dir.path, input_files)
+    def kept_data(self):
+        return (''.join(self.kept[ccerb.JOB_STDOUT]), ''.join(self.kept[ccerb.JOB_STDERR]))
+
+
+def read_output(f, tag, on_output):
+    # What universal_newlines would give, but passed on as it comes.
+    has_cr = False
+    while True:
+        data = os.read(f.fileno(), OUTPUT_READ_SIZE)
+        if not data:
+            break
+        if has_cr:
+            data = '\r' + data
+        has_cr = data.endswith('\r') # Maybe the first half of a '\r\n'.
+        if has_cr:
+            data = data[:-1]
+        data = data.replace('\r\n', '\n').replace('\r', '\n')
+        if data:
+            on_output(tag, data)
+    if has_cr:
+        on_output(tag, '\n')
+    return
+
+
+def run_in_dir(dir_path, input_names, output_names, args, beacon, on_output=None):
+    # With `on_output`, stdout and stderr go to on_output(tag, data) as they come,
+    # and come back empty. With `output_names`, only those are collected as outputs.
+    start = time.time()
+    p = subprocess.Popen(args, bufsize=-1, cwd=dir_path, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, universal_newlines=not on_output)
 
-        p = subprocess.Popen(args, bufsize=-1, cwd=temp_dir.path, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, universal_newlines=True)
+    def on_error():
+        # Nobody is waiting for this result anymore.
+        try:
+            p.kill()
+        except OSError:
+            pass
+    beacon.set_on_error(on_error)
+
+    if on_output:
+        threads = [net_util.spawn_thread(read_output, (p.stdout, ccerb.JOB_STDOUT,
+                                                       on_output)),
+                   net_util.spawn_thread(read_output, (p.stderr, ccerb.JOB_STDERR,
+                                                       on_output))]
+        for t in threads:
+            t.join()
+        p.wait()
+        (outdata, errdata) = ('', '')
+    else:
         (outdata, errdata) = p.communicate()
-        returncode = p.returncode
-        assert returncode != None # Should have exited.
+    returncode = p.returncode
+    assert returncode != None # Should have exited.
+    start = record_phase('compile', start)
+
+    if output_names is not None:
+        output_files = [(x, os.path.join(dir_path, x)) for x in output_names]
+        output_files = [x for x in output_files if os.path.isfile(x[1])]
+    else:
+        # The inputs are left for the workspace to clean up with everything else.
+        input_names = set(os.path.normpath(x) for x in input_names)
+        output_files = [x for x in ccerb.list_files(dir_path)
+                        if os.path.normpath(x[0]) not in input_names]
+    record_phase('collect_outputs', start)
+    return (returncode, outdata, errdata, output_files)
 
-        for (file_rel_path, _) in input_files:
-            file_path = os.path.join(temp_dir.path, file_rel_path)
-            os.remove(file_path)
-            continue
 
-        output_files = ccerb.read_files(temp_dir.path)
+def run_in_workspace(workspace, input_names, output_names, args, beacon, on_output=None):
+    # run_in_dir(), then again on disk if it failed in a RAM workspace that may have
+    # filled up. Output already streamed is repeated.
+    result = run_in_dir(workspace.path, input_names, output_names, args, beacon,
+                        on_output)
+    if result[0] == 0 or not WORKSPACES.may_be_full(workspace, result[2]):
+        return result
+    ccerb.v_log(1, '<workspace {} may be full: running again on disk>', workspace.path)
+    WORKSPACES.move_to_disk(workspace, input_names)
+    return run_in_dir(workspace.path, input_names, output_names, args, beacon, on_output)
 
-    return (returncode, outdata, errdata, output_files)
+####
+
+def send_job_result(conn, link, returncode, outdata, errdata, output_files,
+                    frame=None):
+    if frame is None:
+        frame = net_util.Frame()
+    net_util.send_struct(frame, '<i', returncode)
+    ccerb.send_payload(conn, link, outdata, frame)
+    ccerb.send_payload(conn, link, errdata, frame)
+
+    ccerb.send_file_paths(conn, output_files, link, frame)
+    return
+
+
+def store_result(digest, returncode, outdata, errdata, output_files, output):
+    # Streamed output comes back empty from run_in_dir, but `output` kept a copy.
+    if output:
+        (outdata, errdata) = output.kept_data()
+    RESULT_CACHE.store(digest, returncode, outdata, errdata, output_files)
+
+
+def run_remote_job_server(conn, link, job_bin, job_key):
+    start = time.time()
+    (job_args, output_names) = ccerb.recv_job_args(conn, link)
+
+    with WORKSPACES.acquire() as workspace:
+        dedup_was = (link.chunked_bytes, link.deduped_bytes)
+        input_names = ccerb.recv_files_to_dir(conn, workspace.path, link,
+                                              workspace.max_bytes)
+        record_dedup(job_key, link, dedup_was)
+        record_phase('recv_inputs', start)
+
+        digest = None
+        if RESULT_CACHE:
+            digest = ccerb.job_digest_dir(job_key, job_args, workspace.path, input_names)
+
+        with net_util.WaitBeacon(conn) as beacon:
+            output = None
+            if link.version >= 3:
+                output = JobOutput(link, beacon, bool(digest))
+            args = [job_bin] + job_args
+            (returncode, outdata, errdata, output_files) = run_in_workspace(
+                workspace, input_names, output_names, args, beacon, output)
+
+        if digest and returncode == 0:
+            store_result(digest, returncode, outdata, errdata, output_files, output)
+
+        start = time.time()
+        send_job_result(conn, link, returncode, outdata, errdata, output_files)
+        record_phase('send_outputs', start)
+        input_files = [(x, os.path.join(workspace.path, x)) for x in input_names]
+        record_job(job_key, 'run', input_files,
+                   (returncode, outdata, errdata, output_files))
+
+    ccerb.v_log(3, '<<link {}>>', link.ratio_info())
+    ccerb.v_log(3, '<<workspaces: {}>>', WORKSPACES.summary())
+    return
 
 ####
 
-def run_remote_job_server(conn, job_bin):
-    job_args = str(net_util.recv_buffer(conn))
-    job_args = job_args.split('\0')
+def unpump(data, root):
+    # Turns paths under `root` back into the client's (see ccerb.pump_name), in
+    # whatever form the preprocessor wrote them: as is, with '/'s, or with escaped
+    # '\\'s, as in #line directives.
+    forms = set([root, root.replace('\\', '/'), root.replace('\\', '\\\\')])
+    for form in forms:
+        if form not in data:
+            continue
+        pattern = re.escape(form) + r'(?:\\\\|[\\/])(?:([a-z])_|_)(?=\\|/)'
+        data = re.sub(pattern, lambda m: m.group(1) + ':' if m.group(1) else '', data)
+    return data
+
+
+def run_preproc(root, args, beacon):
+    # Returns (returncode, outdata, errdata), with paths as the client knows them.
+    p = subprocess.Popen(args, bufsize=-1, cwd=root, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
 
-    input_files = ccerb.recv_files(conn)
+    def on_error():
+        try:
+            p.kill()
+        except OSError:
+            pass
+    beacon.set_on_error(on_error)
 
-    with net_util.WaitBeacon(conn):
-        args = [job_bin] + job_args
-        (returncode, outdata, errdata, output_files) = run_in_temp_dir(input_files, args)
+    (outdata, errdata) = p.communicate()
+    # What the shim's universal_newlines would have given.
+    outdata = unpump(outdata.replace('\r\n', '\n'), root)
+    errdata = unpump(errdata.replace('\r\n', '\n'), root)
+    return (p.returncode, outdata, errdata)
 
-    net_util.send_struct(conn, '<i', returncode)
-    net_util.send_buffer(conn, outdata)
-    net_util.send_buffer(conn, errdata)
 
-    ccerb.send_files(conn, output_files)
+def run_pump_job_server(conn, link, job_bin, job_key, client_digest):
+    # See ccerb.PUMP_ROOT. The result is cached only under the digest the client
+    # asked for, and only if it's the one we'd have given the job.
+    start = time.time()
+    (job_args, output_names, source_name, preproc_args,
+     manifest) = ccerb.recv_pump_job(conn, link)
+    missing = HEADER_STORE.missing(sorted(set([x for (_, x) in manifest])))
+    ccerb.send_hashes(conn, missing)
+
+    with WORKSPACES.acquire() as workspace:
+        recv_dir = os.path.join(workspace.path, ccerb.PUMP_ROOT + '.recv')
+        for sha1 in ccerb.recv_files_to_dir(conn, recv_dir, link, workspace.max_bytes):
+            path = os.path.join(recv_dir, sha1)
+            HEADER_STORE.add(str(sha1), path)
+            os.remove(path)
+        if missing:
+            os.rmdir(recv_dir)
+        root = os.path.join(workspace.path, ccerb.PUMP_ROOT)
+        HEADER_STORE.materialize(manifest, root)
+        start = record_phase('recv_inputs', start)
+        input_names = [source_name] + [os.path.join(ccerb.PUMP_ROOT, x)
+                                       for (x, _) in manifest]
+
+        digest = None
+        if RESULT_CACHE and client_digest and client_digest == ccerb.pump_digest(
+                job_key, job_args, preproc_args, manifest):
+            digest = client_digest
+
+        with net_util.WaitBeacon(conn) as beacon:
+            args = [job_bin] + [x.replace(ccerb.PUMP_PATH_MARK, root + os.sep)
+                                for x in preproc_args]
+            (returncode, preproc_data, preproc_err) = run_preproc(root, args, beacon)
+            start = record_phase('preproc', start)
+            output = None
+            result = None
+            if returncode != 0:
+                ccerb.v_log(2, '<pump preproc failed ({}): {}>', returncode,
+                            preproc_err.strip().split('\n')[-1])
+            else:
+                with open(os.path.join(workspace.path, source_name), 'wb') as f:
+                    f.write(preproc_data)
+                if link.version >= 3:
+                    output = JobOutput(link, beacon, bool(digest))
+                args = [job_bin] + job_args
+                result = run_in_workspace(workspace, input_names, output_names, args,
+                                          beacon, output)
+
+        if digest and result and result[0] == 0:
+            store_result(digest, *result, output=output)
+
+        start = time.time()
+        frame = net_util.Frame()
+        net_util.send_byte(frame, ccerb.PUMP_OK if result else ccerb.PUMP_FAILED)
+        ccerb.send_payload(conn, link, preproc_err, frame)
+        if result:
+            send_job_result(conn, link, *result, frame=frame)
+        else:
+            frame.send(conn)
+        record_phase('send_outputs', start)
+        input_files = [(x, os.path.join(workspace.path, x)) for x in input_names]
+        record_job(job_key, 'pump' if result else 'pump_failed', input_files,
+                   result or (returncode, '', preproc_err, []))
+
+    ccerb.v_log(3, '<<link {}>>', link.ratio_info())
+    ccerb.v_log(3, '<<header store: {}>>', HEADER_STORE.summary())
     return
 
 ####
 
 for (job_bin, _) in CONFIG['bin'].viewitems():
-    def job_func(conn):
-        return run_remote_job_server(conn, job_bin)
-
     job_key = ccerb.get_job_key(job_bin)
+
+    def job_func(conn, link, job_bin=job_bin, job_key=job_key):
+        return run_remote_job_server(conn, link, job_bin, job_key)
+
     JOB_MAP[job_key] = job_func
+    JOB_BINS[job_key] = job_bin
     continue
 
+ccerb.v_log(1, '<job keys: {}>', ccerb.job_key_stats.summary())
+
 ########################################
 
-class PriorityQueue:
-    def __init__(self):
-        self.list = []
-        return
+SLOT_GOVERNOR = None
+if ADAPTIVE_SLOTS and load_util.read_loadavg() is not None:
+    SLOT_GOVERNOR = load_util.SlotGovernor(SLOT_COUNT, SLOTS_MIN, SLOTS_MAX,
+                                           SLOT_MEM_MB * 1024 * 1024)
+    SCHED = sched_util.Scheduler(SLOT_GOVERNOR.slots, SCHED_AGING_RATE)
+else:
+    SCHED = sched_util.Scheduler(SLOTS_MAX, SCHED_AGING_RATE)
+
+REMOTE_POOL = None
+if REMOTE_ADDRS:
+    REMOTE_POOL = remote_pool.RemotePool(REMOTE_ADDRS, HOST_INFO, REMOTE_CHOICES,
+                                         use_mux=REMOTE_MUX)
+
+HEDGER = None
+if REMOTE_POOL and HEDGE_PERCENTILE:
+    HEDGER = hedge_util.Hedger(HEDGE_PERCENTILE, HEDGE_MIN_SECS)
+
+WORKSPACES = workspace_pool.WorkspacePool(WORKSPACE_DIR, WORKSPACE_RAM_DIR,
+                                          WORKSPACE_RAM_MB * 1024 * 1024,
+                                          WORKSPACE_MAX_MB * 1024 * 1024, SLOTS_MAX * 2)
+WORKSPACES.fill(SCHED.max_slots)
+if WORKSPACE_RAM_DIR and not WORKSPACES.ram_slots:
+    ccerb.v_log(1, '<workspace_ram_dir unused: needs workspace_max_mb at most'
+                ' workspace_ram_mb>')
+
+RESULT_CACHE = None
+if RESULT_CACHE_MB:
+    RESULT_CACHE = result_cache.ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MB * 1024 * 1024)
+
+CHUNK_CACHES = None
+if CHUNK_CACHE_MB and CHUNK_CACHE_PEERS:
+    CHUNK_CACHES = chunk_util.PeerCaches(CHUNK_CACHE_MB * 1024 * 1024, CHUNK_CACHE_PEERS)
+
+HEADER_STORE = None
+if HEADER_STORE_MB:
+    HEADER_STORE = header_store.HeaderStore(HEADER_STORE_DIR,
+                                            HEADER_STORE_MB * 1024 * 1024)
 
-    def pop(self):
-        return self.list.pop(0)
+########################################
 
-    def insert(self, elem):
-        bisect.insort_right(self.list, elem)
+METRICS = metrics_util.Metrics('ccerbd_')
+JOB_RATE = metrics_util.RateMeter()
+
+METRICS.counter('jobs_total', 'Jobs served, by job key and how.')
+METRICS.counter('input_bytes_total', 'Job input bytes received, by job key.')
+METRICS.counter('output_bytes_total', 'Job output bytes sent, by job key.')
+METRICS.counter('shim_outs_total', 'Local compiles run by the shim itself, by reason.')
+METRICS.counter('chunked_input_bytes_total', 'Job input bytes received as chunk'
+                ' manifests, by job key and whether they had to be sent.')
+METRICS.histogram('phase_seconds', 'Job latency, by phase.')
+
+def sample_sched():
+    ret = []
+    for (priority, counts) in sorted(SCHED.counts_by_priority().items()):
+        for (state, count) in zip(['active', 'pending'], counts):
+            ret.append(((('priority', priority), ('state', state)), count))
+    return ret
+
+METRICS.sampled('sched_jobs', 'gauge', 'Scheduled jobs, by priority and state.',
+                sample_sched)
+METRICS.sampled('slots', 'gauge', 'Job slots, as currently advertised.',
+                lambda: [((), SCHED.max_slots)])
+METRICS.sampled('slot_utilization', 'gauge', 'Fraction of job slots in use.',
+                lambda: [((), float(SCHED.counts()[0]) / SCHED.max_slots)])
+METRICS.sampled('jobs_per_second', 'gauge', 'Jobs served per second, over the last'
+                ' {:g}s.'.format(metrics_util.RATE_WINDOW),
+                lambda: [((), JOB_RATE.rate())])
+if HEADER_STORE:
+    METRICS.sampled('pump_headers_total', 'counter', 'Pump job sources and headers,'
+                    ' by whether the header store had them.',
+                    lambda: [((('how', 'hit'), ), HEADER_STORE.hits),
+                             ((('how', 'miss'), ), HEADER_STORE.misses)])
+METRICS.sampled('log_lines_total', 'counter', 'Log lines printed or written.',
+                lambda: [((), LOG_SINK.lines)])
+METRICS.sampled('log_dropped_total', 'counter', 'Log lines dropped, by where.',
+                lambda: [((('where', 'ccerbd'), ), LOG_SINK.dropped),
+                         ((('where', 'shim'), ), LOG_SINK.sender_dropped)])
+if HEDGER:
+    METRICS.sampled('hedges_total', 'counter', 'Forwarded jobs run a second time.',
+                    lambda: [((), HEDGER.hedges)])
+    METRICS.sampled('hedge_wins_total', 'counter', 'Hedged jobs where the second run'
+                    ' finished first.', lambda: [((), HEDGER.hedge_wins)])
+
+
+TRACER = trace_util.Tracer(TRACE_DIR, HOST_INFO, 'ccerbd', TRACE_MAX_MB * 1024 * 1024)
+
+def record_phase(phase, start):
+    # Returns the time now, to start the next phase from.
+    now = time.time()
+    METRICS.observe('phase_seconds', (('phase', phase),), now - start)
+    TRACER.add(phase, start, now)
+    return now
+
+
+def files_bytes(files):
+    # `files` as (name, path). Cached files may be evicted meanwhile.
+    total = 0
+    for (_, path) in files:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
 
-    def remove(self, elem):
-        self.list.remove(elem)
 
-####
+def record_job(job_key, how, input_files, result):
+    (_, outdata, errdata, output_files) = result
+    input_bytes = files_bytes(input_files)
+    output_bytes = len(outdata) + len(errdata) + files_bytes(output_files)
 
-class Scheduler:
-    def __init__(self, slots):
-        self.max_slots = slots
-        self.lock = threading.Lock()
-        self.pending = PriorityQueue()
-        self.active = set()
+    labels = (('job_key', job_key), )
+    METRICS.add('jobs_total', labels + (('how', how), ))
+    METRICS.add('input_bytes_total', labels, input_bytes)
+    METRICS.add('output_bytes_total', labels, output_bytes)
+    JOB_RATE.mark()
+    return
+
+
+def record_dedup(job_key, link, was):
+    # `was` is (link.chunked_bytes, link.deduped_bytes) from before the job's inputs.
+    chunked_bytes = link.chunked_bytes - was[0]
+    if not chunked_bytes:
         return
+    deduped_bytes = link.deduped_bytes - was[1]
+    labels = (('job_key', job_key), )
+    METRICS.add('chunked_input_bytes_total', labels + (('how', 'deduped'), ),
+                deduped_bytes)
+    METRICS.add('chunked_input_bytes_total', labels + (('how', 'sent'), ),
+                chunked_bytes - deduped_bytes)
+    return
 
+########################################
 
-    def _process(self):
-        try:
-            while len(self.active) < self.max_slots:
-                cur = self.pending.pop()
-                self.active.add(cur)
-                cur.ready_event.set()
-        except IndexError:
-            pass
+CANCEL_POLL_INTERVAL = 0.1
 
+class ExJobCancelled(Exception):
+    pass
 
-    def enqueue(self, priority, info):
-        return Scheduler.TimeSlot(self, priority, info)
 
+def wait_for(conn, wait_func):
+    # Calls wait_func(timeout) until it returns True, sending heartbeats meanwhile.
+    # Raises ExJobCancelled if the client cancels first.
+    heartbeat_interval = conn.gettimeout() * 0.5
+    next_heartbeat = time.time() + heartbeat_interval
+    while not wait_func(CANCEL_POLL_INTERVAL):
+        if net_util.is_readable(conn):
+            net_util.recv_byte(conn) # JOB_CANCEL
+            raise ExJobCancelled()
 
-    ####
+        now = time.time()
+        if now >= next_heartbeat:
+            net_util.send_byte(conn, 0)
+            next_heartbeat = now + heartbeat_interval
+        continue
 
-    class TimeSlot:
-        def __init__(self, scheduler, priority, info):
-            self.scheduler = scheduler
-            self.priority = priority
-            self.info = info
-            self.ready_event = threading.Event()
-            return
 
+def grant(conn, state):
+    # The client may have cancelled before seeing `state`.
+    net_util.send_byte(conn, state)
+    if net_util.recv_byte(conn) != ccerb.JOB_START:
+        raise ExJobCancelled()
 
-        def __lt__(self, x):
-            return self.priority < x.priority
 
+def get_status(job_key):
+    (active, pending) = SCHED.counts()
+    max_slots = SCHED.max_slots
+    return ccerb.RemoteStatus(job_key in JOB_MAP, max(max_slots - active, 0), max_slots,
+                              pending, SPEED)
 
-        def __enter__(self):
-            with self.scheduler.lock:
-                self.scheduler.pending.insert(self)
-                self.scheduler._process()
-            return self
 
+def send_status(conn):
+    job_key = str(net_util.recv_buffer(conn))
+    ccerb.send_status(conn, get_status(job_key))
+    return
 
-        def acquire(self, timeout=None):
-            return self.ready_event.wait(timeout)
+####
 
+def forward_job(conn, link, info):
+    start = time.time()
+    job_key = str(net_util.recv_buffer(conn))
+    local_priority = net_util.recv_byte(conn) # 0 if the client won't compile locally.
+    remote_priority = net_util.recv_byte(conn)
+    digest = str(net_util.recv_buffer(conn))
+    (job_args, output_names) = ccerb.recv_job_args(conn, link)
+
+    with WORKSPACES.acquire() as in_dir, WORKSPACES.acquire() as out_dir, \
+         WORKSPACES.acquire_lazy() as hedge_dir:
+        input_names = ccerb.recv_files_to_dir(conn, in_dir.path, link, in_dir.max_bytes)
+        record_phase('recv_inputs', start)
+
+        cached = None
+        if digest and RESULT_CACHE:
+            cached = RESULT_CACHE.lookup(digest)
+        try:
+            with net_util.WaitBeacon(conn) as beacon:
+                output = None
+                if link.version >= 3:
+                    output = JobOutput(link, beacon, False)
+                result = cached or forward_or_run(info, job_key, local_priority,
+                                                  remote_priority, digest, job_args,
+                                                  output_names, in_dir, input_names,
+                                                  out_dir.path, hedge_dir, beacon,
+                                                  output)
+
+            if not result:
+                net_util.send_byte(conn, ccerb.FORWARD_FAILED)
+                return
+            start = time.time()
+            frame = net_util.Frame()
+            net_util.send_byte(frame, ccerb.FORWARD_OK)
+            send_job_result(conn, link, *result, frame=frame)
+            record_phase('send_outputs', start)
+        finally:
+            if cached:
+                RESULT_CACHE.unpin(digest)
+        input_files = [(x, os.path.join(in_dir.path, x)) for x in input_names]
+        record_job(job_key, 'forward', input_files, result)
+
+    if REMOTE_POOL:
+        ccerb.v_log(3, '<<remote pool: {}>>', REMOTE_POOL.summary())
+    if HEDGER:
+        ccerb.v_log(3, '<<hedging: {}>>', HEDGER.summary())
+    return
 
-        def __exit__(self, ex_type, ex_val, ex_traceback):
-            with self.scheduler.lock:
-                try:
-                    self.scheduler.active.remove(self)
-                except KeyError:
-                    self.scheduler.pending.remove(self)
-                self.scheduler._process()
 
+def forward_or_run(info, job_key, local_priority, remote_priority, digest, job_args,
+                   output_names, in_workspace, input_names, out_dir, hedge_dir, beacon,
+                   output):
+    in_dir = in_workspace.path
+    can_run_local = bool(local_priority) and job_key in JOB_BINS
+
+    candidates = []
+    if REMOTE_POOL:
+        candidates = REMOTE_POOL.choose(job_key)
+
+    if candidates and can_run_local:
+        local_score = ccerb.status_score(get_status(job_key))
+        if local_score <= ccerb.status_score(candidates[0][3]):
+            candidates = [] # Not worth the trip.
+
+    for (addr, remote_conn, remote_link, _) in candidates[1:]:
+        REMOTE_POOL.put(addr, remote_conn, remote_link)
+
+    if candidates:
+        ccerb.v_log(2, '[{}] forwarding to {}', info, candidates[0][0])
+        input_bytes = sum([os.path.getsize(os.path.join(in_dir, x)) for x in input_names])
+        hedge_secs = None
+        if HEDGER:
+            hedge_secs = HEDGER.hedge_secs(job_key, input_bytes)
+
+        if hedge_secs is not None:
+            result = run_hedged(info, candidates[0], hedge_secs, job_key, local_priority,
+                                remote_priority, digest, job_args, output_names, in_dir,
+                                input_names, out_dir, hedge_dir, can_run_local)
+        else:
+            start = time.time()
+            # Output streamed before a remote fails is repeated by the local run.
+            result = REMOTE_POOL.run(candidates[0], job_key, remote_priority, digest,
+                                     job_args, output_names, in_dir, input_names, out_dir,
+                                     output, TRACER.current())
+            end = time.time()
+            TRACER.add('forward', start, end, {'addr': str(candidates[0][0])})
+            if result and HEDGER:
+                HEDGER.record(job_key, input_bytes, end - start)
+        if result:
+            return result
+
+    if not can_run_local:
+        return None
+
+    job_digest = None
+    if RESULT_CACHE:
+        job_digest = ccerb.job_digest_dir(job_key, job_args, in_dir, input_names)
+
+    if output:
+        output.keep = bool(job_digest)
+
+    start = time.time()
+    with SCHED.enqueue(local_priority, info) as timeslot:
+        timeslot.acquire()
+        record_phase('wait_for_slot', start)
+        args = [JOB_BINS[job_key]] + job_args
+        result = run_in_workspace(in_workspace, input_names, output_names, args, beacon,
+                                  output)
+
+    if job_digest and result[0] == 0:
+        store_result(job_digest, *result, output=output)
+    return result
 
 ####
 
-SCHED = Scheduler(SLOT_COUNT)
+class Cancel:
+    # Stands in for run_in_dir's beacon in a hedged attempt, to kill it if it loses.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.is_set = False
+        self.on_error = None
+        return
 
-########################################
 
-def acquire_and_run(conn, info):
+    def set_on_error(self, on_error):
+        with self.lock:
+            self.on_error = on_error
+            if not self.is_set:
+                return
+        on_error()
+
+
+    def cancel(self):
+        with self.lock:
+            self.is_set = True
+            on_error = self.on_error
+        if on_error:
+            on_error()
+
+
+def choose_hedge(job_key, primary_addr, can_run_local):
+    # Returns a remote candidate other than `primary_addr`, True to hedge locally, or
+    # None if there's nowhere to hedge.
+    best = None
+    for (addr, remote_conn, remote_link, status) in REMOTE_POOL.choose(job_key):
+        if best or addr == primary_addr:
+            REMOTE_POOL.put(addr, remote_conn, remote_link)
+            continue
+        best = (addr, remote_conn, remote_link, status)
+
+    if can_run_local:
+        local_score = ccerb.status_score(get_status(job_key))
+        if not best or local_score <= ccerb.status_score(best[3]):
+            if best:
+                REMOTE_POOL.put(*best[:3])
+            return True
+    return best
+
+
+def stop_remote(conn):
+    # Only shut down: if the attempt finished anyway, its connection may be back in
+    # the pool, which then sees it hung up.
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    return
+
+
+def run_hedged(info, candidate, hedge_secs, job_key, local_priority, remote_priority,
+               digest, job_args, output_names, in_dir, input_names, out_dir, hedge_dir,
+               can_run_local):
+    # Runs on `candidate`, and if that takes over `hedge_secs`, on another remote or
+    # locally too. The first result wins, and the other is cancelled. Output isn't
+    # streamed, since either might win. `hedge_dir` is a LazyWorkspace, taken only
+    # for a remote hedge.
+    input_bytes = sum([os.path.getsize(os.path.join(in_dir, x)) for x in input_names])
+    trace_id = TRACER.current()
+    future = ccerb.Future()
+    lock = threading.Lock()
+    attempts = dict() # name -> (thread, cancel_func)
+    done = set()
+    left = [0]
+
+    def attempt(name, run):
+        TRACER.set_trace_id(trace_id)
+        start = time.time()
+        result = run()
+        TRACER.add(name, start, time.time(), {'ok': bool(result)})
+        with lock:
+            done.add(name)
+            left[0] -= 1
+            if result:
+                HEDGER.record(job_key, input_bytes, time.time() - start)
+                future.accept((name, result))
+            elif not left[0]:
+                future.reject()
+        return
+
+    def launch(name, run, cancel_func):
+        with lock:
+            if future.is_resolved():
+                return
+            left[0] += 1
+            t = net_util.spawn_thread(attempt, (name, run))
+            attempts[name] = (t, cancel_func)
+        return
+
+    def run_remote(candidate, out_dir):
+        return lambda: REMOTE_POOL.run(candidate, job_key, remote_priority, digest,
+                                       job_args, output_names, in_dir, input_names,
+                                       out_dir, None, trace_id)
+
+    launch('primary', run_remote(candidate, out_dir), lambda: stop_remote(candidate[1]))
+
+    if not future.event.wait(hedge_secs):
+        hedge = choose_hedge(job_key, candidate[0], can_run_local)
+        HEDGER.record_hedge(bool(hedge))
+        if hedge is True:
+            ccerb.v_log(2, '[{}] hedging locally after {:.1f}s', info, hedge_secs)
+            cancel = Cancel()
+            def run_local():
+                with SCHED.enqueue(local_priority, info) as timeslot:
+                    while not timeslot.acquire(CANCEL_POLL_INTERVAL):
+                        if cancel.is_set:
+                            return None
+                    args = [JOB_BINS[job_key]] + job_args
+                    result = run_in_dir(in_dir, input_names, output_names, args, cancel)
+                if cancel.is_set:
+                    return None # Killed.
+                return result
+            launch('hedge', run_local, cancel.cancel)
+        elif hedge:
+            ccerb.v_log(2, '[{}] hedging on {} after {:.1f}s', info, hedge[0], hedge_secs)
+            launch('hedge', run_remote(hedge, hedge_dir.path()),
+                   lambda: stop_remote(hedge[1]))
+
+    try:
+        (winner, result) = future.await()
+    except ccerb.Future.Rejection:
+        return None
+
+    # The losers must be gone before their workspaces are reused.
+    with lock:
+        losers = [(name not in done, x) for (name, x) in attempts.items()
+                  if name != winner]
+    for (is_running, (t, cancel_func)) in losers:
+        if is_running:
+            cancel_func()
+        t.join()
+    if winner == 'hedge':
+        HEDGER.record_hedge_win()
+    return result
+
+####
+
+def acquire_and_run(conn, link, info):
     try:
         job_key = str(net_util.recv_buffer(conn))
     except (net_util.ExSocketClosed, socket.error):
         # This is a graceful exit.
         return False
 
+    if job_key == 'status':
+        send_status(conn)
+        return True
+
+    if job_key == 'trace':
+        TRACER.set_trace_id(str(net_util.recv_buffer(conn)))
+        try:
+            return acquire_and_run(conn, link, info)
+        finally:
+            TRACER.set_trace_id(None)
+
+    if job_key == 'shim_out':
+        reason = str(net_util.recv_buffer(conn))
+        ccerb.v_log(1, '<{}: shim out: \'{}\'>', info, reason)
+        # Keep exception messages out of the labels.
+        METRICS.add('shim_outs_total', (('reason', reason.split('(')[0]), ))
+        return True
+
+    if job_key == 'mux' and not isinstance(conn, mux_util.MuxStream):
+        serve_mux(conn, link, info)
+        return False
+
+    if job_key == 'forward':
+        try:
+            forward_job(conn, link, info)
+        except (ccerb.ExTooLarge, ccerb.ExBadChunk) as e:
+            locked_print('[{}] Rejected forward: {}'.format(info, e))
+            return False
+        return True
+
+    is_pump = (job_key == 'pump')
+    if is_pump:
+        job_key = str(net_util.recv_buffer(conn))
+        if not HEADER_STORE:
+            net_util.recv_byte(conn) # priority
+            net_util.recv_buffer(conn) # digest
+            ccerb.v_log(2, '[{}] refused pump job: no header store', info)
+            net_util.send_byte(conn, ccerb.JOB_NO_PUMP)
+            return True
+
     try:
         job_func = JOB_MAP[job_key]
+        job_bin = JOB_BINS[job_key] if is_pump else None
     except KeyError:
         locked_print('[{}] Unrecognized job_key: {}'.format(info, job_key))
         return False
 
     priority = net_util.recv_byte(conn)
+    digest = str(net_util.recv_buffer(conn))
+    if is_pump:
+        def job_func(conn, link):
+            return run_pump_job_server(conn, link, job_bin, job_key, digest)
 
-    with SCHED.enqueue(priority, info) as timeslot:
-        while not timeslot.acquire(conn.gettimeout() * 0.5):
-            net_util.send_byte(conn, 0)
-        net_util.send_byte(conn, 1)
-
-        job_func(conn)
+    is_cache_owner = False
+    try:
+        if digest and RESULT_CACHE:
+            result = await_cached_result(conn, digest)
+            if result:
+                ccerb.v_log(2, '[{}] result cache hit: {}', info, digest)
+                try:
+                    grant(conn, ccerb.JOB_CACHED)
+                    start = time.time()
+                    send_job_result(conn, link, *result)
+                    record_phase('send_outputs', start)
+                finally:
+                    RESULT_CACHE.unpin(digest)
+                record_job(job_key, 'cached', [], result)
+                ccerb.v_log(3, '<<result cache: {}>>', RESULT_CACHE.summary())
+                return True
+            is_cache_owner = True
+
+        start = time.time()
+        with SCHED.enqueue(priority, info) as timeslot:
+            wait_for(conn, timeslot.acquire)
+            record_phase('wait_for_slot', start)
+            grant(conn, ccerb.JOB_READY)
+
+            job_func(conn, link)
+    except ExJobCancelled:
+        ccerb.v_log(3, '<<[{}] cancelled {}>>', info, job_key)
+        try:
+            net_util.send_byte(conn, ccerb.JOB_CANCELLED)
+        except socket.error:
+            return False # The client didn't stick around for the ack.
+    except (ccerb.ExTooLarge, ccerb.ExBadChunk, header_store.ExBadHeader) as e:
+        # The rest of the input is still in flight, so drop the connection.
+        locked_print('[{}] Rejected {}: {}'.format(info, job_key, e))
+        return False
+    finally:
+        if is_cache_owner:
+            RESULT_CACHE.release(digest)
     return True
 
+
+def serve_mux(conn, link, info):
+    # From here on the connection carries a stream per concurrent job, each served
+    # on a thread of its own, like a connection of its own.
+    net_util.send_byte(conn, ccerb.MUX_OK)
+
+    def on_stream(stream):
+        if not MUX_STREAM_SLOTS.acquire(False):
+            ccerb.v_log(1, '<mux({}): over max_mux_streams, closing #{}>', info,
+                        stream.id)
+            stream.close()
+            return
+        stream_link = ccerb.Link(link.codec, link.version, link.hello)
+        stream_link.chunks = link.chunks
+        stream_info = '{}#{}'.format(info, stream.id)
+        net_util.spawn_thread(serve_stream, (stream, stream_link, stream_info))
+
+    session = mux_util.MuxSession(conn, on_stream)
+    session.run()
+    ccerb.v_log(2, '<~mux({}): {} streams>', info, session.opened)
+    return
+
+
+def serve_stream(stream, link, info):
+    try:
+        while acquire_and_run(stream, link, info):
+            continue
+    except (socket.error, net_util.ExSocketClosed) as e:
+        ccerb.v_log(2, '<stream {} failed: {}>', info, e)
+    finally:
+        MUX_STREAM_SLOTS.release()
+    net_util.kill_socket(stream)
+    return
+
+
+def await_cached_result(conn, digest):
+    # Returns the cached result, pinned (see ResultCache.lookup), or None once this
+    # connection owns the compile.
+    # Identical requests arriving while another connection compiles wait for it.
+    while True:
+        result = RESULT_CACHE.lookup(digest)
+        if result:
+            return result
+
+        event = RESULT_CACHE.claim(digest)
+        if not event:
+            return None
+
+        wait_for(conn, event.wait)
+        continue
+
 ########################################
 
-def accept(conn, host_info):
+def accept(conn, link, host_info):
+    # Between jobs the connection is parked on the event loop, not holding a thread.
+    # Jobs wait for slots and run on threads of their own, not the loop's pool.
     start = time.time()
-    while acquire_and_run(conn, host_info):
-        continue
+    def next_job(conn):
+        if acquire_and_run(conn, link, host_info):
+            return blocking
 
-    diff = time.time() - start
-    diff = int(diff * 1000)
-    ccerb.v_log(2, '<~accept({}): {}ms>', host_info, diff)
-    return
+        diff = time.time() - start
+        diff = int(diff * 1000)
+        ccerb.v_log(2, '<~accept({}): {}ms>', host_info, diff)
+        return None
+
+    blocking = net_util.Blocking(next_job)
+    return blocking
 
 
 def accept_public(conn, addr):
     ccerb.v_log(2, 'accept_public({})', addr)
+    net_util.set_nodelay(conn)
 
     host_info = str(net_util.recv_buffer(conn))
     host_info = '{}@{}'.format(host_info, addr)
-    accept(conn, host_info)
-    return
+    link = ccerb.link_handshake_server(conn)
+    if CHUNK_CACHES:
+        link.chunks = CHUNK_CACHES.get(addr[0])
+    return accept(conn, link, host_info)
 
 
 def accept_local(conn, addr):
     ccerb.v_log(3, 'accept_local({})', addr)
+    net_util.set_nodelay(conn)
 
-    ccerbdd_addr = None
-    net_util.send_pickle(conn, ccerbdd_addr)
-
+    net_util.send_buffer(conn, ccerb.LEGACY_LOCAL_HELLO)
+    link = ccerb.link_handshake_server(conn, LOCAL_HELLO)
     host_info = 'localhost'
-    accept(conn, host_info)
-    return
+    return accept(conn, link, host_info)
+
+########################################
+
+MAX_METRICS_REQUEST = 64 * 1024
+
+def accept_metrics(conn, addr):
+    # Any request gets the metrics: enough for curl and Prometheus.
+    request = ''
+    try:
+        while '\r\n\r\n' not in request and len(request) < MAX_METRICS_REQUEST:
+            data = conn.recv(4096)
+            if not data:
+                break
+            request += data
+    except socket.error:
+        pass
+
+    body = METRICS.render()
+    try:
+        conn.sendall('HTTP/1.0 200 OK\r\n'
+                     'Content-Type: text/plain; version=0.0.4\r\n'
+                     'Content-Length: {}\r\n\r\n'.format(len(body)) + body)
+    except socket.error:
+        pass # The scraper hung up.
+    return None
 
 ########################################
 
 log_counter = itertools.count(1)
 
 def accept_log(conn, addr):
+    # Shims from before log datagrams connect, and send their lines one at a time.
     conn.settimeout(None)
+    source = 'c{}'.format(next(log_counter))
 
-    lines = []
+    def read_lines(conn):
+        lines = []
+        try:
+            while True:
+                lines.append(unicode(net_util.recv_buffer(conn)))
+                if not net_util.is_readable(conn):
+                    LOG_SINK.put(source, lines)
+                    return read_lines
+        except (net_util.ExSocketClosed, socket.error):
+            pass
+        LOG_SINK.put(source, lines)
+        return None
 
-    try:
-        while True:
-            lines.append(unicode(net_util.recv_buffer(conn)))
-    except (net_util.ExSocketClosed, socket.error):
-        pass
+    return read_lines
 
-    if not lines:
-        return
+########################################
+
+def govern_slots():
+    # Doesn't return. The scheduler signals a change, so the directory hears of it,
+    # and shims and forwarders see it in the next status they ask for.
+    while True:
+        time.sleep(load_util.SAMPLE_INTERVAL)
+        (active, _) = SCHED.counts()
+        slots = SLOT_GOVERNOR.update(load_util.Sample(), active)
+        if slots is None:
+            continue
+        SCHED.set_max_slots(slots)
+        ccerb.v_log(2, '<slots: {}>', SLOT_GOVERNOR.summary())
+        continue
 
-    log_id = next(log_counter)
-    prefix = u'[log {}] '.format(log_id)
-    sep = u'\n' + prefix
-    text = prefix + sep.join(lines)
+########################################
 
-    locked_print(text)
-    return
+DIRECTORY_KEEPALIVE = 10.0
+DIRECTORY_MIN_INTERVAL = 0.02 # Coalesces bursts of scheduler changes.
+DIRECTORY_RETRY_INTERVAL = 5.0
+
+def advertise_to_directory():
+    # Keeps the directory's view of our load current, reconnecting as needed.
+    job_keys = list(JOB_BINS)
+    while True:
+        try:
+            conn = ccerb.directory_connect(DIRECTORY_ADDR, ccerb.DIRECTORY_WORKER)
+        except socket.error as e:
+            ccerb.v_log(1, '<directory {} unreachable: {}>', DIRECTORY_ADDR, e)
+            time.sleep(DIRECTORY_RETRY_INTERVAL)
+            continue
+
+        try:
+            ccerb.register_worker(conn, PUBLIC_HOST, PUBLIC_PORT, job_keys)
+            last = None
+            while True:
+                SCHED.changed.clear()
+                status = get_status(None)._replace(has_job_key=True)
+                if status != last:
+                    ccerb.send_status(conn, status)
+                    last = status
+
+                if not SCHED.changed.wait(DIRECTORY_KEEPALIVE):
+                    last = None
+                time.sleep(DIRECTORY_MIN_INTERVAL)
+                continue
+        except socket.error as e:
+            ccerb.v_log(1, '<lost directory {}: {}>', DIRECTORY_ADDR, e)
+        net_util.kill_socket(conn)
+        time.sleep(DIRECTORY_RETRY_INTERVAL)
+        continue
 
 ########################################
 
 ccerb.nice_down()
 
-net_util.spawn_thread(net_util.serve_forever, (PUBLIC_ADDR, accept_public))
-net_util.spawn_thread(net_util.serve_forever, (ccerb.CCERBD_LOCAL_ADDR, accept_local))
-net_util.spawn_thread(net_util.serve_forever, (ccerb.CCERBD_LOG_ADDR, accept_log))
+LOOP = net_util.EventLoop(max_workers=int(CONFIG[None].get('max_threads', 256)),
+                          max_connections=int(CONFIG[None].get('max_connections', 4096)),
+                          backlog=int(CONFIG[None].get('listen_backlog',
+                                                       net_util.LISTEN_BACKLOG)))
+LOOP.listen(PUBLIC_ADDR, accept_public)
+LOOP.listen(ccerb.CCERBD_LOCAL_ADDR, accept_local)
+LOOP.listen(ccerb.CCERBD_LOG_ADDR, accept_log)
+net_util.spawn_thread(log_util.serve_datagrams, (ccerb.CCERBD_LOG_ADDR, LOG_SINK))
+if METRICS_PORT:
+    LOOP.listen((METRICS_HOST, METRICS_PORT), accept_metrics)
+net_util.spawn_thread(LOOP.run_forever, ())
+
+if DIRECTORY_ADDR:
+    net_util.spawn_thread(advertise_to_directory, ())
+
+if SLOT_GOVERNOR:
+    net_util.spawn_thread(govern_slots, ())
+
+if TRACE_DIR:
+    if not os.path.isdir(TRACE_DIR):
+        os.makedirs(TRACE_DIR)
+    net_util.spawn_thread(TRACER.flush_every, (TRACE_FLUSH_INTERVAL, ))
 
 ####
 
 net_util.sleep_until_keyboard()
+LOG_SINK.flush()
+TRACER.flush()
+WORKSPACES.close()
 exit(0)
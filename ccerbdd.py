@@ -2,146 +2,261 @@
 from __future__ import print_function
 assert __name__ == '__main__'
 
-from collections import namedtuple
-
-import marshal
-import math
-import multiprocessing
-import os
-import shutil
+import heapq
+import itertools
 import socket
-import subprocess
-import sys
-import tempfile
-import time
 import threading
-import uuid
+import time
 
 import ccerb
-import schedaemon
 import net_util
 
-####
+####################
 
-service_map = dict()
+CONFIG = ccerb.parse_ini(ccerb.CONFIG_PATH)
 
-conn_list_lock = threading.Lock()
-conn_list = []
+DIRECTORY_PORT = int(CONFIG[None].get('directory_port', ccerb.CCERBDD_PORT))
+DIRECTORY_ADDR = ('', DIRECTORY_PORT)
 
-####
+# Most workers one query may ask for.
+MAX_QUERY_COUNT = 8
+
+STATS_INTERVAL = 10.0
+
+####################
 
+print_lock = threading.Lock()
+
+def locked_print(*args, **kwargs):
+    with print_lock:
+        print(*args, **kwargs)
+
+ccerb.print_func = locked_print
+
+####################
 
 class Worker:
-    def __init(self, addr, slots):
+    def __init__(self, addr, job_keys):
         self.addr = addr
-        self.remaining_slots = slots
+        self.job_keys = job_keys
+        self.status = None
+        self.version = 0
+        self.is_live = True
         return
 
-job_queue_map = WeakValueDictionary()
-global_queue_lock = threading.Lock()
 
-class Job:
-    id_counter = count(1)
+    def lease(self):
+        # Until the worker's next status, assume the client's job landed there.
+        s = self.status
+        if s.free_slots:
+            self.status = s._replace(free_slots=s.free_slots - 1)
+        else:
+            self.status = s._replace(pending=s.pending + 1)
 
-    def __init__(self, info):
-        self.id = next(id_counter)
-        self.worker = ccerb.Future()
-        return
 
+def _is_current(entry):
+    (_, _, version, worker) = entry
+    return worker.is_live and worker.version == version
 
-class JobQueue:
+
+class WorkerQueue:
+    # Min-heap of (score, seq, version, worker) over the workers with one job key.
+    # A worker is pushed again whenever its score changes, which makes its older
+    # entries stale. Stale entries are skipped by pop(), or dropped once they
+    # outnumber current ones.
     def __init__(self):
-        self.queue = collections.deque()
+        self.heap = []
+        self.workers = 0
         return
 
 
-    def next_id(self):
-        try:
-            return self.queue[0].id
-        except IndexError:
-            return float('+inf') # Sort empty queues to the back.
+    def push(self, worker, seq):
+        heapq.heappush(self.heap, (ccerb.status_score(worker.status), seq,
+                                   worker.version, worker))
 
+        if len(self.heap) > 2 * self.workers + 64:
+            self.heap = [x for x in self.heap if _is_current(x)]
+            heapq.heapify(self.heap)
+        return
 
-    def __del__(self):
-        for job in self.queue:
-            job.worker.reject()
+
+    def pop(self):
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if _is_current(entry):
+                return entry[3]
+        return None
+
+####
+
+lock = threading.Lock()
+queue_map = dict() # job_key -> WorkerQueue
+worker_map = dict() # addr -> Worker
+
+# Among equal scores, the least recently pushed worker comes first, so ties rotate.
+push_seq = itertools.count()
+
+query_count = [0]
+
+
+def update_worker(worker):
+    worker.version += 1
+    if not worker.status or not worker.is_live:
+        return # A replaced worker's queues may be gone.
+    seq = next(push_seq)
+    for job_key in worker.job_keys:
+        queue_map[job_key].push(worker, seq)
+    return
+
+
+def add_worker(worker):
+    old = worker_map.get(worker.addr)
+    if old:
+        remove_worker(old) # Reconnected before we noticed the old connection die.
+    worker_map[worker.addr] = worker
+
+    for job_key in worker.job_keys:
+        queue_map.setdefault(job_key, WorkerQueue()).workers += 1
+    return
+
+
+def remove_worker(worker):
+    if not worker.is_live:
         return
+    worker.is_live = False
+    del worker_map[worker.addr]
+
+    for job_key in worker.job_keys:
+        queue = queue_map[job_key]
+        queue.workers -= 1
+        if not queue.workers:
+            del queue_map[job_key]
+    return
 
 
-    def await_worker(self, info):
-        job = Job(info)
-        with global_queue_lock:
-            if not self.queue:
-                return None
-            self.queue.append(job)
+def choose_workers(job_key, count):
+    # Each lookup costs O(log n) in the workers with `job_key`, plus re-pushing each
+    # chosen worker under each of its job keys.
+    query_count[0] += 1
+    queue = queue_map.get(job_key)
+    if not queue:
+        return []
 
-        try:
-            return job.worker.await()
-        except ccerb.Future.Rejection:
-            return None
+    chosen = []
+    while len(chosen) < count:
+        worker = queue.pop()
+        if not worker:
+            break
+        chosen.append(worker)
+
+    ret = [(x.addr, x.status) for x in chosen]
+    for worker in chosen:
+        worker.lease()
+        update_worker(worker)
+    return ret
 
+####################
 
-def get_next_job(job_queue_list):
-    with global_queue_lock:
-        next_job_queue = min(job_queue_list, key=JobQueue.next_id)
+def accept_worker(conn, addr):
+    host = str(net_util.recv_buffer(conn))
+    port = net_util.recv_struct(conn, '<H')
+    job_keys = str(net_util.recv_buffer(conn)).split('\0')
+    if not host:
+        host = addr[0]
+
+    worker = Worker((host, port), job_keys)
+    with lock:
+        add_worker(worker)
+    ccerb.v_log(1, '<worker {} joined with {} job keys>', worker.addr, len(job_keys))
+
+    def read_status(conn):
         try:
-            return next_job_queue.popleft()
-        except IndexError:
+            while True:
+                status = ccerb.recv_status(conn)
+                if not net_util.is_readable(conn):
+                    break
+        except (net_util.ExSocketClosed, socket.error):
+            with lock:
+                remove_worker(worker)
+            ccerb.v_log(1, '<worker {} left>', worker.addr)
             return None
 
-####
-
-Worker = namedtuple('Worker', 'info, payload')
+        with lock:
+            worker.status = status
+            update_worker(worker)
+            if not worker.is_live:
+                return None # Replaced by a reconnect.
+        return read_status
 
-####
+    return read_status
 
-def accept_worker(conn, addr):
-    info = str(net_util.recv_buffer(conn))
-    payload = net_util.recv_buffer(conn)
-    worker = Worker(info, payload)
 
-    job_keys = net_util.recv_buffer(conn)
-    job_keys = job_keys.split('\0')
+def accept_job(conn, addr):
+    def next_query(conn):
+        try:
+            job_key = str(net_util.recv_buffer(conn))
+            count = net_util.recv_byte(conn)
+        except (net_util.ExSocketClosed, socket.error):
+            return None
 
-    job_queue_list = [job_queue_map.setdefault(x, JobQueue()) for x in job_keys]
+        with lock:
+            chosen = choose_workers(job_key, min(count, MAX_QUERY_COUNT))
 
-    while True:
-        net_util.recv_poke(conn)
-        job = get_next_job(job_queue_list)
-        if not job:
-            continue;
+        frame = net_util.Frame()
+        net_util.send_byte(frame, len(chosen))
+        for ((host, port), status) in chosen:
+            net_util.send_buffer(frame, host)
+            net_util.send_struct(frame, '<H', port)
+            ccerb.send_status(frame, status)
+        frame.send(conn)
+        return next_query
 
-        job.worker.accept(worker)
-        continue
+    return next_query
 
-    return
 
-####
+def accept(conn, addr):
+    net_util.set_nodelay(conn)
 
-def accept_job(conn, addr):
-    info = str(net_util.recv_buffer(conn))
-    job_key = net_util.recv_buffer(conn)
-    job_info = '{}@{}'.format(info, addr)
+    role = str(net_util.recv_buffer(conn))
+    if role == ccerb.DIRECTORY_WORKER:
+        return accept_worker(conn, addr)
+    if role == ccerb.DIRECTORY_CLIENT:
+        return accept_job(conn, addr)
 
-    try:
-        job_queue = job_queue_map[job_key]
-    except KeyError:
-        return
+    ccerb.v_log(1, '<{}: unrecognized role: {}>', addr, role)
+    return None
 
-    worker = job_queue.acquire_worker(job_info)
-    if not worker:
-        return
+####################
 
-    net_util.send_buffer(conn, worker.info)
-    net_util.send_buffer(conn, worker.payload)
-    return
+def stats_thread():
+    last_count = 0
+    last_time = time.time()
+    while True:
+        time.sleep(STATS_INTERVAL)
+        with lock:
+            count = query_count[0]
+            workers = len(worker_map)
+            job_keys = len(queue_map)
+
+        now = time.time()
+        if count != last_count:
+            ccerb.v_log(1, '<{} workers, {} job keys, {:.0f} queries/s>', workers,
+                        job_keys, (count - last_count) / (now - last_time))
+        last_count = count
+        last_time = now
+        continue
 
-####
+####################
 
-if __name__ == '__main__':
-    net_util.spawn_thread(net_util.serve_forever, (DIRECTORY_ADDR, accept))
+LOOP = net_util.EventLoop(max_workers=int(CONFIG[None].get('max_threads', 256)),
+                          max_connections=int(CONFIG[None].get('max_connections', 4096)),
+                          backlog=int(CONFIG[None].get('listen_backlog',
+                                                       net_util.LISTEN_BACKLOG)))
+LOOP.listen(DIRECTORY_ADDR, accept)
+net_util.spawn_thread(LOOP.run_forever, ())
+net_util.spawn_thread(stats_thread, ())
 
-    ####
+####
 
-    net_util.sleep_until_keyboard()
-    exit(0)
+net_util.sleep_until_keyboard()
+exit(0)
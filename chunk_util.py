@@ -0,0 +1,142 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import collections
+import hashlib
+import re
+import struct
+import threading
+import zlib
+
+####
+
+# Chunk boundaries are content-defined, so an insertion only changes the chunks
+# around it. Hashing every byte is too slow in Python, so candidates are the starts
+# of preprocessor directive lines (mostly #line, at every change of header), and a
+# candidate is a boundary if its line's crc32 has the low bits of BOUNDARY_MASK
+# clear. Data with no candidates for MAX_CHUNK_SIZE is cut at a line end.
+BOUNDARY_RE = re.compile(r'\n#[^\n]*')
+BOUNDARY_MASK = 0x7 # About one directive line in eight.
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 128 * 1024
+
+# A manifest is a chunk per MANIFEST_ENTRY: its sha1, then its size.
+MANIFEST_ENTRY = struct.Struct('<20sI')
+ID_SIZE = 20
+
+####
+
+def chunk_ends(data):
+    ends = []
+    last = 0
+    pos = MIN_CHUNK_SIZE
+    while True:
+        m = BOUNDARY_RE.search(data, pos - 1)
+        end = m.start() + 1 if m else len(data)
+        if end - last > MAX_CHUNK_SIZE:
+            cut = data.rfind('\n', last + MIN_CHUNK_SIZE, last + MAX_CHUNK_SIZE) + 1
+            last = cut or last + MAX_CHUNK_SIZE
+            ends.append(last)
+            pos = last + MIN_CHUNK_SIZE
+            continue
+        if not m:
+            break
+        pos = m.end() + 1
+        if not zlib.crc32(m.group()) & BOUNDARY_MASK:
+            ends.append(end)
+            last = end
+            pos = end + MIN_CHUNK_SIZE
+        continue
+
+    if last < len(data):
+        ends.append(len(data))
+    return ends
+
+
+def split(data):
+    # Returns [(sha1 digest, chunk)].
+    ret = []
+    start = 0
+    for end in chunk_ends(data):
+        chunk = data[start:end]
+        ret.append((hashlib.sha1(chunk).digest(), chunk))
+        start = end
+    return ret
+
+
+def pack_manifest(chunks):
+    return ''.join([MANIFEST_ENTRY.pack(x, len(chunk)) for (x, chunk) in chunks])
+
+
+def unpack_manifest(data):
+    # Returns [(sha1 digest, size)].
+    return [MANIFEST_ENTRY.unpack_from(data, pos)
+            for pos in range(0, len(data), MANIFEST_ENTRY.size)]
+
+
+def is_valid(chunk_id, chunk):
+    return hashlib.sha1(chunk).digest() == chunk_id
+
+####
+
+class ChunkCache:
+    # Chunks one peer has sent, in memory, least recently used first out.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.lru = collections.OrderedDict() # sha1 digest -> chunk
+        self.total_bytes = 0
+        return
+
+
+    def get(self, chunk_id):
+        with self.lock:
+            try:
+                chunk = self.lru.pop(chunk_id)
+            except KeyError:
+                return None
+            self.lru[chunk_id] = chunk
+            return chunk
+
+
+    def put(self, chunk_id, chunk):
+        with self.lock:
+            if chunk_id in self.lru:
+                return
+            self.lru[chunk_id] = chunk
+            self.total_bytes += len(chunk)
+            while self.total_bytes > self.max_bytes and self.lru:
+                (_, old) = self.lru.popitem(last=False)
+                self.total_bytes -= len(old)
+        return
+
+
+class PeerCaches:
+    # A ChunkCache per peer, so that no peer can fetch or crowd out another's
+    # chunks, for up to `max_peers` peers, the least recent dropped first. Peers are
+    # told apart by what they can't choose, i.e. their IP, not their host_info.
+    def __init__(self, max_bytes_per_peer, max_peers):
+        self.max_bytes_per_peer = max_bytes_per_peer
+        self.max_peers = max_peers
+        self.lock = threading.Lock()
+        self.caches = collections.OrderedDict() # peer -> ChunkCache
+        return
+
+
+    def get(self, peer):
+        with self.lock:
+            try:
+                cache = self.caches.pop(peer)
+            except KeyError:
+                cache = ChunkCache(self.max_bytes_per_peer)
+            self.caches[peer] = cache
+            while len(self.caches) > self.max_peers:
+                self.caches.popitem(last=False)
+            return cache
+
+
+    def summary(self):
+        with self.lock:
+            caches = list(self.caches.values())
+        return '{} peers, {} bytes'.format(len(caches),
+                                           sum([x.total_bytes for x in caches]))
@@ -0,0 +1,155 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import threading
+import zlib
+
+####
+
+MIN_COMPRESS_SIZE = 4 * 1024
+MIN_BANDWIDTH_SAMPLE = 256 * 1024
+
+EWMA_WEIGHT = 0.25
+EXPLORE_INTERVAL = 16
+
+########################################
+
+class LevelTuner:
+    # Picks the level minimizing estimated (compress + transfer) time per byte, given
+    # measured compression speed/ratio per level and measured link bandwidth.
+    def __init__(self, levels, start_level):
+        self.levels = levels
+        self.lock = threading.Lock()
+        self.stats = dict() # level -> (bytes_per_sec, ratio)
+        self.bandwidth = None # bytes_per_sec
+        self.cur = levels.index(start_level)
+        self.picks = 0
+        self.explore_dir = 1
+        return
+
+
+    def _est_secs_per_byte(self, level):
+        (speed, ratio) = self.stats[level]
+        return 1.0 / speed + ratio / self.bandwidth
+
+
+    def pick(self):
+        with self.lock:
+            self.picks += 1
+            if not self.bandwidth or self.levels[self.cur] not in self.stats:
+                return self.levels[self.cur]
+
+            known = [x for x in self.levels if x in self.stats]
+            best = min(known, key=self._est_secs_per_byte)
+            self.cur = self.levels.index(best)
+
+            if self.picks % EXPLORE_INTERVAL == 0:
+                # Occasionally re-measure a neighbor, since CPU load and links change.
+                i = self.cur + self.explore_dir
+                self.explore_dir = -self.explore_dir
+                if 0 <= i < len(self.levels):
+                    return self.levels[i]
+            return best
+
+
+    def record(self, level, raw_len, comp_len, comp_secs, send_secs):
+        def ewma(old, new):
+            if old is None:
+                return new
+            return old + EWMA_WEIGHT * (new - old)
+
+        with self.lock:
+            speed = raw_len / max(comp_secs, 1e-6)
+            ratio = float(comp_len) / raw_len
+            (old_speed, old_ratio) = self.stats.get(level, (None, None))
+            self.stats[level] = (ewma(old_speed, speed), ewma(old_ratio, ratio))
+
+            if send_secs is not None and comp_len >= MIN_BANDWIDTH_SAMPLE:
+                bandwidth = comp_len / max(send_secs, 1e-6)
+                self.bandwidth = ewma(self.bandwidth, bandwidth)
+        return
+
+########################################
+
+class Codec:
+    def __init__(self, name, levels, default_level, compress_func, decompress_func):
+        self.name = name
+        self.compress_func = compress_func
+        self.decompress_func = decompress_func
+        self.tuner = None
+        if levels:
+            self.tuner = LevelTuner(levels, default_level)
+        return
+
+
+    def compress(self, data, level):
+        return self.compress_func(data, level)
+
+
+    def decompress(self, data):
+        return self.decompress_func(data)
+
+####
+
+NONE_CODEC = Codec('none', None, None, None, None)
+
+def _make_codecs():
+    ret = []
+
+    try:
+        import zstandard
+        def zstd_compress(data, level):
+            return zstandard.ZstdCompressor(level=level).compress(data)
+        def zstd_decompress(data):
+            return zstandard.ZstdDecompressor().decompress(data)
+        ret.append(Codec('zstd', [1, 3, 6, 12], 3, zstd_compress, zstd_decompress))
+    except ImportError:
+        pass
+
+    try:
+        import lz4.frame
+        def lz4_compress(data, level):
+            return lz4.frame.compress(data, compression_level=level)
+        ret.append(Codec('lz4', [0, 3, 9], 0, lz4_compress, lz4.frame.decompress))
+    except ImportError:
+        pass
+
+    ret.append(Codec('zlib', [1, 3, 6, 9], 1, zlib.compress, zlib.decompress))
+    ret.append(NONE_CODEC)
+    return ret
+
+# Filled in by load(). Probing for zstandard and lz4 is slow for shims that shim out,
+# whose only link uses 'none'.
+CODECS = []
+CODEC_MAP = dict()
+load_lock = threading.Lock()
+
+def load():
+    with load_lock:
+        if not CODECS:
+            CODECS.extend(_make_codecs())
+            CODEC_MAP.update((x.name, x) for x in CODECS)
+    return
+
+####
+
+def supported_names():
+    load()
+    return [x.name for x in CODECS]
+
+
+def find(name):
+    # Returns None if `name` isn't supported here.
+    if name == NONE_CODEC.name:
+        return NONE_CODEC
+    load()
+    return CODEC_MAP.get(name)
+
+
+def choose(offered_names):
+    # The offering side lists codecs in its order of preference.
+    for name in offered_names:
+        codec = find(name)
+        if codec:
+            return codec
+    return NONE_CODEC
@@ -0,0 +1,157 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import collections
+import os
+import shutil
+import threading
+
+import ccerb
+
+####
+
+class ExBadHeader(Exception):
+    pass
+
+####
+
+class HeaderStore:
+    # Pump jobs' sources and headers, by sha1, at root_dir/ab/abcdef.... Files are
+    # linked into workspaces, so nothing must write to them there. Uses keep entries
+    # fresh in memory only: after a restart, the oldest stored go first.
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.lru = collections.OrderedDict() # sha1 -> size, oldest first
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_stored = 0
+
+        if not os.path.isdir(root_dir):
+            os.makedirs(root_dir)
+        self._load()
+        return
+
+
+    def _load(self):
+        entries = []
+        for sub_dir in os.listdir(self.root_dir):
+            for name in os.listdir(os.path.join(self.root_dir, sub_dir)):
+                path = os.path.join(self.root_dir, sub_dir, name)
+                if name.endswith('.tmp'):
+                    # Leftover from an interrupted add.
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                entries.append((st.st_mtime, name, st.st_size))
+            continue
+
+        for (_, sha1, size) in sorted(entries):
+            self.lru[sha1] = size
+            self.total_bytes += size
+        self._evict()
+        return
+
+
+    def _entry_path(self, sha1):
+        return os.path.join(self.root_dir, sha1[:2], sha1)
+
+    ####
+
+    def missing(self, hashes):
+        # Returns those of `hashes` we don't have.
+        ret = []
+        with self.lock:
+            for sha1 in hashes:
+                try:
+                    size = self.lru.pop(sha1)
+                except KeyError:
+                    ret.append(sha1)
+                    continue
+                self.lru[sha1] = size
+            self.hits += len(hashes) - len(ret)
+            self.misses += len(ret)
+        return ret
+
+
+    def add(self, sha1, src_path):
+        # Copies in the file at `src_path`, which must hash to `sha1`.
+        if ccerb.hash_file(src_path) != sha1:
+            raise ExBadHeader('{} doesn\'t match {}'.format(src_path, sha1))
+
+        path = self._entry_path(sha1)
+        tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass # Raced with another add.
+        # A copy, since `src_path` may be on another filesystem, and goes with its
+        # workspace.
+        shutil.copyfile(src_path, tmp_path)
+        size = os.path.getsize(tmp_path)
+
+        with self.lock:
+            if sha1 in self.lru:
+                os.remove(tmp_path)
+                return
+            os.rename(tmp_path, path)
+            self.lru[sha1] = size
+            self.total_bytes += size
+            self.bytes_stored += size
+            self._evict()
+        return
+
+
+    def _evict(self):
+        # Requires self.lock.
+        while self.total_bytes > self.max_bytes and self.lru:
+            (sha1, size) = self.lru.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._entry_path(sha1))
+            except OSError:
+                pass
+        return
+
+    ####
+
+    def materialize(self, manifest, root_dir):
+        # Lays out [(name, sha1)] under `root_dir`.
+        made_dirs = set()
+        for (name, sha1) in manifest:
+            name = os.path.normpath(name)
+            if os.path.isabs(name) or name.startswith(os.pardir):
+                raise ExBadHeader('{} is outside the tree'.format(name))
+            path = os.path.join(root_dir, name)
+
+            dir_name = os.path.dirname(path)
+            if dir_name not in made_dirs:
+                if not os.path.isdir(dir_name):
+                    os.makedirs(dir_name)
+                made_dirs.add(dir_name)
+
+            src_path = self._entry_path(sha1)
+            try:
+                os.link(src_path, path)
+            except (OSError, AttributeError):
+                # No hardlinks here, or across filesystems.
+                try:
+                    shutil.copyfile(src_path, path)
+                except IOError:
+                    raise ExBadHeader('{} was evicted'.format(sha1))
+        return
+
+    ####
+
+    def summary(self):
+        with self.lock:
+            return '{} hits, {} misses, {} evictions, {}/{} bytes, {} stored'.format(
+                self.hits, self.misses, self.evictions, self.total_bytes,
+                self.max_bytes, self.bytes_stored)
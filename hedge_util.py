@@ -0,0 +1,75 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import collections
+import threading
+
+####
+
+HISTORY_SIZE = 256 # Per job key.
+MIN_HISTORY = 16 # Before any job is hedged.
+
+####
+
+class Hedger:
+    # Decides when a job has run long enough to be worth running again elsewhere,
+    # from recent compile times per input byte for its job key.
+    def __init__(self, percentile, min_secs):
+        self.percentile = percentile
+        self.min_secs = min_secs
+
+        self.lock = threading.Lock()
+        self.history = dict() # job_key -> deque of secs per byte
+
+        self.jobs = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedge_failures = 0 # No second remote or local slot to hedge on.
+        return
+
+
+    def record(self, job_key, input_bytes, secs):
+        with self.lock:
+            try:
+                history = self.history[job_key]
+            except KeyError:
+                history = collections.deque(maxlen=HISTORY_SIZE)
+                self.history[job_key] = history
+            history.append(secs / max(input_bytes, 1))
+        return
+
+
+    def hedge_secs(self, job_key, input_bytes):
+        # Returns how long a job of `input_bytes` may run before it's slower than
+        # `percentile` of recent ones, or None without enough history to tell.
+        with self.lock:
+            self.jobs += 1
+            history = self.history.get(job_key)
+            if not history or len(history) < MIN_HISTORY:
+                return None
+            rates = sorted(history)
+        i = min(len(rates) - 1, int(len(rates) * self.percentile / 100.0))
+        return max(rates[i] * max(input_bytes, 1), self.min_secs)
+
+
+    def record_hedge(self, is_launched):
+        with self.lock:
+            if is_launched:
+                self.hedges += 1
+            else:
+                self.hedge_failures += 1
+        return
+
+
+    def record_hedge_win(self):
+        with self.lock:
+            self.hedge_wins += 1
+        return
+
+    ####
+
+    def summary(self):
+        with self.lock:
+            rate = 100.0 * self.hedges / max(self.jobs, 1)
+            return '{} jobs, {} hedged ({:.1f}%), {} hedge wins, {} unhedgeable'.format(
+                self.jobs, self.hedges, rate, self.hedge_wins, self.hedge_failures)
@@ -0,0 +1,103 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import hashlib
+import os
+import re
+
+####
+
+# Directives are found without evaluating any #if, so every header a source might
+# include is found, at the cost of some it doesn't. That's only a problem for
+# includes named by a macro, which we can't follow.
+INCLUDE_RE = re.compile(r'^[ \t]*#[ \t]*(include_next|include|import)[ \t]*(.*)$', re.M)
+HAS_INCLUDE_RE = re.compile(r'__has_include(?:_next)?[ \t]*\([ \t]*([<"])([^>"\n]+)[>"]')
+NAME_RE = re.compile(r'([<"])([^>"\n]+)[>"]')
+
+class ExUnpumpable(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+        return
+
+####
+
+def parse_includes(data, path):
+    # Returns [(is_quoted, name)].
+    ret = []
+    for (directive, rest) in INCLUDE_RE.findall(data):
+        if directive == 'import':
+            raise ExUnpumpable('#import in {}'.format(path))
+        m = NAME_RE.match(rest)
+        if not m:
+            raise ExUnpumpable('computed #include in {}'.format(path))
+        ret.append((m.group(1) == '"', m.group(2)))
+    for (quote, name) in HAS_INCLUDE_RE.findall(data):
+        ret.append((quote == '"', name))
+    return ret
+
+
+def find_headers(paths, include_dirs):
+    # Returns {path: sha1} for `paths` and every header they may include. Like cl,
+    # a quoted name is looked for in the dirs of every file on the include stack,
+    # then the first source's, then `include_dirs`; angled ones only in the last.
+    # Tracking include stacks costs time exponential in the dirs, so a quoted name
+    # is instead looked for in the dirs of every file found so far, which covers any
+    # stack, and all matches are included. Each file is read once; as new dirs turn
+    # up, the quoted names seen so far are looked for in them too. Names found in
+    # none of these are the toolchain's own, which a remote with the same job key
+    # has too.
+    source_dir = os.path.dirname(os.path.abspath(paths[0]))
+    include_dirs = [os.path.abspath(x) for x in include_dirs]
+
+    exists = dict()
+
+    ret = dict()
+    seen = set()
+    todo = [os.path.abspath(x) for x in paths]
+
+    def look_in(dir_path, name):
+        candidate = os.path.normpath(os.path.join(dir_path, name))
+        if candidate in seen:
+            return
+        try:
+            is_file = exists[candidate]
+        except KeyError:
+            is_file = os.path.isfile(candidate)
+            exists[candidate] = is_file
+        if is_file:
+            todo.append(candidate)
+        return
+
+    quoted_dirs = set([source_dir] + include_dirs)
+    quoted_names = set()
+
+    while todo:
+        path = todo.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            continue # Not something a compile could have read either.
+        ret[path] = hashlib.sha1(data).hexdigest()
+
+        dir_path = os.path.dirname(path)
+        if dir_path not in quoted_dirs:
+            quoted_dirs.add(dir_path)
+            for name in quoted_names:
+                look_in(dir_path, name)
+
+        for (is_quoted, name) in parse_includes(data, path):
+            if not is_quoted:
+                for x in include_dirs:
+                    look_in(x, name)
+                continue
+            if name in quoted_names:
+                continue # Already looked for in every dir.
+            quoted_names.add(name)
+            for x in quoted_dirs:
+                look_in(x, name)
+    return ret
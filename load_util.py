@@ -0,0 +1,156 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import math
+import threading
+
+####
+
+SAMPLE_INTERVAL = 2.0
+GROW_SAMPLES = 3 # In a row with room for more, before each added slot.
+SHRINK_SAMPLES = 2 # In a row over the limit, before dropping to it.
+
+# The 1-minute load average is an exponential average over this window, lagging
+# our own jobs starting and finishing by about as long.
+LOADAVG_WINDOW = 60.0
+ACTIVE_DECAY = math.exp(-SAMPLE_INTERVAL / LOADAVG_WINDOW)
+
+# Past these PSI 'some' avg10 percentages, drop a slot per sample.
+CPU_PRESSURE_MAX = 40.0
+MEMORY_PRESSURE_MAX = 10.0
+# Under this, with nothing else running, our jobs leave CPU to spare (waiting on
+# I/O, or on remotes), so take on more of them than there are CPUs.
+CPU_PRESSURE_LOW = 10.0
+
+####
+
+def read_loadavg(path='/proc/loadavg'):
+    # The 1-minute load average, or None where there's none.
+    try:
+        with open(path, 'rb') as f:
+            return float(f.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def read_pressure(resource, proc_dir='/proc/pressure'):
+    # The percentage of the last 10s that some task stalled on `resource`, or None
+    # without PSI (Linux before 4.20, or disabled).
+    try:
+        with open('{}/{}'.format(proc_dir, resource), 'rb') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(dict([x.split('=') for x in fields[1:]])['avg10'])
+    except (IOError, ValueError, KeyError):
+        pass
+    return None
+
+
+def read_mem_available(path='/proc/meminfo'):
+    # In bytes, or None.
+    try:
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+####
+
+class Sample:
+    def __init__(self):
+        self.loadavg = read_loadavg()
+        self.cpu_pressure = read_pressure('cpu')
+        self.memory_pressure = read_pressure('memory')
+        self.mem_available = read_mem_available()
+        return
+
+
+class SlotGovernor:
+    # Picks a slot count between `min_slots` and `max_slots` from how busy the box
+    # is apart from our own jobs: CPUs left free by the rest of the load average,
+    # memory for `mem_per_slot` bytes a job, and no CPU or memory pressure stalls.
+    # Past a CPU a slot, only while nothing else runs and CPUs are uncontended.
+    #
+    # Our own jobs are taken out of the load average as averaged over the same
+    # window, so that it lagging them doesn't count them as someone else's load.
+    # Shrinking takes SHRINK_SAMPLES samples in a row over the limit, and growing is
+    # one slot at a time, after GROW_SAMPLES samples in a row with room for it, so
+    # that a blip in load doesn't flap the count.
+    def __init__(self, cpu_count, min_slots, max_slots, mem_per_slot):
+        self.cpu_count = cpu_count
+        self.min_slots = max(min_slots, 1)
+        self.max_slots = max(max_slots, self.min_slots)
+        self.mem_per_slot = mem_per_slot
+
+        self.slots = max(self.min_slots, min(cpu_count, self.max_slots))
+        self.avg_active = 0.0
+        self.grow_streak = 0
+        self.shrink_streak = 0
+        self.reason = 'initial'
+
+        self.lock = threading.Lock()
+        self.changes = 0
+        return
+
+
+    def target(self, sample, active, avg_active):
+        # Returns (slots, reason) for `sample` while `active` jobs of ours run, and
+        # `avg_active` did over the load average's window.
+        limits = [(self.max_slots, 'max')]
+        if sample.loadavg is not None:
+            # Our own compiles are in the load average, and so in the free CPUs.
+            others = max(sample.loadavg - avg_active, 0.0)
+            slots = int(math.floor(self.cpu_count - others + 0.5))
+            if (others < 1.0 and sample.cpu_pressure is not None and
+                sample.cpu_pressure < CPU_PRESSURE_LOW):
+                slots = max(slots, self.slots + 1)
+            limits.append((slots, 'load'))
+        if sample.mem_available is not None and self.mem_per_slot:
+            limits.append((active + sample.mem_available // self.mem_per_slot, 'memory'))
+        if (sample.cpu_pressure or 0.0) > CPU_PRESSURE_MAX:
+            limits.append((self.slots - 1, 'cpu pressure'))
+        if (sample.memory_pressure or 0.0) > MEMORY_PRESSURE_MAX:
+            limits.append((self.slots - 1, 'memory pressure'))
+
+        (slots, reason) = min(limits)
+        if slots < self.min_slots:
+            return (self.min_slots, reason)
+        return (slots, reason)
+
+
+    def update(self, sample, active):
+        # Returns the new slot count, or None if it's unchanged. Called every
+        # SAMPLE_INTERVAL.
+        with self.lock:
+            self.avg_active = (self.avg_active * ACTIVE_DECAY +
+                               active * (1.0 - ACTIVE_DECAY))
+            (target, reason) = self.target(sample, active, self.avg_active)
+            if target > self.slots:
+                self.shrink_streak = 0
+                self.grow_streak += 1
+                if self.grow_streak < GROW_SAMPLES:
+                    return None
+                target = self.slots + 1
+            elif target < self.slots:
+                self.grow_streak = 0
+                self.shrink_streak += 1
+                if self.shrink_streak < SHRINK_SAMPLES:
+                    return None
+            self.grow_streak = 0
+            self.shrink_streak = 0
+            if target == self.slots:
+                return None
+            self.slots = target
+            self.reason = reason
+            self.changes += 1
+        return target
+
+
+    def summary(self):
+        with self.lock:
+            return '{} slots ({}..{}, limited by {}), {} changes'.format(
+                self.slots, self.min_slots, self.max_slots, self.reason, self.changes)
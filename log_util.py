@@ -0,0 +1,260 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import collections
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+####
+
+# Shims send their log lines to ccerbd's log port in UDP datagrams, each a
+# BATCH_HEADER of (sender pid, lines the sender dropped since its last batch), then
+# each line as LINE_HEADER (length) and its utf-8 bytes. Nothing comes back, and a
+# datagram that doesn't fit is dropped and counted.
+BATCH_HEADER = struct.Struct('<II')
+LINE_HEADER = struct.Struct('<I')
+MAX_DATAGRAM = 60 * 1024
+
+RING_LINES = 4096 # Per shim, before the oldest lines are dropped.
+FLUSH_INTERVAL = 0.5
+QUEUE_LINES = 64 * 1024 # In ccerbd, before new lines are dropped.
+RECV_BUFFER = 4 * 1024 * 1024
+
+# Binary log files are records of BINARY_HEADER (time, source length, line length),
+# then the source and the line, in utf-8.
+BINARY_HEADER = struct.Struct('<dBI')
+
+####
+
+def datagram_addr(addr):
+    # The one address both ends agree on for `addr`, which may resolve to several.
+    (host, port) = addr
+    (family, _, _, _, sockaddr) = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
+    return (family, sockaddr)
+
+
+def pack_batches(pid, dropped, lines):
+    # Yields datagrams. Lines too big for one are cut short.
+    max_line = MAX_DATAGRAM - BATCH_HEADER.size - LINE_HEADER.size
+    parts = [BATCH_HEADER.pack(pid, dropped)]
+    size = BATCH_HEADER.size
+    for line in lines:
+        data = line.encode('utf-8')[:max_line]
+        if size + LINE_HEADER.size + len(data) > MAX_DATAGRAM:
+            yield ''.join(parts)
+            parts = [BATCH_HEADER.pack(pid, 0)]
+            size = BATCH_HEADER.size
+        parts += [LINE_HEADER.pack(len(data)), data]
+        size += LINE_HEADER.size + len(data)
+    yield ''.join(parts)
+
+
+def unpack_batch(data):
+    # Returns (pid, dropped, [line]).
+    (pid, dropped) = BATCH_HEADER.unpack_from(data)
+    lines = []
+    pos = BATCH_HEADER.size
+    while pos < len(data):
+        (size, ) = LINE_HEADER.unpack_from(data, pos)
+        pos += LINE_HEADER.size
+        lines.append(data[pos:pos+size].decode('utf-8', 'replace'))
+        pos += size
+    return (pid, dropped, lines)
+
+####
+
+class LogSender:
+    # For the shim: log() only appends to a ring buffer. Lines go out in batches
+    # every FLUSH_INTERVAL, from a thread started on first use, and on flush().
+    def __init__(self, addr):
+        self.addr = addr
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.ring = collections.deque(maxlen=RING_LINES)
+        self.dropped = 0 # Since the last batch.
+        self.sock = None
+        self.thread = None
+        return
+
+
+    def log(self, msg):
+        if not isinstance(msg, unicode):
+            msg = msg.decode('utf-8', 'replace')
+        with self.lock:
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1
+            self.ring.append(msg)
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+        self.thread.start()
+        return
+
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+
+    def flush(self):
+        with self.lock:
+            if not self.ring and not self.dropped:
+                return
+            lines = list(self.ring)
+            self.ring.clear()
+            dropped = self.dropped
+            self.dropped = 0
+
+            try:
+                if not self.sock:
+                    (family, self.sockaddr) = datagram_addr(self.addr)
+                    self.sock = socket.socket(family, socket.SOCK_DGRAM)
+                    self.sock.setblocking(0)
+                for datagram in pack_batches(self.pid, dropped, lines):
+                    self.sock.sendto(datagram, self.sockaddr)
+            except socket.error:
+                # No ccerbd, or it's behind: counted in the next batch, if any.
+                self.dropped += len(lines)
+        return
+
+
+class LogSink:
+    # For ccerbd: put() only queues, up to `max_lines`, past which lines are
+    # dropped and counted. The writer thread (see run()) takes the queue a batch
+    # at a time, to print it, or append it to `path` as text or binary records.
+    def __init__(self, print_func, path=None, is_binary=False, max_lines=QUEUE_LINES):
+        self.print_func = print_func
+        self.is_binary = is_binary
+        self.max_lines = max_lines
+
+        self.write_lock = threading.Lock()
+        self.f = None
+        if path:
+            self.f = open(path, 'ab')
+
+        self.cond = threading.Condition(threading.Lock())
+        self.queue = [] # [(time, source, line)]
+        self.lines = 0
+        self.dropped = 0 # Here, for want of queue space.
+        self.sender_dropped = 0 # By senders, before they got here.
+        return
+
+
+    def put(self, source, lines, sender_dropped=0):
+        # `source` is None for our own lines.
+        now = time.time()
+        with self.cond:
+            self.sender_dropped += sender_dropped
+            room = self.max_lines - len(self.queue)
+            if len(lines) > room:
+                self.dropped += len(lines) - max(room, 0)
+                lines = lines[:max(room, 0)]
+            self.queue += [(now, source, x) for x in lines]
+            self.cond.notify()
+        return
+
+
+    def log(self, msg):
+        if not isinstance(msg, unicode):
+            msg = msg.decode('utf-8', 'replace')
+        self.put(None, [msg])
+
+    ####
+
+    def run(self):
+        # Doesn't return.
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+            self.flush()
+
+
+    def flush(self):
+        with self.write_lock:
+            with self.cond:
+                batch = self.queue
+                self.queue = []
+                self.lines += len(batch)
+            if not batch:
+                return
+            if self.f:
+                self._write(batch)
+            else:
+                self._print(batch)
+        return
+
+
+    def _print(self, batch):
+        # Our own lines go to stderr, like ccerb.basic_log, and shims' to stdout.
+        runs = [] # [(is_own, [line])]
+        for (_, source, line) in batch:
+            is_own = source is None
+            if not is_own:
+                line = u'[log {}] {}'.format(source, line)
+            if not runs or runs[-1][0] != is_own:
+                runs.append((is_own, []))
+            runs[-1][1].append(line)
+        for (is_own, lines) in runs:
+            self.print_func(u'\n'.join(lines), file=sys.stderr if is_own else sys.stdout)
+
+
+    def _write(self, batch):
+        parts = []
+        for (t, source, line) in batch:
+            source = (u'' if source is None else unicode(source)).encode('utf-8')
+            line = line.encode('utf-8')
+            if self.is_binary:
+                parts += [BINARY_HEADER.pack(t, len(source), len(line)), source, line]
+            else:
+                parts.append('{:.6f} {} {}\n'.format(t, source or '-', line))
+        self.f.write(''.join(parts))
+        self.f.flush()
+
+    ####
+
+    def summary(self):
+        with self.cond:
+            return '{} lines, {} queued, {} dropped here, {} dropped by senders'.format(
+                self.lines, len(self.queue), self.dropped, self.sender_dropped)
+
+
+def serve_datagrams(addr, sink):
+    # Feeds `sink` with the batches shims send to `addr`. Only returns if it can't
+    # bind `addr`.
+    (family, sockaddr) = datagram_addr(addr)
+    s = socket.socket(family, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+    try:
+        s.bind(sockaddr)
+    except socket.error as e:
+        print('Log datagrams on {} unavailable: {}'.format(addr, e), file=sys.stderr)
+        return
+    s.settimeout(None)
+    while True:
+        data = s.recv(MAX_DATAGRAM + 1024)
+        try:
+            (pid, dropped, lines) = unpack_batch(data)
+        except (struct.error, UnicodeDecodeError):
+            continue
+        sink.put(pid, lines, dropped)
+
+
+def read_binary_log(f):
+    # Yields (time, source, line) from a binary log file, until its end or a record
+    # cut short.
+    while True:
+        header = f.read(BINARY_HEADER.size)
+        if len(header) < BINARY_HEADER.size:
+            return
+        (t, source_len, line_len) = BINARY_HEADER.unpack(header)
+        data = f.read(source_len + line_len)
+        if len(data) < source_len + line_len:
+            return
+        yield (t, data[:source_len].decode('utf-8'), data[source_len:].decode('utf-8'))
@@ -0,0 +1,157 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import bisect
+import collections
+import threading
+import time
+
+####
+
+# Upper bounds, in seconds, of the latency histograms' buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0, 60.0, 300.0)
+
+RATE_WINDOW = 60.0
+
+####
+
+def _escape(val):
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(k, _escape(v)) for (k, v) in labels]) + '}'
+
+
+def _format_value(val):
+    if isinstance(val, float):
+        return repr(val)
+    return str(val)
+
+####
+
+class RateMeter:
+    # Events per second over the last `window` seconds.
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.times = collections.deque()
+        return
+
+
+    def _trim(self, now):
+        # Requires self.lock.
+        while self.times and self.times[0] < now - self.window:
+            self.times.popleft()
+
+
+    def mark(self):
+        now = time.time()
+        with self.lock:
+            self.times.append(now)
+            self._trim(now)
+        return
+
+
+    def rate(self):
+        now = time.time()
+        with self.lock:
+            self._trim(now)
+            return len(self.times) / self.window
+
+
+class Metrics:
+    # Counters and histograms cost a dict update under a lock to record. Sampled
+    # metrics are read from their funcs only when rendered. Labels are tuples of
+    # (name, value) pairs, always in the same order for a given metric.
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.kinds = collections.OrderedDict() # name -> (kind, help_text)
+        self.values = dict() # name -> {labels: count, or histogram counts}
+        self.buckets = dict() # name -> bucket bounds
+        self.funcs = dict() # name -> func() returning [(labels, value)]
+        return
+
+
+    def counter(self, name, help_text):
+        self.kinds[name] = ('counter', help_text)
+        self.values[name] = dict()
+
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.kinds[name] = ('histogram', help_text)
+        self.values[name] = dict()
+        self.buckets[name] = buckets
+
+
+    def sampled(self, name, kind, help_text, func):
+        self.kinds[name] = (kind, help_text)
+        self.funcs[name] = func
+
+    ####
+
+    def add(self, name, labels=(), n=1):
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + n
+        return
+
+
+    def observe(self, name, labels, val):
+        buckets = self.buckets[name]
+        i = bisect.bisect_left(buckets, val)
+        with self.lock:
+            values = self.values[name]
+            try:
+                hist = values[labels]
+            except KeyError:
+                # A count per bucket (not cumulative), then +Inf's, then the sum.
+                hist = [0] * (len(buckets) + 1) + [0.0]
+                values[labels] = hist
+            hist[i] += 1
+            hist[-1] += val
+        return
+
+    ####
+
+    def render(self):
+        # Prometheus text exposition format.
+        with self.lock:
+            snapshot = dict()
+            for (name, values) in self.values.items():
+                snapshot[name] = [(k, list(v) if isinstance(v, list) else v)
+                                  for (k, v) in values.items()]
+
+        lines = []
+        for (name, (kind, help_text)) in self.kinds.items():
+            full_name = self.prefix + name
+            lines.append('# HELP {} {}'.format(full_name, help_text))
+            lines.append('# TYPE {} {}'.format(full_name, kind))
+
+            if name in self.funcs:
+                samples = self.funcs[name]()
+            else:
+                samples = sorted(snapshot[name])
+
+            if kind != 'histogram':
+                for (labels, val) in samples:
+                    lines.append('{}{} {}'.format(full_name, _format_labels(labels),
+                                                  _format_value(val)))
+                continue
+
+            bounds = [_format_value(float(x)) for x in self.buckets[name]] + ['+Inf']
+            for (labels, hist) in samples:
+                total = 0
+                for (bound, count) in zip(bounds, hist):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(
+                        full_name, _format_labels(labels + (('le', bound),)), total))
+                lines.append('{}_sum{} {}'.format(full_name, _format_labels(labels),
+                                                  _format_value(hist[-1])))
+                lines.append('{}_count{} {}'.format(full_name, _format_labels(labels),
+                                                    total))
+        return '\n'.join(lines) + '\n'
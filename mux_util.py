@@ -0,0 +1,385 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import select
+import socket
+import struct
+import threading
+import time
+
+import net_util
+
+####
+
+# A session carries many streams over one connection. Each frame is a header of
+# (stream id, kind, length), followed by `length` bytes for MUX_DATA. Only the side
+# that connected opens streams.
+MUX_HEADER = struct.Struct('<IBI')
+MUX_DATA = 0
+MUX_CREDIT = 1 # The receiver has taken `length` more bytes off the stream.
+MUX_CLOSE = 2
+MUX_PING = 3 # On stream 0, so an idle session doesn't look dead.
+MUX_OPEN = 4 # Ahead of any of the stream's data.
+
+# Per stream, the most bytes in flight before the receiver hands back credit.
+MUX_WINDOW = 256 * 1024
+# Big sends are split so one stream can't hold up the others for long.
+MUX_MAX_FRAME = 64 * 1024
+
+####
+
+class MuxStream:
+    # Stands in for a socket, for everything the protocol functions in net_util and
+    # ccerb need: sendall, try_sendall, recv_into, timeouts, is_readable, and
+    # kill_socket.
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.id = stream_id
+        self.timeout = socket.getdefaulttimeout()
+
+        self.cond = threading.Condition(threading.Lock())
+        self.buf = bytearray()
+        self.consumed = 0 # Not yet credited back.
+        self.credit = MUX_WINDOW
+        self.is_eof = False
+        self.is_closed = False
+        self.error = None
+        return
+
+
+    def gettimeout(self):
+        return self.timeout
+
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+
+    def _wait(self, is_ready):
+        # Requires self.cond.
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while not is_ready():
+            if self.error:
+                raise socket.error(self.error)
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise socket.timeout('timed out')
+            self.cond.wait(timeout)
+        if self.error:
+            raise socket.error(self.error)
+        return
+
+    ####
+
+    def sendall(self, data):
+        view = memoryview(data)
+        pos = 0
+        while pos != len(view):
+            with self.cond:
+                self._wait(lambda: self.credit or self.is_closed or self.is_eof)
+                if self.is_closed or self.is_eof:
+                    raise socket.error('stream closed')
+                size = min(self.credit, MUX_MAX_FRAME, len(view) - pos)
+                self.credit -= size
+            self.session.send_frame(self.id, MUX_DATA, view[pos:pos+size])
+            pos += size
+        return
+
+
+    def try_sendall(self, data):
+        # For heartbeats: returns False rather than wait for credit, another stream's
+        # send, or room on the connection.
+        with self.cond:
+            if self.error:
+                raise socket.error(self.error)
+            if self.is_closed or self.is_eof:
+                raise socket.error('stream closed')
+            if self.credit < len(data):
+                return False
+            self.credit -= len(data)
+        if self.session.try_send_frame(self.id, MUX_DATA, data):
+            return True
+        with self.cond:
+            self.credit += len(data)
+        return False
+
+
+    def recv_into(self, buf, nbytes=0):
+        if not nbytes:
+            nbytes = len(buf)
+        with self.cond:
+            self._wait(lambda: self.buf or self.is_eof or self.is_closed)
+            size = min(nbytes, len(self.buf))
+            buf[:size] = self.buf[:size]
+            del self.buf[:size]
+
+            self.consumed += size
+            credit = 0
+            if self.consumed >= MUX_WINDOW // 2 and not self.is_eof:
+                credit = self.consumed
+                self.consumed = 0
+
+        if credit:
+            self.session.send_frame(self.id, MUX_CREDIT, length=credit)
+        return size
+
+
+    def recv(self, nbytes):
+        buf = bytearray(nbytes)
+        size = self.recv_into(buf, nbytes)
+        return bytes(buf[:size])
+
+
+    def is_readable(self):
+        with self.cond:
+            return bool(self.buf or self.is_eof or self.error)
+
+    ####
+
+    def shutdown(self, how):
+        self.close()
+
+
+    def close(self):
+        with self.cond:
+            if self.is_closed:
+                return
+            self.is_closed = True
+            self.cond.notify_all()
+        self.session._drop(self)
+        self.session.queue_frame(self.id, MUX_CLOSE)
+        return
+
+    ####
+
+    def _on_data(self, data):
+        with self.cond:
+            # More than the credit we gave the peer.
+            if len(self.buf) + len(data) > MUX_WINDOW:
+                raise net_util.ExSocketClosed('mux stream {} over its window'.format(
+                    self.id))
+            self.buf += data
+            self.cond.notify_all()
+
+
+    def _on_credit(self, credit):
+        with self.cond:
+            self.credit += credit
+            self.cond.notify_all()
+
+
+    def _on_close(self):
+        with self.cond:
+            self.is_eof = True
+            self.cond.notify_all()
+
+
+    def _on_error(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify_all()
+
+
+class MuxSession:
+    # Run run() (or start()) to dispatch incoming frames. With `on_stream`, streams
+    # the peer opens are passed to on_stream(stream), on the dispatch thread.
+    def __init__(self, conn, on_stream=None):
+        self.conn = conn
+        self.on_stream = on_stream
+        self.interval = conn.gettimeout() * 0.5
+
+        self.send_lock = threading.Lock()
+        self.last_send = time.time()
+        self.queued = [] # Frame headers from queue_frame().
+
+        self.lock = threading.Lock()
+        self.streams = dict() # id -> MuxStream
+        self.next_id = 1
+        self.error = None
+
+        self.opened = 0
+        return
+
+
+    def is_alive(self):
+        with self.lock:
+            return not self.error
+
+
+    def open(self):
+        with self.send_lock:
+            with self.lock:
+                if self.error:
+                    raise socket.error(self.error)
+                stream = MuxStream(self, self.next_id)
+                self.next_id += 1
+                self.streams[stream.id] = stream
+                self.opened += 1
+            self._send(MUX_HEADER.pack(stream.id, MUX_OPEN, 0), b'')
+        self._flush_queued()
+        return stream
+
+
+    def _drop(self, stream):
+        with self.lock:
+            self.streams.pop(stream.id, None)
+
+
+    def stream_count(self):
+        with self.lock:
+            return len(self.streams)
+
+    ####
+
+    def send_frame(self, stream_id, kind, data=b'', length=None):
+        if length is None:
+            length = len(data)
+        header = MUX_HEADER.pack(stream_id, kind, length)
+        with self.send_lock:
+            self._send(header, data)
+        self._flush_queued()
+        return
+
+
+    def try_send_frame(self, stream_id, kind, data=b''):
+        # Like send_frame, but returns False rather than block.
+        if not self.send_lock.acquire(False):
+            return False
+        try:
+            if not net_util.is_writable(self.conn):
+                return False
+            self._send(MUX_HEADER.pack(stream_id, kind, len(data)), data)
+        finally:
+            self.send_lock.release()
+        self._flush_queued()
+        return True
+
+
+    def queue_frame(self, stream_id, kind):
+        # For a frame without data, from threads that mustn't block on the connection,
+        # like run()'s. It goes out ahead of the next frame sent, or once the
+        # connection has room.
+        with self.lock:
+            if self.error:
+                return
+            self.queued.append(MUX_HEADER.pack(stream_id, kind, 0))
+        self._flush_queued()
+        return
+
+
+    def _flush_queued(self):
+        # If another thread holds send_lock, it calls this once done. If the
+        # connection has no room, run() calls this again.
+        while self.queued:
+            if not self.send_lock.acquire(False):
+                return
+            try:
+                if not net_util.is_writable(self.conn):
+                    return
+                self._send(b'', b'')
+            except socket.error:
+                return # Failed the session.
+            finally:
+                self.send_lock.release()
+        return
+
+
+    def _send(self, header, data):
+        # Requires self.send_lock.
+        with self.lock:
+            if self.queued:
+                header = b''.join(self.queued) + header
+                del self.queued[:]
+        try:
+            if len(data) < net_util.FRAME_JOIN_LIMIT:
+                self.conn.sendall(header + memoryview(data).tobytes())
+            else:
+                self.conn.sendall(header)
+                self.conn.sendall(data)
+        except socket.error as e:
+            self._fail(e)
+            raise
+        self.last_send = time.time()
+        net_util.IO_STATS.sends += 1
+        return
+
+
+    def _fail(self, error):
+        with self.lock:
+            if self.error:
+                return
+            self.error = error
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream._on_error(error)
+        net_util.kill_socket(self.conn)
+        return
+
+    ####
+
+    def start(self):
+        net_util.spawn_thread(self.run, ())
+
+
+    def run(self):
+        # Returns once the connection fails or the peer hangs up.
+        last_recv = time.time()
+        try:
+            while True:
+                readable = net_util.wait_readable(self.conn, self.interval)
+                now = time.time()
+                if now - self.last_send >= self.interval:
+                    # Skipped if it would block: a send that's stuck times out.
+                    self.try_send_frame(0, MUX_PING)
+                self._flush_queued()
+                if not readable:
+                    if now - last_recv > self.interval * 4:
+                        raise socket.timeout('mux session timed out')
+                    continue
+                last_recv = now
+                self._recv_frame()
+        except (socket.error, select.error, net_util.ExSocketClosed) as e:
+            self._fail(e)
+        return
+
+
+    def _recv_frame(self):
+        header = net_util.recv_n(self.conn, MUX_HEADER.size)
+        (stream_id, kind, length) = MUX_HEADER.unpack(bytes(header))
+        if kind == MUX_PING:
+            return
+
+        data = None
+        if kind == MUX_DATA:
+            if length > MUX_WINDOW:
+                raise net_util.ExSocketClosed('mux frame over the window')
+            data = net_util.recv_n(self.conn, length)
+
+        if kind == MUX_OPEN:
+            if not self.on_stream:
+                raise net_util.ExSocketClosed('unexpected mux stream')
+            stream = MuxStream(self, stream_id)
+            with self.lock:
+                self.streams[stream_id] = stream
+                self.opened += 1
+            self.on_stream(stream)
+            return
+
+        with self.lock:
+            stream = self.streams.get(stream_id)
+        if not stream:
+            return # Already closed on our side.
+
+        if kind == MUX_DATA:
+            stream._on_data(data)
+        elif kind == MUX_CREDIT:
+            stream._on_credit(length)
+        elif kind == MUX_CLOSE:
+            stream._on_close()
+            self._drop(stream)
+        return
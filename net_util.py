@@ -1,11 +1,18 @@
 from __future__ import print_function
 assert __name__ != '__main__'
 
-import pickle
+import collections
+import errno
+import heapq
+import itertools
+import Queue
+import select
 import socket
 import struct
+import sys
 import threading
 import time
+import traceback
 
 ####
 
@@ -29,7 +36,7 @@ def spawn_thread(target, args, as_daemon=True):
     if as_daemon:
         t.daemon = True
     t.start()
-    return
+    return t
 
 ####
 
@@ -59,11 +66,126 @@ def recv_n(conn, size):
         continue
     return data
 
+
+def recv_into_file(conn, f, size, buf):
+    # Receives `size` bytes into `f`, through the reusable `buf`.
+    view = memoryview(buf)
+    while size:
+        subview = view[:min(size, len(view))]
+        pos = 0
+        while pos != len(subview):
+            read = conn.recv_into(subview[pos:], len(subview) - pos)
+            if not read:
+                raise ExSocketClosed()
+            pos += read
+        f.write(subview)
+        size -= len(subview)
+    return
+
+
+def send_file(conn, f, size, buf):
+    # Sends `size` bytes of `f` from its current position.
+    if hasattr(conn, 'sendfile'):
+        sent = conn.sendfile(f, f.tell(), size)
+        IO_STATS.sends += 1
+        if sent != size:
+            raise ExSocketClosed()
+        return
+
+    view = memoryview(buf)
+    while size:
+        read = f.readinto(buf)
+        if not read:
+            raise IOError('{} truncated while sending'.format(f.name))
+        read = min(read, size)
+        conn.sendall(view[:read])
+        IO_STATS.sends += 1
+        size -= read
+    return
+
+####
+
+class IoStats:
+    # For judging the wire protocol. Unlocked, so only approximate under threads.
+    def __init__(self):
+        self.fields = 0 # Writes, had every field gone out on its own.
+        self.sends = 0 # Actual send calls.
+        self.round_trips = 0
+        self.pipelined = 0 # Round trips saved by not waiting between requests.
+        return
+
+
+    def summary(self):
+        return '{} round trips ({} saved), {} sends ({} saved)'.format(
+            self.round_trips, self.pipelined, self.sends, self.fields - self.sends)
+
+IO_STATS = IoStats()
+
+####
+
+FRAME_JOIN_LIMIT = 64 * 1024
+
+class Frame:
+    # Stands in for a socket to collect small writes, then sends them as one.
+    # Parts of FRAME_JOIN_LIMIT or more go out on their own rather than be copied.
+    # (No sendmsg() for scatter-gather in Python 2.)
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        return
+
+
+    def sendall(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        IO_STATS.fields += 1
+
+
+    def send(self, conn):
+        parts = self.parts
+        self.parts = []
+        self.size = 0
+        if isinstance(conn, Frame):
+            conn.parts += parts
+            conn.size += sum([len(x) for x in parts])
+            return
+
+        small = []
+        for data in parts:
+            if len(data) < FRAME_JOIN_LIMIT:
+                small.append(data)
+                continue
+            _send_joined(conn, small)
+            small = []
+            conn.sendall(data)
+            IO_STATS.sends += 1
+        _send_joined(conn, small)
+        return
+
+
+def _send_joined(conn, parts):
+    if not parts:
+        return
+    if len(parts) == 1:
+        conn.sendall(parts[0])
+    else:
+        conn.sendall(bytearray().join(parts))
+    IO_STATS.sends += 1
+
+
+def set_nodelay(conn):
+    # Everything we send is either a finished message or bulk data, so Nagle only
+    # adds delayed-ACK stalls.
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
 ####
 
 def send_struct(conn, format, val):
     data = struct.pack(format, val)
     conn.sendall(data)
+    if not isinstance(conn, Frame):
+        IO_STATS.fields += 1
+        IO_STATS.sends += 1
     return
 
 
@@ -81,11 +203,27 @@ def send_byte(conn, val):
 def recv_byte(conn):
     return recv_struct(conn, '<B')
 
+
+def try_send_byte(conn, val):
+    # Like send_byte, but returns False rather than blocking while `conn` can't
+    # take it. Not a send with MSG_DONTWAIT: on a socket with a timeout, Python waits
+    # for it to be writable first anyway.
+    if hasattr(conn, 'try_sendall'):
+        return conn.try_sendall(struct.pack('<B', val)) # A mux_util.MuxStream.
+    if not is_writable(conn):
+        return False
+    send_byte(conn, val)
+    return True
+
 ####
 
 def send_buffer(conn, data):
-    send_struct(conn, '<Q', len(data))
-    conn.sendall(data)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    frame = Frame()
+    send_struct(frame, '<Q', len(data))
+    frame.sendall(data)
+    frame.send(conn)
     return
 
 def recv_buffer(conn):
@@ -95,18 +233,6 @@ def recv_buffer(conn):
 
 ####
 
-def send_pickle(conn, data):
-    pdata = pickle.dumps(data)
-    send_buffer(conn, pdata)
-    return
-
-def recv_pickle(conn):
-    pdata = recv_buffer(conn)
-    data = pickle.loads(pdata)
-    return data
-
-####
-
 def send_poke(conn):
     conn.sendall(bytearray(1))
     return
@@ -118,6 +244,35 @@ def recv_poke(conn):
 
 ####
 
+def _is_ready(conn, is_write, timeout=0):
+    if hasattr(select, 'poll'):
+        # Not select(), which can't take fds past FD_SETSIZE (1024).
+        p = select.poll()
+        p.register(conn, select.POLLOUT if is_write else select.POLLIN)
+        return bool(p.poll(timeout * 1000))
+    # Windows has no poll(), nor the fd limit.
+    (readable, writable, _) = select.select([] if is_write else [conn],
+                                            [conn] if is_write else [], [], timeout)
+    return bool(readable or writable)
+
+
+def wait_readable(conn, timeout):
+    # Returns False if `conn` isn't readable within `timeout` seconds.
+    return _is_ready(conn, False, timeout)
+
+
+def is_readable(conn):
+    if hasattr(conn, 'is_readable'):
+        return conn.is_readable() # A mux_util.MuxStream.
+    return _is_ready(conn, False)
+
+
+def is_writable(conn):
+    # Or failed, so that a send would say so.
+    return _is_ready(conn, True)
+
+####
+
 def kill_socket(s):
     try:
         s.shutdown(socket.SHUT_RDWR)
@@ -138,36 +293,127 @@ def wait_on_beacon(conn):
         continue
 
 
+class HeartbeatService:
+    # A single thread beats every live WaitBeacon, from a heap of deadlines.
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.heap = [] # (deadline, seq, beacon)
+        self.seq = itertools.count()
+        self.is_running = False
+        return
+
+
+    def add(self, beacon, deadline):
+        with self.cond:
+            heapq.heappush(self.heap, (deadline, next(self.seq), beacon))
+            if not self.is_running:
+                self.is_running = True
+                t = threading.Thread(name='HeartbeatService', target=self._thread)
+                t.daemon = True
+                t.start()
+            elif self.heap[0][2] is beacon:
+                self.cond.notify()
+        return
+
+
+    def _thread(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    timeout = None
+                    if self.heap:
+                        timeout = self.heap[0][0] - now
+                    self.cond.wait(timeout)
+                    continue
+
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+
+            for beacon in due:
+                delay = beacon._beat()
+                if delay is not None:
+                    self.add(beacon, now + delay)
+            continue
+
+HEARTBEATS = HeartbeatService()
+
+####
+
+# A beat skipped because the connection couldn't take it is retried after this.
+BEAT_RETRY_INTERVAL = 0.1
+
 class WaitBeacon:
-    def __init__(self, conn):
+    # Sends 0 every `0.7 * timeout` until signaled, then 1. Beats never block the
+    # HeartbeatService, which beats every beacon: one the connection can't take
+    # right away is retried shortly.
+    # If the socket fails, the socket is killed, `on_error` (if set) is called, and
+    # signal() and send() raise ExSocketClosed.
+    def __init__(self, conn, on_error=None):
         assert conn.gettimeout() != None
 
         self.conn = conn
         self.lock = threading.Lock()
         self.signaled = False
+        self.error = None
+        self.on_error = on_error
+        self.interval = conn.gettimeout() * 0.7
 
-        t = threading.Thread(name='WaitBeacon', target=WaitBeacon._thread,
-                             args=(self,))
-        t.daemon = True
-        t.start()
+        HEARTBEATS.add(self, time.time())
         return
 
-    def _thread(self):
-        while True:
-            with self.lock:
-                if self.signaled:
-                    return
 
-                send_byte(self.conn, 0)
-                wait_interval = self.conn.gettimeout() * 0.7
+    def _beat(self):
+        # Returns the delay to the next beat, or None once done.
+        if not self.lock.acquire(False):
+            return BEAT_RETRY_INTERVAL # Mid send(), which may block.
+        try:
+            if self.signaled:
+                return None
+
+            try:
+                if not try_send_byte(self.conn, 0):
+                    # A full send buffer: the peer is alive, just behind on reading.
+                    return BEAT_RETRY_INTERVAL
+                return self.interval
+            except socket.error as e:
+                on_error = self._set_error(e)
+        finally:
+            self.lock.release()
+
+        self._fail(e, on_error)
+        return None
+
+
+    def _set_error(self, e):
+        # Requires self.lock. Returns the on_error for _fail().
+        self.signaled = True
+        self.error = e
+        return self.on_error
+
+
+    def _fail(self, e, on_error):
+        debug_print('WaitBeacon failed:', e)
+        kill_socket(self.conn)
+        if on_error:
+            on_error()
+
+
+    def set_on_error(self, on_error):
+        with self.lock:
+            self.on_error = on_error
+            if not self.error:
+                return
+        on_error()
 
-            #if wait_interval >= 1.0:
-            #    wait_interval = 1.0
-            time.sleep(wait_interval)
-            continue
 
     def signal(self):
         with self.lock:
+            if self.error:
+                raise ExSocketClosed(self.error)
             if self.signaled:
                 return
 
@@ -175,6 +421,23 @@ class WaitBeacon:
             send_byte(self.conn, 1)
             return
 
+
+    def send(self, send_func):
+        # Calls send_func(conn) between heartbeats, before signal().
+        with self.lock:
+            if self.error:
+                raise ExSocketClosed(self.error)
+            assert not self.signaled
+
+            try:
+                send_func(self.conn)
+                return
+            except socket.error as e:
+                on_error = self._set_error(e)
+
+        self._fail(e, on_error)
+        raise ExSocketClosed(e)
+
     def __enter__(self):
         return self
 
@@ -183,7 +446,6 @@ class WaitBeacon:
 
 ########################################
 
-import traceback
 def accept_thread(conn, addr, accept_func):
     debug_print('accept_thread', conn, addr)
     try:
@@ -218,22 +480,41 @@ def listen_thread(s, accept_func, gai, gai_set):
 
 ####
 
-def serve_forever(addr, accept_func, gai_poll_interval=GAI_POLL_INTERVAL):
+LISTEN_BACKLOG = 128
+
+def _listen_gais(addr):
+    (host, port) = addr
+    return socket.getaddrinfo(host or None, port, 0, socket.SOCK_STREAM, 0,
+                              socket.AI_PASSIVE)
+
+
+def _bind_listener(gai, backlog):
+    (family, socktype, proto, _, sockaddr) = gai
+    s = socket.socket(family, socktype, proto)
+    try:
+        if sys.platform != 'win32':
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(sockaddr)
+        s.listen(backlog)
+    except socket.error:
+        kill_socket(s)
+        return None
+    return s
+
+####
+
+def serve_forever(addr, accept_func, gai_poll_interval=GAI_POLL_INTERVAL,
+                  backlog=LISTEN_BACKLOG):
+    # Thread-per-connection server. See EventLoop for the scalable one.
     debug_print('serve_forever', addr, accept_func)
     gai_set = set()
     while True:
-        (host, port) = addr
-        for gai in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        for gai in _listen_gais(addr):
             if gai in gai_set:
                 continue
 
-            (family, socktype, proto, _, sockaddr) = gai
-            s = socket.socket(family, socktype, proto)
-            try:
-                s.bind(sockaddr)
-                s.listen(5)
-            except socket.error:
-                kill_socket(s)
+            s = _bind_listener(gai, backlog)
+            if not s:
                 continue
 
             gai_set.add(gai)
@@ -246,3 +527,312 @@ def serve_forever(addr, accept_func, gai_poll_interval=GAI_POLL_INTERVAL):
         except:
             pass
         continue
+
+########################################
+
+class WorkerPool:
+    # Threads are spawned on demand up to max_workers, and exit after idling.
+    def __init__(self, max_workers, idle_timeout=30.0):
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.workers = 0
+        self.idle = 0
+        self.unclaimed = 0 # Queued, and not yet taken by a worker.
+        return
+
+
+    def submit(self, func, *args):
+        with self.lock:
+            self.queue.put((func, args))
+            self.unclaimed += 1
+            if self.unclaimed <= self.idle or self.workers >= self.max_workers:
+                return
+            self.workers += 1
+        spawn_thread(self._thread, ())
+        return
+
+
+    def _thread(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            try:
+                (func, args) = self.queue.get(True, self.idle_timeout)
+            except Queue.Empty:
+                with self.lock:
+                    self.idle -= 1
+                    if self.queue.empty():
+                        self.workers -= 1
+                        return
+                continue
+
+            with self.lock:
+                self.idle -= 1
+                self.unclaimed -= 1
+
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            continue
+
+####
+
+class _Poller:
+    def __init__(self):
+        try:
+            self.epoll = select.epoll()
+        except AttributeError:
+            self.epoll = None
+        self.fds = set()
+        return
+
+
+    def register(self, fd):
+        if self.epoll:
+            self.epoll.register(fd, select.EPOLLIN)
+        self.fds.add(fd)
+
+
+    def unregister(self, fd):
+        if self.epoll:
+            self.epoll.unregister(fd)
+        self.fds.remove(fd)
+
+
+    def poll(self, timeout):
+        try:
+            if self.epoll:
+                return [fd for (fd, _) in self.epoll.poll(timeout)]
+            (readable, _, _) = select.select(list(self.fds), [], [], timeout)
+            return readable
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+def _make_wake_pair():
+    try:
+        return socket.socketpair()
+    except AttributeError:
+        pass
+
+    # Windows' Python 2 has no socketpair.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    w = socket.create_connection(listener.getsockname())
+    (r, _) = listener.accept()
+    kill_socket(listener)
+    return (r, w)
+
+####
+
+class Blocking:
+    # A continuation that may block for long (waiting for a job slot, running the
+    # job), so runs on a thread of its own rather than on the capped worker pool,
+    # where it would hold up other connections' handshakes and jobs.
+    def __init__(self, func):
+        self.func = func
+        return
+
+
+class EventLoop:
+    # One thread polls every listening socket and every idle connection.
+    # Accepted connections are handed to `accept_func(conn, addr)` on a worker thread.
+    # Handlers may return a continuation `func(conn)` (or a Blocking), in which case
+    # the connection is parked on the loop until it is readable again, without
+    # holding a thread. Otherwise the connection is closed.
+    def __init__(self, max_workers=256, max_connections=4096, backlog=LISTEN_BACKLOG,
+                 idle_timeout=120.0, gai_poll_interval=GAI_POLL_INTERVAL):
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.gai_poll_interval = gai_poll_interval
+
+        self.pool = WorkerPool(max_workers)
+        self.poller = _Poller()
+
+        self.lock = threading.Lock()
+        self.ops = collections.deque()
+        (self.wake_r, self.wake_w) = _make_wake_pair()
+        self.wake_r.setblocking(0)
+        self.wake_w.setblocking(0)
+        self.poller.register(self.wake_r.fileno())
+
+        self.listen_addrs = [] # (addr, accept_func, {gai: listener})
+        self.listeners = dict() # fd -> (listener, accept_func)
+        self.parked = collections.OrderedDict() # fd -> (conn, func, deadline)
+        self.conn_count = 0
+        self.is_accepting = True
+
+        self.accepted = 0
+        self.rejected = 0
+        return
+
+
+    def listen(self, addr, accept_func):
+        with self.lock:
+            self.listen_addrs.append((addr, accept_func, dict()))
+        self._wake()
+
+    ####
+
+    def _wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except socket.error:
+            pass # Already has a pending wake.
+
+
+    def _park(self, conn, func):
+        with self.lock:
+            self.ops.append((conn, func))
+        self._wake()
+
+
+    def _release(self, conn):
+        kill_socket(conn)
+        with self.lock:
+            self.conn_count -= 1
+            if self.is_accepting or self.conn_count >= self.max_connections:
+                return
+        self._wake()
+
+    ####
+
+    def _run_handler(self, conn, func, args):
+        try:
+            next_func = func(conn, *args)
+        except (socket.error, ExSocketClosed) as e:
+            print('Uncaught error on {}: {}({})'.format(func, type(e), e))
+            next_func = None
+        except Exception:
+            traceback.print_exc()
+            next_func = None
+
+        if next_func:
+            self._park(conn, next_func)
+        else:
+            self._release(conn)
+        return
+
+
+    def _bind_listeners(self):
+        for (addr, accept_func, gai_map) in self.listen_addrs:
+            try:
+                gais = _listen_gais(addr)
+            except socket.gaierror as e:
+                print('getaddrinfo({}) failed: {}'.format(addr, e), file=sys.stderr)
+                continue
+
+            for gai in gais:
+                if gai in gai_map:
+                    continue
+                s = _bind_listener(gai, self.backlog)
+                if not s:
+                    continue
+                s.setblocking(0)
+                gai_map[gai] = s
+                self.listeners[s.fileno()] = (s, accept_func)
+                if self.is_accepting:
+                    self.poller.register(s.fileno())
+        return
+
+
+    def _set_accepting(self, is_accepting):
+        # Past max_connections, new connections wait in the listen backlog.
+        if is_accepting == self.is_accepting:
+            return
+        self.is_accepting = is_accepting
+        for fd in self.listeners:
+            if is_accepting:
+                self.poller.register(fd)
+            else:
+                self.poller.unregister(fd)
+        return
+
+
+    def _accept(self, listener, accept_func):
+        while True:
+            with self.lock:
+                if self.conn_count >= self.max_connections:
+                    self._set_accepting(False)
+                    self.rejected += 1
+                    return
+            try:
+                (conn, addr) = listener.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print('accept failed: {}'.format(e), file=sys.stderr)
+                return
+
+            conn.settimeout(socket.getdefaulttimeout())
+            with self.lock:
+                self.conn_count += 1
+                self.accepted += 1
+            self.pool.submit(self._run_handler, conn, accept_func, (addr,))
+            continue
+
+    ####
+
+    def run_forever(self):
+        next_gai_poll = 0
+        while True:
+            now = time.time()
+            if now >= next_gai_poll:
+                self._bind_listeners()
+                next_gai_poll = now + self.gai_poll_interval
+
+            timeout = next_gai_poll - now
+            if self.parked:
+                # Deadlines are in parking order, since idle_timeout is fixed.
+                (_, _, deadline) = next(self.parked.itervalues())
+                timeout = min(timeout, deadline - now)
+
+            for fd in self.poller.poll(max(timeout, 0)):
+                if fd == self.wake_r.fileno():
+                    try:
+                        while self.wake_r.recv(4096):
+                            continue
+                    except socket.error:
+                        pass
+                    continue
+
+                if fd in self.listeners:
+                    (listener, accept_func) = self.listeners[fd]
+                    self._accept(listener, accept_func)
+                    continue
+
+                (conn, func, _) = self.parked.pop(fd)
+                self.poller.unregister(fd)
+                if isinstance(func, Blocking):
+                    spawn_thread(self._run_handler, (conn, func.func, ()))
+                else:
+                    self.pool.submit(self._run_handler, conn, func, ())
+                continue
+
+            with self.lock:
+                ops = list(self.ops)
+                self.ops.clear()
+                self._set_accepting(self.conn_count < self.max_connections)
+
+            now = time.time()
+            for (conn, func) in ops:
+                fd = conn.fileno()
+                self.parked[fd] = (conn, func, now + self.idle_timeout)
+                self.poller.register(fd)
+                continue
+
+            while self.parked:
+                (fd, (conn, _, deadline)) = next(self.parked.iteritems())
+                if deadline > now:
+                    break
+                del self.parked[fd]
+                self.poller.unregister(fd)
+                self.pool.submit(self._release, conn)
+                continue
+            continue
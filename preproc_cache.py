@@ -0,0 +1,168 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import hashlib
+import marshal
+import os
+import time
+import zlib
+
+import ccerb
+
+####
+
+# Entries are files at root_dir/k/key, written atomically, so any number of shims
+# can share the cache without locks. Each is marshal data of (the time it was
+# recorded, [(path, size, mtime, sha1)] of the source and what it included, then
+# zlib-compressed marshal data of (outdata, errdata)).
+ENTRY_VERSION = 2
+SUB_DIRS = '0123456789abcdef'
+COMPRESS_LEVEL = 1
+
+# Output isn't stored if any file it came from changed this close to when the
+# preprocessor started, or after. The file may have changed while it ran, or may
+# change again within its mtime's resolution, so its hash from after the run
+# could pair new content with old output. ccache has the same rule.
+STAT_SLACK = 2.0
+
+# The preprocessed output of sources using these isn't the same on a rerun.
+VOLATILE_MACROS = ('__DATE__', '__TIME__', '__TIMESTAMP__')
+
+# Environment variables cl takes include dirs or args from.
+KEY_ENV_VARS = ('INCLUDE', 'CL', '_CL_')
+
+####
+
+def _file_info(path):
+    # Returns (size, mtime, sha1, data) from a single read.
+    with open(path, 'rb') as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+    return (st.st_size, st.st_mtime, hashlib.sha1(data).hexdigest(), data)
+
+
+class PreprocCache:
+    # Preprocessor output, reused while the source and every header it included
+    # (as -showIncludes lists them, after `note_prefix`) are unchanged. A header
+    # newly added ahead of one already included isn't noticed.
+    def __init__(self, root_dir, max_bytes, note_prefix):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.note_prefix = note_prefix
+        return
+
+
+    def key(self, job_key, preproc_args, source_path):
+        parts = [str(ENTRY_VERSION), job_key, os.getcwd(), os.path.abspath(source_path)]
+        parts += preproc_args
+        parts += [os.environ.get(x, '') for x in KEY_ENV_VARS]
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+    def _entry_path(self, key):
+        return os.path.join(self.root_dir, key[0], key)
+
+    ####
+
+    def lookup(self, key):
+        # Returns (outdata, errdata), or None.
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                (recorded, files, blob) = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        for (file_path, size, mtime, sha1) in files:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return None
+            if st.st_size != size:
+                return None
+            if st.st_mtime == mtime and mtime < recorded - STAT_SLACK:
+                continue
+            try:
+                if ccerb.hash_file(file_path) != sha1:
+                    return None
+            except IOError:
+                return None
+
+        try:
+            (outdata, errdata) = marshal.loads(zlib.decompress(blob))
+            os.utime(path, None) # For eviction, least recently used first.
+        except (zlib.error, EOFError, ValueError, TypeError, OSError):
+            return None
+        return (outdata, errdata)
+
+
+    def included_paths(self, errdata):
+        ret = []
+        for line in errdata.splitlines():
+            if line.startswith(self.note_prefix):
+                ret.append(line[len(self.note_prefix):].strip())
+        return ret
+
+
+    def without_notes(self, errdata):
+        # `errdata` as if -showIncludes hadn't been given.
+        return ''.join([x for x in errdata.splitlines(True)
+                        if not x.startswith(self.note_prefix)])
+
+
+    def store(self, key, source_path, outdata, errdata, started):
+        # `errdata` is the preprocessor's stderr with -showIncludes. `started` is
+        # when the preprocessor started, since any file could have changed since.
+        # Returns False if the result can't be reused.
+        files = []
+        for path in [source_path] + self.included_paths(errdata):
+            try:
+                (size, mtime, sha1, data) = _file_info(path)
+            except (IOError, OSError):
+                return False
+            if mtime >= started - STAT_SLACK:
+                return False
+            if any([x in data for x in VOLATILE_MACROS]):
+                return False
+            files.append((os.path.abspath(path), size, mtime, sha1))
+
+        blob = zlib.compress(marshal.dumps((outdata, errdata)), COMPRESS_LEVEL)
+        entry = marshal.dumps((started, files, blob))
+        if len(entry) > self.max_bytes // len(SUB_DIRS):
+            return False
+        try:
+            ccerb.write_file_atomic(self._entry_path(key), entry)
+            self._evict(key[0])
+        except (IOError, OSError) as e:
+            ccerb.v_log(1, '<preproc cache: failed to store {}: {}>', key, e)
+            return False
+        return True
+
+
+    def _evict(self, sub_dir):
+        # Each sub dir gets an even share of max_bytes, so a store only has to look
+        # through its own. Other shims may be evicting the same files.
+        dir_path = os.path.join(self.root_dir, sub_dir)
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                if st.st_mtime > time.time() - 60:
+                    continue # Still being written.
+            entries.append((st.st_mtime, path, st.st_size))
+            total_bytes += st.st_size
+
+        for (_, path, size) in sorted(entries):
+            if total_bytes <= self.max_bytes // len(SUB_DIRS):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+        return
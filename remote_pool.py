@@ -0,0 +1,218 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import os
+import random
+import socket
+import threading
+import time
+
+import ccerb
+import mux_util
+import net_util
+
+####
+
+# Remotes close connections parked longer than their EventLoop idle_timeout (120s).
+MAX_IDLE_SECS = 60.0
+
+NET_ERRORS = (socket.timeout, socket.error, net_util.ExSocketClosed)
+
+####
+
+class RemotePool:
+    # Warm connections to each dedicated remote, reused across jobs. With `use_mux`,
+    # each remote gets one multiplexed connection instead, with a stream per job,
+    # unless it's too old for that.
+    def __init__(self, addrs, host_info, choices, max_idle_per_remote=16, use_mux=True):
+        self.addrs = addrs
+        self.host_info = host_info
+        self.choices = choices
+        self.max_idle_per_remote = max_idle_per_remote
+        self.use_mux = use_mux
+
+        self.lock = threading.Lock()
+        self.idle = dict((addr, []) for addr in addrs) # addr -> [(conn, link, since)]
+        self.sessions = dict() # addr -> (MuxSession, link)
+        self.session_locks = dict((addr, threading.Lock()) for addr in addrs)
+        self.no_mux = set() # addrs
+
+        self.connects = 0
+        self.reuses = 0
+        self.failures = 0
+        self.streams = 0
+        return
+
+
+    def _get_idle(self, addr):
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.idle[addr]:
+                    return None
+                (conn, link, since) = self.idle[addr].pop()
+
+            # Readable while idle means the remote hung up.
+            if now - since < MAX_IDLE_SECS and not net_util.is_readable(conn):
+                with self.lock:
+                    self.reuses += 1
+                return (conn, link)
+            net_util.kill_socket(conn)
+            continue
+
+
+    def put(self, addr, conn, link):
+        if isinstance(conn, mux_util.MuxStream):
+            net_util.kill_socket(conn) # Opening another costs nothing.
+            return
+        with self.lock:
+            if len(self.idle[addr]) < self.max_idle_per_remote:
+                self.idle[addr].append((conn, link, time.time()))
+                return
+        net_util.kill_socket(conn)
+
+
+    def discard(self, conn):
+        with self.lock:
+            self.failures += 1
+        net_util.kill_socket(conn)
+
+    ####
+
+    def _get_session(self, addr):
+        # Returns (session, link) for `addr`, connecting if need be, or None if it
+        # doesn't multiplex.
+        if not self.use_mux:
+            return None
+        with self.session_locks[addr]:
+            with self.lock:
+                if addr in self.no_mux:
+                    return None
+                res = self.sessions.get(addr)
+            if res and res[0].is_alive():
+                return res
+
+            try:
+                res = ccerb.ccerbd_connect_mux(addr, self.host_info)
+            except NET_ERRORS:
+                return None
+            with self.lock:
+                self.connects += 1
+                if not res:
+                    ccerb.v_log(1, '<remote {} does not multiplex>', addr)
+                    self.no_mux.add(addr)
+                    return None
+            (conn, link) = res
+            session = mux_util.MuxSession(conn)
+            session.start()
+            with self.lock:
+                self.sessions[addr] = (session, link)
+            return (session, link)
+
+
+    def _query_stream(self, addr, job_key, session, session_link):
+        try:
+            stream = session.open()
+        except NET_ERRORS:
+            return None
+        link = ccerb.Link(session_link.codec, session_link.version, session_link.hello)
+        try:
+            status = ccerb.query_status(stream, job_key)
+        except NET_ERRORS:
+            self.discard(stream)
+            return None
+        with self.lock:
+            self.streams += 1
+        return (addr, stream, link, status)
+
+
+    def _query(self, addr, job_key):
+        session = self._get_session(addr)
+        if session:
+            return self._query_stream(addr, job_key, *session)
+
+        idle = self._get_idle(addr)
+        if idle:
+            (conn, link) = idle
+            try:
+                status = ccerb.query_status(conn, job_key)
+                return (addr, conn, link, status)
+            except NET_ERRORS:
+                self.discard(conn) # Stale: retry with a fresh connection.
+
+        try:
+            (conn, link, status) = ccerb.ccerbd_connect_status(addr, self.host_info,
+                                                               job_key)
+        except NET_ERRORS:
+            return None
+        with self.lock:
+            self.connects += 1
+        return (addr, conn, link, status)
+
+
+    def choose(self, job_key):
+        # Best-first candidates among a random sample of `choices` remotes.
+        # Every returned connection must be handed back via put() or discard().
+        addrs = random.sample(self.addrs, min(self.choices, len(self.addrs)))
+        ret = []
+        for addr in addrs:
+            res = self._query(addr, job_key)
+            if not res:
+                continue
+            (_, conn, link, status) = res
+            if not status.has_job_key:
+                self.put(addr, conn, link)
+                continue
+            ret.append(res)
+        ret.sort(key=lambda x: ccerb.status_score(x[3]))
+        return ret
+
+    ####
+
+    def run(self, candidate, job_key, priority, digest, job_args, output_names, in_dir,
+            input_names, out_dir, on_output=None, trace_id=None):
+        # Returns (returncode, outdata, errdata, output_files), or None if the remote
+        # failed. With `on_output`, output the remote streams goes to
+        # on_output(tag, data) rather than into outdata and errdata.
+        (addr, conn, link, _) = candidate
+        if link.version < 4:
+            trace_id = None
+        streamed = {ccerb.JOB_STDOUT: [], ccerb.JOB_STDERR: []}
+        if not on_output:
+            on_output = lambda tag, data: streamed[tag].append(data)
+        try:
+            job_state = ccerb.acquire_remote_job(conn, job_key, priority, digest,
+                                                 trace_id)
+            if job_state == ccerb.JOB_CANCELLED:
+                self.put(addr, conn, link)
+                return None
+            if job_state == ccerb.JOB_CACHED:
+                ccerb.start_remote_job(conn)
+            else:
+                frame = net_util.Frame()
+                ccerb.start_remote_job(frame)
+                ccerb.send_job_args(frame, link, job_args, output_names)
+                input_files = [(x, os.path.join(in_dir, x)) for x in input_names]
+                ccerb.send_file_paths(conn, input_files, link, frame, dedup=True)
+                ccerb.recv_job_output(conn, link, on_output)
+
+            returncode = net_util.recv_struct(conn, '<i')
+            outdata = ''.join(streamed[ccerb.JOB_STDOUT]) + ccerb.recv_payload(conn, link)
+            errdata = ''.join(streamed[ccerb.JOB_STDERR]) + ccerb.recv_payload(conn, link)
+            output_names = ccerb.recv_files_to_dir(conn, out_dir, link)
+        except NET_ERRORS as e:
+            ccerb.v_log(1, '<forward to {} failed: {}>', addr, e)
+            self.discard(conn)
+            return None
+
+        self.put(addr, conn, link)
+        output_files = [(x, os.path.join(out_dir, x)) for x in output_names]
+        return (returncode, outdata, errdata, output_files)
+
+    ####
+
+    def summary(self):
+        with self.lock:
+            idle = sum([len(x) for x in self.idle.values()])
+            return '{} connects, {} reuses, {} failures, {} idle, {} streams'.format(
+                self.connects, self.reuses, self.failures, idle, self.streams)
@@ -0,0 +1,196 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import collections
+import marshal
+import os
+import shutil
+import threading
+
+import ccerb
+
+####
+
+META_NAME = 'meta'
+
+####
+
+class ResultCache:
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.lru = collections.OrderedDict() # digest -> size, oldest first
+        self.total_bytes = 0
+        self.in_flight = dict() # digest -> threading.Event
+        self.pins = collections.Counter() # digest -> lookups not yet unpinned
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.bytes_stored = 0
+        self.bytes_served = 0
+
+        if not os.path.isdir(root_dir):
+            os.makedirs(root_dir)
+        self._load()
+        return
+
+
+    def _load(self):
+        entries = []
+        for digest in os.listdir(self.root_dir):
+            path = os.path.join(self.root_dir, digest)
+            meta_path = os.path.join(path, META_NAME)
+            if not os.path.exists(meta_path):
+                # Leftover from an interrupted store.
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+
+            size = 0
+            for x in os.listdir(path):
+                size += os.path.getsize(os.path.join(path, x))
+            entries.append((os.path.getmtime(meta_path), digest, size))
+            continue
+
+        for (_, digest, size) in sorted(entries):
+            self.lru[digest] = size
+            self.total_bytes += size
+        self._evict()
+        return
+
+
+    def _entry_path(self, digest):
+        return os.path.join(self.root_dir, digest)
+
+    ####
+
+    def lookup(self, digest):
+        # A result returned is pinned: its files aren't evicted until unpin(digest).
+        with self.lock:
+            try:
+                size = self.lru.pop(digest)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.lru[digest] = size
+            self.hits += 1
+            self.bytes_served += size
+            self.pins[digest] += 1
+
+        path = self._entry_path(digest)
+        try:
+            os.utime(os.path.join(path, META_NAME), None)
+            with open(os.path.join(path, META_NAME), 'rb') as f:
+                (returncode, outdata, errdata, names) = marshal.load(f)
+
+            output_files = [(name, os.path.join(path, str(i)))
+                            for (i, name) in enumerate(names)]
+        except (IOError, OSError, EOFError, ValueError) as e:
+            ccerb.v_log(1, '<result cache: dropping unreadable {}: {}>', digest, e)
+            self.unpin(digest)
+            self._remove(digest)
+            return None
+
+        return (returncode, outdata, errdata, output_files)
+
+
+    def unpin(self, digest):
+        with self.lock:
+            self.pins[digest] -= 1
+            if self.pins[digest]:
+                return
+            del self.pins[digest]
+            self._evict()
+        return
+
+
+    def store(self, digest, returncode, outdata, errdata, output_files):
+        path = self._entry_path(digest)
+        tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        try:
+            os.mkdir(tmp_path)
+            size = 0
+            names = []
+            for (i, (name, src_path)) in enumerate(output_files):
+                dest_path = os.path.join(tmp_path, str(i))
+                shutil.copyfile(src_path, dest_path)
+                size += os.path.getsize(dest_path)
+                names.append(name)
+
+            meta = marshal.dumps((returncode, outdata, errdata, names))
+            with open(os.path.join(tmp_path, META_NAME), 'wb') as f:
+                f.write(meta)
+            size += len(meta)
+
+            with self.lock:
+                if digest in self.lru:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    return
+                os.rename(tmp_path, path)
+                self.lru[digest] = size
+                self.total_bytes += size
+                self.bytes_stored += size
+                self._evict()
+        except (IOError, OSError) as e:
+            ccerb.v_log(1, '<result cache: failed to store {}: {}>', digest, e)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+
+    def _remove(self, digest):
+        with self.lock:
+            if digest in self.pins:
+                return # Someone read it fine.
+            try:
+                self.total_bytes -= self.lru.pop(digest)
+            except KeyError:
+                return
+        shutil.rmtree(self._entry_path(digest), ignore_errors=True)
+
+
+    def _evict(self):
+        # Requires self.lock. Pinned entries are skipped, until unpinned.
+        if self.total_bytes <= self.max_bytes:
+            return
+        for digest in list(self.lru):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if digest in self.pins:
+                continue
+            self.total_bytes -= self.lru.pop(digest)
+            self.evictions += 1
+            shutil.rmtree(self._entry_path(digest), ignore_errors=True)
+        return
+
+    ####
+
+    def claim(self, digest):
+        # Returns None if the caller now owns the compile for `digest`, otherwise an
+        # Event that is set when the current owner releases it.
+        with self.lock:
+            try:
+                event = self.in_flight[digest]
+            except KeyError:
+                self.in_flight[digest] = threading.Event()
+                return None
+            self.coalesced += 1
+            return event
+
+
+    def release(self, digest):
+        with self.lock:
+            event = self.in_flight.pop(digest)
+        event.set()
+        return
+
+    ####
+
+    def summary(self):
+        with self.lock:
+            return ('{} hits, {} misses, {} coalesced, {} evictions, {}/{} bytes,'
+                    ' {} stored, {} served').format(self.hits, self.misses,
+                    self.coalesced, self.evictions, self.total_bytes, self.max_bytes,
+                    self.bytes_stored, self.bytes_served)
@@ -0,0 +1,144 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import heapq
+import itertools
+import threading
+import time
+
+########################################
+
+class PriorityQueue:
+    # Min-heap of (key, seq, elem). remove() just marks the element, and dead
+    # entries are skipped by pop() or dropped when they outnumber live ones.
+    def __init__(self):
+        self.heap = []
+        self.live = 0
+        return
+
+
+    def __len__(self):
+        return self.live
+
+
+    def pop(self):
+        while self.heap:
+            (_, _, elem) = heapq.heappop(self.heap)
+            if elem.is_queued:
+                elem.is_queued = False
+                self.live -= 1
+                return elem
+        raise IndexError('pop from empty PriorityQueue')
+
+
+    def insert(self, elem):
+        heapq.heappush(self.heap, (elem.key, elem.seq, elem))
+        elem.is_queued = True
+        self.live += 1
+
+
+    def remove(self, elem):
+        if not elem.is_queued:
+            raise ValueError('not queued')
+        elem.is_queued = False
+        self.live -= 1
+
+        if len(self.heap) > 2 * self.live + 64:
+            self.heap = [x for x in self.heap if x[2].is_queued]
+            heapq.heapify(self.heap)
+        return
+
+####
+
+class Scheduler:
+    # Lower priority values run first. Equal keys run in FIFO order.
+    #
+    # With aging, a waiting job's effective priority drops by `aging_rate` per second
+    # waited. Every pending job ages at the same rate, so the heap order never changes:
+    # it's enough to sort on `priority + aging_rate * enqueue_time`.
+    def __init__(self, slots, aging_rate=0.0):
+        self.max_slots = slots
+        self.aging_rate = aging_rate
+        self.lock = threading.Lock()
+        self.pending = PriorityQueue()
+        self.active = set()
+        self.seq = itertools.count()
+        self.epoch = time.time()
+        self.changed = threading.Event() # Set on every enqueue and exit.
+        return
+
+
+    def _process(self):
+        try:
+            while len(self.active) < self.max_slots:
+                cur = self.pending.pop()
+                self.active.add(cur)
+                cur.ready_event.set()
+        except IndexError:
+            pass
+
+
+    def enqueue(self, priority, info):
+        return Scheduler.TimeSlot(self, priority, info)
+
+
+    def set_max_slots(self, slots):
+        # Fewer slots only stop pending jobs from starting: active ones run on.
+        with self.lock:
+            self.max_slots = slots
+            self._process()
+        self.changed.set()
+
+
+    def counts(self):
+        with self.lock:
+            return (len(self.active), len(self.pending))
+
+
+    def counts_by_priority(self):
+        # Returns {priority: (active, pending)}.
+        with self.lock:
+            active = [x.priority for x in self.active]
+            pending = [x[2].priority for x in self.pending.heap if x[2].is_queued]
+        ret = dict()
+        for x in set(active + pending):
+            ret[x] = (active.count(x), pending.count(x))
+        return ret
+
+    ####
+
+    class TimeSlot:
+        def __init__(self, scheduler, priority, info):
+            self.scheduler = scheduler
+            self.priority = priority
+            self.info = info
+            self.ready_event = threading.Event()
+            self.is_queued = False
+            self.seq = None
+            self.key = None
+            return
+
+
+        def __enter__(self):
+            sched = self.scheduler
+            with sched.lock:
+                self.seq = next(sched.seq)
+                self.key = self.priority + sched.aging_rate * (time.time() - sched.epoch)
+                sched.pending.insert(self)
+                sched._process()
+            sched.changed.set()
+            return self
+
+
+        def acquire(self, timeout=None):
+            return self.ready_event.wait(timeout)
+
+
+        def __exit__(self, ex_type, ex_val, ex_traceback):
+            with self.scheduler.lock:
+                try:
+                    self.scheduler.active.remove(self)
+                except KeyError:
+                    self.scheduler.pending.remove(self)
+                self.scheduler._process()
+            self.scheduler.changed.set()
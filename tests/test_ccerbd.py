@@ -0,0 +1,106 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+import ccerb
+
+####
+
+# Runs ccerbd.py with `ccerb` pointed at our ports, since it binds the local and log
+# ports from there rather than from the config.
+DAEMON_SCRIPT = '''
+import sys
+sys.argv = ['ccerbd']
+sys.path.insert(0, {root!r})
+import ccerb
+ccerb.CCERBD_LOCAL_ADDR = ('localhost', {local_port})
+ccerb.CCERBD_LOG_ADDR = ('localhost', {log_port})
+execfile({script!r})
+'''
+
+JOB_KEY = 'test_cc'
+
+def free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class DaemonTest(unittest.TestCase):
+    INI = ''
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.port = free_port()
+        # A compiler whose job key (see ccerb.get_job_key) is JOB_KEY.
+        cc_path = os.path.join(self.home, 'cc')
+        with open(cc_path, 'wb') as f:
+            f.write('#!/bin/sh\necho {} >&2\n'.format(JOB_KEY))
+        os.chmod(cc_path, 0o755)
+        with open(os.path.join(self.home, '.ccerb.ini'), 'wb') as f:
+            f.write('host_info=test\nport={}\nmetrics_port=0\n'.format(self.port))
+            f.write(self.INI)
+            f.write('[bin]\n{}=\n[dedicated_remotes]\n'.format(cc_path))
+
+        script = DAEMON_SCRIPT.format(root=ROOT_DIR, local_port=free_port(),
+                                      log_port=free_port(),
+                                      script=os.path.join(ROOT_DIR, 'ccerbd.py'))
+        env = dict(os.environ, HOME=self.home)
+        self.log = open(os.path.join(self.home, 'ccerbd.log'), 'wb')
+        self.daemon = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                       stdout=self.log, stderr=subprocess.STDOUT)
+        (self.conn, self.link) = self.connect()
+        return
+
+
+    def tearDown(self):
+        self.conn.close()
+        self.daemon.kill()
+        self.daemon.wait()
+        self.log.close()
+        shutil.rmtree(self.home)
+        return
+
+
+    def connect(self):
+        deadline = time.time() + 10
+        while True:
+            try:
+                return ccerb.ccerbd_connect(('localhost', self.port), 'test')
+            except socket.error:
+                if time.time() > deadline or self.daemon.poll() is not None:
+                    raise
+                time.sleep(0.1)
+
+####
+
+class NoHeaderStoreTest(DaemonTest):
+    INI = 'header_store_mb=0\n'
+
+    def test_pump_refused(self):
+        self.assertGreaterEqual(self.link.version, 5)
+
+        state = ccerb.acquire_remote_job(self.conn, JOB_KEY, 130, 'digest', None, True)
+        self.assertEqual(state, ccerb.JOB_NO_PUMP)
+
+        # Still good for other requests.
+        status = ccerb.query_status(self.conn, JOB_KEY)
+        self.assertTrue(status.has_job_key)
+        return
+
+####
+
+if __name__ == '__main__':
+    unittest.main()
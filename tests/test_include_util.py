@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import include_util
+
+####
+
+class FindHeadersTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        return
+
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        return
+
+
+    def write(self, rel_path, data=''):
+        path = os.path.join(self.root, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+    def found(self, paths, include_dirs):
+        ret = include_util.find_headers(paths, include_dirs)
+        return sorted(os.path.relpath(x, self.root) for x in ret)
+
+
+    def test_include_stack(self):
+        # c.h is only next to a.h, two levels up the include stack from b.h.
+        src = self.write('src/u.c', '#include <p/a.h>\n')
+        self.write('inc/p/a.h', '#include "q/b.h"\n')
+        self.write('inc/p/q/b.h', '#include "c.h"\n#include <d.h>\n')
+        self.write('inc/p/c.h')
+        self.write('src/d.h') # Angled names aren't looked for next to the source.
+        inc = os.path.join(self.root, 'inc')
+        self.assertEqual(self.found([src], [inc]),
+                         ['inc/p/a.h', 'inc/p/c.h', 'inc/p/q/b.h', 'src/u.c'])
+        return
+
+
+    def test_all_matches(self):
+        src = self.write('src/u.c', '#include "x.h"\n#include <y.h>\n')
+        self.write('src/x.h')
+        self.write('i1/x.h')
+        self.write('i1/y.h')
+        self.write('i2/y.h')
+        inc = [os.path.join(self.root, x) for x in ('i1', 'i2')]
+        self.assertEqual(self.found([src], inc),
+                         ['i1/x.h', 'i1/y.h', 'i2/y.h', 'src/u.c', 'src/x.h'])
+        return
+
+
+    def test_many_include_dirs(self):
+        # Every module includes every other's header, so a header is reached
+        # through every subset of the include dirs.
+        count = 24
+        include_dirs = []
+        for k in range(count):
+            lines = ['#include <h{}.h>'.format(j) for j in range(count) if j != k]
+            lines.append('#include "local{}.h"'.format(k))
+            self.write('inc{}/h{}.h'.format(k, k), '\n'.join(lines) + '\n')
+            self.write('inc{}/local{}.h'.format(k, k), '#include "shared.h"\n')
+            self.write('inc{}/shared.h'.format(k))
+            include_dirs.append(os.path.join(self.root, 'inc{}'.format(k)))
+        src = self.write('u.c', '#include <h0.h>\n')
+
+        start = time.time()
+        found = self.found([src], include_dirs)
+        self.assertLess(time.time() - start, 5.0)
+        self.assertEqual(len(found), 3 * count + 1)
+        return
+
+####
+
+if __name__ == '__main__':
+    unittest.main()
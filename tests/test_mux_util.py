@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mux_util
+import net_util
+
+####
+
+def wait_until(is_done, timeout=5.0):
+    deadline = time.time() + timeout
+    while not is_done():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class MuxSessionTest(unittest.TestCase):
+    # A MuxSession on one end of a socket pair, with raw frames on the other.
+    def setUp(self):
+        (self.conn, self.peer) = socket.socketpair()
+        self.conn.settimeout(2.0)
+        self.peer.settimeout(2.0)
+        self.streams = []
+        self.session = mux_util.MuxSession(self.conn, self.on_stream)
+        self.thread = threading.Thread(target=self.session.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+
+    def tearDown(self):
+        net_util.kill_socket(self.peer)
+        self.thread.join(5.0)
+        return
+
+
+    def on_stream(self, stream):
+        self.streams.append(stream)
+        stream.close() # As ccerbd does past max_mux_streams.
+
+
+    def send(self, stream_id, kind, data=b''):
+        self.peer.sendall(mux_util.MUX_HEADER.pack(stream_id, kind, len(data)) + data)
+
+
+    def recv_frame(self):
+        header = net_util.recv_n(self.peer, mux_util.MUX_HEADER.size)
+        (stream_id, kind, length) = mux_util.MUX_HEADER.unpack(bytes(header))
+        if kind == mux_util.MUX_DATA:
+            net_util.recv_n(self.peer, length)
+        return (stream_id, kind)
+
+
+    def test_close_while_send_blocked(self):
+        # A writer stuck on the connection mustn't stall dispatch.
+        self.session.send_lock.acquire()
+        try:
+            for stream_id in range(1, 9):
+                self.send(stream_id, mux_util.MUX_OPEN)
+            self.assertTrue(wait_until(lambda: len(self.streams) == 8))
+        finally:
+            self.session.send_lock.release()
+        self.session.send_frame(0, mux_util.MUX_PING)
+
+        closed = set()
+        while len(closed) < 8:
+            (stream_id, kind) = self.recv_frame()
+            if kind == mux_util.MUX_CLOSE:
+                closed.add(stream_id)
+        self.assertEqual(closed, set(range(1, 9)))
+        return
+
+
+    def test_data_over_window(self):
+        self.session.on_stream = lambda stream: None # Left open.
+        self.send(1, mux_util.MUX_OPEN)
+        chunk = b'x' * mux_util.MUX_MAX_FRAME
+        try:
+            for _ in range(mux_util.MUX_WINDOW // len(chunk) + 1):
+                self.send(1, mux_util.MUX_DATA, chunk)
+        except socket.error:
+            pass # Already failed.
+        # Well before the session would time out.
+        self.assertTrue(wait_until(lambda: not self.session.is_alive(), 1.0))
+        return
+
+####
+
+if __name__ == '__main__':
+    unittest.main()
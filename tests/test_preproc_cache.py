@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import preproc_cache
+
+####
+
+NOTE_PREFIX = 'Note: including file:'
+
+class PreprocCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = preproc_cache.PreprocCache(os.path.join(self.root, 'cache'),
+                                                16 * 1024 * 1024, NOTE_PREFIX)
+        self.source = self.write('u.c', '#include "h.h"\n', age=60)
+        self.header = self.write('h.h', 'int x;\n', age=60)
+        self.errdata = '{} {}\n'.format(NOTE_PREFIX, self.header)
+        self.key = self.cache.key('job', ['-E'], self.source)
+        return
+
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        return
+
+
+    def write(self, name, data, age=0):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+
+    def test_store_and_lookup(self):
+        started = time.time()
+        self.assertTrue(self.cache.store(self.key, self.source, 'out', self.errdata,
+                                         started))
+        self.assertEqual(self.cache.lookup(self.key), ('out', self.errdata))
+
+        self.write('h.h', 'int y;\n')
+        self.assertEqual(self.cache.lookup(self.key), None)
+        return
+
+
+    def test_header_edited_while_preprocessing(self):
+        started = time.time()
+        # The preprocessor read the old header; this lands before the store.
+        self.write('h.h', 'int y;\n')
+        self.assertFalse(self.cache.store(self.key, self.source, 'old out',
+                                          self.errdata, started))
+        self.assertEqual(self.cache.lookup(self.key), None)
+        return
+
+
+    def test_header_edited_just_before(self):
+        # Within STAT_SLACK of the start, the edit may not be what was read.
+        self.write('h.h', 'int y;\n', age=preproc_cache.STAT_SLACK / 2)
+        self.assertFalse(self.cache.store(self.key, self.source, 'out', self.errdata,
+                                          time.time()))
+        return
+
+####
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import binascii
+import json
+import os
+import threading
+import time
+
+####
+
+# Every process on a host appends its spans to the same file in its trace_dir,
+# one JSON object per line. ccerb_trace.py merges these files, from any number of
+# hosts, into one Chrome trace.
+TRACE_FILE_NAME = 'ccerb-trace.jsonl'
+
+def new_trace_id():
+    return binascii.hexlify(os.urandom(8))
+
+####
+
+class Tracer:
+    # Spans belong to the calling thread's trace id (see set_trace_id), or else the
+    # default one, and are dropped without either. Nothing is recorded without a
+    # `trace_dir`, so call sites needn't check. Buffered spans go out on flush(),
+    # as a single append.
+    def __init__(self, trace_dir, host, process_name, max_bytes=0):
+        self.path = None
+        if trace_dir:
+            self.path = os.path.join(trace_dir, TRACE_FILE_NAME)
+        self.host = host
+        self.process_name = process_name
+        self.pid = os.getpid()
+        self.max_bytes = max_bytes # Past this, flush() starts the file over.
+
+        self.default_id = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.spans = []
+        return
+
+
+    def set_trace_id(self, trace_id):
+        # For the calling thread.
+        self.local.trace_id = trace_id
+
+
+    def current(self):
+        if not self.path:
+            return None
+        return getattr(self.local, 'trace_id', None) or self.default_id
+
+
+    def add(self, name, start, end, args=None, trace_id=None):
+        if not trace_id:
+            trace_id = self.current()
+            if not trace_id:
+                return
+        span = (trace_id, name, start, end, threading.current_thread().ident, args)
+        with self.lock:
+            self.spans.append(span)
+        return
+
+    ####
+
+    def flush(self):
+        with self.lock:
+            spans = self.spans
+            self.spans = []
+        if not spans:
+            return
+
+        lines = []
+        for (trace_id, name, start, end, tid, args) in spans:
+            span = {'trace': trace_id, 'name': name, 'ts': start, 'dur': end - start,
+                    'host': self.host, 'proc': self.process_name, 'pid': self.pid,
+                    'tid': tid}
+            if args:
+                span['args'] = args
+            lines.append(json.dumps(span, separators=(',', ':')) + '\n')
+
+        try:
+            if self.max_bytes and os.path.getsize(self.path) > self.max_bytes:
+                os.rename(self.path, self.path + '.old')
+        except OSError:
+            pass
+
+        # One write, so lines from processes sharing the file don't interleave.
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, ''.join(lines))
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+        return
+
+
+    def flush_every(self, interval):
+        # Doesn't return.
+        while True:
+            time.sleep(interval)
+            self.flush()
@@ -0,0 +1,250 @@
+from __future__ import print_function
+assert __name__ != '__main__'
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import ccerb
+
+####
+
+def empty_dir(path):
+    # Removes everything under `path`, leaving `path` itself in place.
+    for (cur_root, cur_dirs, cur_files) in os.walk(path, topdown=False):
+        for x in cur_files:
+            os.remove(os.path.join(cur_root, x))
+        for x in cur_dirs:
+            dir_path = os.path.join(cur_root, x)
+            if os.path.islink(dir_path):
+                os.remove(dir_path)
+            else:
+                os.rmdir(dir_path)
+    return
+
+####
+
+class Workspace:
+    # Released back to its pool when the `with` block exits.
+    def __init__(self, pool, path, is_ram, setup_secs):
+        self.pool = pool
+        self.path = path
+        self.is_ram = is_ram
+        self.max_bytes = pool.max_bytes
+        self.setup_secs = setup_secs
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_val, ex_traceback):
+        self.pool.release(self)
+        return
+
+
+class LazyWorkspace:
+    # A workspace acquired only if path() is called, and released with the `with`
+    # block either way.
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.workspace = None
+        return
+
+    def path(self):
+        with self.lock:
+            if not self.workspace:
+                self.workspace = self.pool.acquire()
+            return self.workspace.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_val, ex_traceback):
+        if self.workspace:
+            self.pool.release(self.workspace)
+        return
+
+
+class WorkspacePool:
+    # Job scratch dirs, emptied and reused instead of created and removed per job.
+    # Each workspace is capped at `max_bytes` (0 for no cap). With a `ram_root` (e.g.
+    # a tmpfs) and a cap, workspaces go there while their caps fit in
+    # `ram_max_bytes`, and under `disk_root` beyond that.
+    def __init__(self, disk_root, ram_root, ram_max_bytes, max_bytes, max_idle):
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle # Per root.
+
+        self.ram_slots = 0
+        if ram_root and max_bytes:
+            self.ram_slots = ram_max_bytes // max_bytes
+
+        self.roots = dict()
+        self.roots[False] = tempfile.mkdtemp(prefix='ccerbd-ws-', dir=disk_root)
+        if self.ram_slots:
+            self.roots[True] = tempfile.mkdtemp(prefix='ccerbd-ws-', dir=ram_root)
+
+        self.lock = threading.Lock()
+        self.idle = {False: [], True: []} # is_ram -> [path]
+        self.ram_in_use = 0
+        self.next_id = 0
+
+        self.jobs = 0
+        self.creates = 0
+        self.reuses = 0
+        self.ram_fallbacks = 0
+        self.ram_retries = 0
+        self.drops = 0
+        self.setup_secs = 0.0
+        self.teardown_secs = 0.0
+        return
+
+
+    def _new_path(self, is_ram):
+        # Requires self.lock.
+        path = os.path.join(self.roots[is_ram], str(self.next_id))
+        self.next_id += 1
+        return path
+
+
+    def fill(self, count):
+        # Pre-creates up to `count` idle workspaces, RAM-backed first.
+        for i in range(min(count, self.max_idle * len(self.roots))):
+            is_ram = i < min(self.ram_slots, self.max_idle)
+            with self.lock:
+                path = self._new_path(is_ram)
+            os.mkdir(path)
+            with self.lock:
+                self.idle[is_ram].append(path)
+        return
+
+    ####
+
+    def acquire(self):
+        start = time.time()
+        with self.lock:
+            is_ram = self.ram_in_use < self.ram_slots
+            if is_ram:
+                self.ram_in_use += 1
+            elif self.ram_slots:
+                self.ram_fallbacks += 1
+
+            path = None
+            if self.idle[is_ram]:
+                path = self.idle[is_ram].pop()
+                self.reuses += 1
+            else:
+                new_path = self._new_path(is_ram)
+                self.creates += 1
+
+        if not path:
+            try:
+                os.mkdir(new_path)
+            except OSError:
+                if is_ram:
+                    with self.lock:
+                        self.ram_in_use -= 1
+                raise
+            path = new_path
+        return Workspace(self, path, is_ram, time.time() - start)
+
+
+    def may_be_full(self, workspace, errdata=''):
+        # Whether a job that failed in `workspace` may have run out of space. Only
+        # inputs count against a workspace's cap, so a RAM one can fill up with the
+        # compiler's outputs.
+        if not workspace.is_ram:
+            return False
+        if os.strerror(errno.ENOSPC) in errdata or 'not enough space' in errdata:
+            return True
+        try:
+            st = os.statvfs(workspace.path)
+        except (OSError, AttributeError):
+            return False # No statvfs on Windows.
+        return st.f_bavail * st.f_frsize < self.max_bytes
+
+
+    def move_to_disk(self, workspace, input_names):
+        # Moves `workspace` to a disk one, with only its inputs, for a job to run
+        # again there. Its RAM one goes back to the pool.
+        with self.lock:
+            if self.idle[False]:
+                path = self.idle[False].pop()
+                self.reuses += 1
+            else:
+                path = self._new_path(False)
+                self.creates += 1
+            self.ram_retries += 1
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        for name in input_names:
+            dest_path = os.path.join(path, name)
+            if not os.path.isdir(os.path.dirname(dest_path)):
+                os.makedirs(os.path.dirname(dest_path))
+            shutil.copyfile(os.path.join(workspace.path, name), dest_path)
+
+        ram_workspace = Workspace(self, workspace.path, True, 0.0)
+        workspace.path = path
+        workspace.is_ram = False
+        self.release(ram_workspace)
+        return
+
+
+    def acquire_lazy(self):
+        return LazyWorkspace(self)
+
+
+    def release(self, workspace):
+        start = time.time()
+        try:
+            empty_dir(workspace.path)
+            is_clean = True
+        except OSError as e:
+            ccerb.v_log(1, '<workspace: dropping {}: {}>', workspace.path, e)
+            is_clean = False
+        teardown_secs = time.time() - start
+
+        with self.lock:
+            if workspace.is_ram:
+                self.ram_in_use -= 1
+            idle = self.idle[workspace.is_ram]
+            is_kept = is_clean and len(idle) < self.max_idle
+            if is_kept:
+                idle.append(workspace.path)
+            else:
+                self.drops += 1
+
+            self.jobs += 1
+            self.setup_secs += workspace.setup_secs
+            self.teardown_secs += teardown_secs
+
+        if not is_kept:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+
+        ccerb.v_log(3, '<<workspace {}{}: setup {}us, teardown {}us>>', workspace.path,
+                    ' (ram)' if workspace.is_ram else '',
+                    int(workspace.setup_secs * 1000 * 1000),
+                    int(teardown_secs * 1000 * 1000))
+        return
+
+
+    def close(self):
+        for root in self.roots.values():
+            shutil.rmtree(root, ignore_errors=True)
+        return
+
+    ####
+
+    def summary(self):
+        with self.lock:
+            jobs = max(self.jobs, 1)
+            return ('{} jobs, {} created, {} reused, {} dropped, {}/{} ram in use,'
+                    ' {} ram fallbacks, {} ram retries, avg setup {}us,'
+                    ' avg teardown {}us').format(
+                    self.jobs, self.creates, self.reuses, self.drops, self.ram_in_use,
+                    self.ram_slots, self.ram_fallbacks, self.ram_retries,
+                    int(self.setup_secs / jobs * 1000 * 1000),
+                    int(self.teardown_secs / jobs * 1000 * 1000))